@@ -0,0 +1,533 @@
+"""
+Hermetic benchmark of kc-compat.py and kernelchecker.py.
+
+Both scripts are run end to end in subprocesses against generated fake package managers
+(rpm, yum, dpkg-query, apt-get, apt-cache, kcarectl), generated package databases and a local
+stub of the patches server. Nothing on the host is read or changed, except /proc/version.
+
+The kernelchecker-parsers scenario times package parsers and version ordering of kernelchecker.py
+in process, on real kernel package names of kernel_corpus.tsv, and reports their throughput.
+
+Usage:
+    python bench_kcare.py [--repeat 5] [--kernels 50] [--delay 0.05] [--latency 0.02]
+                          [--save baseline.json | --baseline baseline.json --max-regression 20]
+                          [--startup-budget 20] [--records 100000]
+"""
+import argparse
+import gzip
+import importlib.util
+import inspect
+import json
+import os
+import random
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KC_COMPAT = os.path.join(HERE, 'kc-compat.py')
+KERNELCHECKER = os.path.join(HERE, 'kernelchecker.py')
+CORPUS = os.path.join(HERE, 'kernel_corpus.tsv')
+
+# functions timed inside the scripts, reported as phases
+PHASES = {
+    KC_COMPAT: ['get_kernel_hash', 'is_compat', 'batch_main'],
+    KERNELCHECKER: ['RpmHandler.get_installed', 'RpmHandler.get_available',
+                    'DpkgHandler.get_installed', 'DpkgHandler.get_available',
+                    'KernelChecker.is_kernelcare_supported_kernel', 'KernelChecker.is_kernelcare_up2date'],
+}
+
+# kc-compat.py as run through curl | python inside a container: compiled from source, exits early
+STARTUP_CODE = '''
+import sys
+module = type(sys)('kc_compat')
+exec(compile(open(%r).read(), 'kc-compat.py', 'exec'), module.__dict__)
+module.detect_container = lambda facts: 'openvz'
+sys.argv = ['kc-compat.py', '--silent']
+sys.exit(module.main() != 2)
+'''
+
+RPM_RELEASE = '3.10.0-1160.el7.x86_64'
+DPKG_RELEASE = '4.15.0-20-generic'
+
+
+class PatchServerStub(ThreadingMixIn, HTTPServer):
+    """
+    Local stub of patches server /<hash>/version endpoint
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, supported_rate=1.0):
+        """
+        :param latency: seconds to wait before every response
+        :param error_rate: share of requests answered with 500
+        :param supported_rate: share of kernel hashes answered with 200, others get 404
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), PatchServerHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.supported_rate = supported_rate
+        self.requests = 0
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+class PatchServerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let delayed ACKs stall keep-alive connections
+    disable_nagle_algorithm = True
+
+    def answer(self, with_body):
+        server = self.server
+        server.requests += 1
+        time.sleep(server.latency)
+        parts = self.path.strip('/').split('/')
+        if random.random() < server.error_rate:
+            code = 500
+        elif len(parts) == 2 and parts[1] == 'version' and \
+                int(parts[0][:8] or '0', 16) / float(0xffffffff) < server.supported_rate:
+            code = 200
+        else:
+            code = 404
+        body = b'1\n' if code == 200 else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.answer(True)
+
+    def do_HEAD(self):
+        self.answer(False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_executable(path, output, delay, rc=0):
+    with open(path + '.out', 'w') as f:
+        f.write(output)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nsleep %s\ncat "%s.out"\nexit %d\n' % (delay, path, rc))
+    os.chmod(path, 0o755)
+
+
+def rpm_header(tags):
+    index, store = b'', b''
+    for tag, value in sorted(tags.items()):
+        if isinstance(value, int):
+            store += b'\0' * (-len(store) % 4)
+            index += struct.pack('>iiii', tag, 4, len(store), 1)
+            store += struct.pack('>i', value)
+        else:
+            index += struct.pack('>iiii', tag, 6, len(store), 1)
+            store += value.encode() + b'\0'
+    return struct.pack('>ii', len(tags), len(store)) + index + store
+
+
+class FakeHost(object):
+    """
+    Temporary directory with fake package managers, package databases and repository metadata
+    """
+
+    def __init__(self, kernels, packages, delay):
+        """
+        :param kernels: number of kernel packages installed and available
+        :param packages: number of other packages in databases and metadata
+        :param delay: seconds every fake executable takes
+        """
+        self.root = tempfile.mkdtemp(prefix='kcare-bench-')
+        self.bin = self.path('bin')
+        os.makedirs(self.bin)
+        rpm_versions = ['3.10.0-%d.el7' % (1160 + i) for i in range(kernels)]
+        dpkg_versions = ['4.15.0-%d-generic' % (20 + i) for i in range(kernels)]
+
+        write_executable(os.path.join(self.bin, 'rpm'), ''.join(v + '\n' for v in rpm_versions), delay)
+        write_executable(os.path.join(self.bin, 'yum'), 'Available Packages\n' + ''.join(
+            'kernel.x86_64    %s    updates\n' % v for v in rpm_versions), delay)
+        write_executable(os.path.join(self.bin, 'dpkg-query'), ''.join(
+            'linux-image-%s\t%s\n' % (v, v) for v in dpkg_versions), delay)
+        write_executable(os.path.join(self.bin, 'apt-get'), 'Reading package lists... Done\n', delay)
+        write_executable(os.path.join(self.bin, 'apt-cache'), ''.join(
+            'linux-image-%s - Linux kernel image\n' % v for v in dpkg_versions), delay)
+        write_executable(os.path.join(self.bin, 'kcarectl'), 'Update available\n', delay, rc=1)
+
+        fillers = ['package%d' % i for i in range(packages)]
+        os.makedirs(self.path('apt-lists'))
+        with open(self.path('dpkg-status'), 'w') as status, \
+                open(self.path('apt-lists', 'bench_Packages'), 'w') as lists:
+            for name in fillers + ['linux-image-' + v for v in dpkg_versions]:
+                status.write('Package: %s\nStatus: install ok installed\nVersion: 1.0\n\n' % name)
+                lists.write('Package: %s\nVersion: 1.0\nDescription: %s\n\n' % (name, name))
+
+        conn = sqlite3.connect(self.path('rpmdb.sqlite'))
+        conn.execute('CREATE TABLE Packages (hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB NOT NULL)')
+        conn.execute('CREATE TABLE Name (key TEXT NOT NULL, hnum INTEGER NOT NULL, idx INTEGER NOT NULL)')
+        rpm_packages = [(name, '1.0', '1.el7') for name in fillers] + \
+            [('kernel',) + tuple(v.split('-', 1)) for v in rpm_versions]
+        for name, version, release in rpm_packages:
+            blob = rpm_header({1000: name, 1001: version, 1002: release, 1022: 'x86_64'})
+            cursor = conn.execute('INSERT INTO Packages (blob) VALUES (?)', (blob,))
+            conn.execute('INSERT INTO Name VALUES (?, ?, 0)', (name, cursor.lastrowid))
+        conn.commit()
+        conn.close()
+
+        os.makedirs(self.path('repo', 'repodata'))
+        with gzip.open(self.path('repo', 'repodata', 'bench-primary.xml.gz'), 'wt') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<metadata xmlns="http://linux.duke.edu/metadata/common" packages="%d">\n' % len(rpm_packages))
+            for name, version, release in rpm_packages:
+                f.write('<package type="rpm"><name>%s</name><arch>x86_64</arch>'
+                        '<version epoch="0" ver="%s" rel="%s"/></package>\n' % (name, version, release))
+            f.write('</metadata>\n')
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def remove(self):
+        shutil.rmtree(self.root)
+
+    def attrs(self, native):
+        """
+        :param native: use generated package databases and metadata instead of fake executables
+        :return: kernelchecker.py module attributes pointing it to this host
+        """
+        missing = self.path('missing')
+        return {
+            'DPKG_STATUS': self.path('dpkg-status') if native else missing,
+            'APT_LISTS_DIR': self.path('apt-lists') if native else missing,
+            'RPMDB_SQLITE': [self.path('rpmdb.sqlite') if native else missing],
+            'RPM_METADATA_GLOBS': [self.path('repo', 'repodata', '*primary.xml*') if native else missing],
+            'KCARE_BIN': os.path.join(self.bin, 'kcarectl'),
+            # generated databases only, not the ones of the benchmark host
+            'PACKAGE_BINDINGS': [],
+            'KCARE_INFO': missing,
+            'KCARE_PATCHES_DIR': missing,
+        }
+
+
+def scenarios(host, server, hosts, distinct):
+    """
+    :return: list of (name, driver config) to run
+    """
+    hashes = host.path('hashes')
+    with open(hashes, 'w') as f:
+        for i in range(hosts):
+            f.write('%040x\n' % random.randint(0, distinct - 1))
+    result = []
+    for name, args in [('kc-compat', ['--no-cache']),
+                       ('kc-compat-refresh', ['--refresh']),
+                       ('kc-compat-cached', []),
+                       ('kc-compat-batch', ['--no-cache', '--batch', hashes])]:
+        result.append((name, {
+            'script': KC_COMPAT,
+            'args': ['--silent'] + args,
+            'attrs': {'PATCH_SERVER': server.address},
+            'no_container': True,
+        }))
+    for distro, release in [('rpm', RPM_RELEASE), ('dpkg', DPKG_RELEASE)]:
+        for native in (False, True):
+            attrs = host.attrs(native)
+            attrs['PATCH_SERVER'] = server.address
+            result.append(('kernelchecker-%s%s' % (distro, '-db' if native else ''), {
+                'script': KERNELCHECKER,
+                'args': ['--no-cache', '--json'],
+                'attrs': attrs,
+                'distro': distro,
+                'release': release,
+                'no_container': True,
+            }))
+    return result
+
+
+def resolve(module, dotted):
+    owner = module
+    parts = dotted.split('.')
+    for part in parts[:-1]:
+        owner = getattr(owner, part)
+    return owner, parts[-1]
+
+
+def patch_function(module, dotted, replace):
+    """
+    Replace function or method with replace(original), keeping staticmethods static
+    """
+    owner, name = resolve(module, dotted)
+    original = getattr(owner, name)
+    replacement = replace(original)
+    if inspect.isclass(owner) and isinstance(inspect.getattr_static(owner, name), staticmethod):
+        replacement = staticmethod(replacement)
+    setattr(owner, name, replacement)
+
+
+def timed(phases, name, func):
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phases.setdefault(name, []).append(time.time() - started)
+    return wrapper
+
+
+def run_driver(config_path):
+    """
+    Run script in this process with attributes from config, report phase timings to config['report']
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    spec = importlib.util.spec_from_file_location('bench_script', config['script'])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    for name, value in config['attrs'].items():
+        setattr(module, name, value)
+    module.default_cache_dir = lambda: config['cache_dir']
+    if config.get('no_container'):
+        module.HostFacts.container = None
+    if config.get('distro'):
+        patch_function(module, 'KernelChecker.get_distro_type', lambda original: lambda facts=None: config['distro'])
+    if config.get('release'):
+        module.HostFacts.kernel_release = config['release']
+
+    phases = {}
+    for name in PHASES[config['script']]:
+        try:
+            patch_function(module, name, lambda original, name=name: timed(phases, name, original))
+        except AttributeError:
+            pass
+
+    sys.argv = [config['script']] + config['args']
+    started = time.time()
+    rc = module.main()
+    phases['main'] = [time.time() - started]
+    with open(config['report'], 'w') as f:
+        json.dump({'rc': rc, 'phases': dict((k, sum(v)) for k, v in phases.items())}, f)
+
+
+def run_scenario(host, config):
+    """
+    :return: dict of phase -> seconds, 'total' includes interpreter startup
+    """
+    config = dict(config, cache_dir=host.path('cache'), report=host.path('report.json'))
+    config_path = host.path('config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    env = dict(os.environ, PATH=host.bin + os.pathsep + os.environ.get('PATH', ''))
+    started = time.time()
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), '--driver', config_path],
+                          env=env, stdout=subprocess.PIPE)
+    total = time.time() - started
+    with open(config['report']) as f:
+        phases = json.load(f)['phases']
+    phases['total'] = total
+    return phases
+
+
+def measure_startup():
+    """
+    :return: dict of phase -> seconds: bare interpreter startup, and kc-compat.py startup on top of it
+    """
+    def run(code):
+        started = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        return time.time() - started
+    interpreter = run('pass')
+    return {'interpreter': interpreter, 'startup': run(STARTUP_CODE % KC_COMPAT) - interpreter}
+
+
+def load_corpus(path=CORPUS):
+    """
+    :return: (distro, format, package, version, flavor) rows of kernel corpus
+    """
+    with open(path) as f:
+        return [tuple((line.rstrip('\n').split('\t') + [''])[:5]) for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+def measure_parsers(module, records):
+    """
+    Time parsers and version ordering of kernelchecker.py over corpus packages, passing over the corpus
+    until at least records packages or versions are handled by each phase
+    :param module: loaded kernelchecker.py
+    :return: dict of phase -> seconds, dict of phase -> records handled
+    """
+    corpus = load_corpus()
+    yum_lines, deb_names, rpm_versions, deb_versions = [], [], [], []
+    for _, fmt, package, version, _ in corpus:
+        if fmt == 'rpm':
+            rest, arch = package.rsplit('.', 1)
+            name, ver, release = rest.rsplit('-', 2)
+            yum_lines.append('%s.%s    %s-%s    updates' % (name, arch, ver, release))
+            if version != '-':
+                rpm_versions.append('%s-%s.%s' % (ver, release, arch))
+        else:
+            deb_names.append(package)
+            if version != '-':
+                deb_versions.append(version)
+    short_versions = [module.RpmHandler.strip_version(version) for version in rpm_versions]
+
+    def latest(distro_type, versions):
+        checker = module.KernelChecker(lazy=True)
+        checker.distro_type = distro_type
+        checker.current_version, checker.installed_versions, checker.available_versions = \
+            versions[0], versions[1:], []
+        return checker.get_latest()
+
+    phases = {
+        'parse_packages yum': (yum_lines, lambda: list(module.parse_packages(yum_lines, 'yum'))),
+        'parse_packages deb': (deb_names, lambda: list(module.parse_packages(deb_names, 'deb'))),
+        'strip_version': (rpm_versions, lambda: [module.RpmHandler.strip_version(v) for v in rpm_versions]),
+        'sort rpm_evr_key': (short_versions, lambda: sorted(short_versions, key=module.rpm_evr_key)),
+        'sort dpkg_version_key': (deb_versions, lambda: sorted(deb_versions, key=module.dpkg_version_key)),
+        'get_latest rpm': (short_versions, lambda: latest('rpm', short_versions)),
+        'get_latest dpkg': (deb_versions, lambda: latest('dpkg', deb_versions)),
+    }
+    seconds, counts = {}, {}
+    for phase, (items, run) in phases.items():
+        passes = -(-records // len(items))
+        started = time.time()
+        for _ in range(passes):
+            run()
+        seconds[phase] = time.time() - started
+        counts[phase] = passes * len(items)
+    return seconds, counts
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def compare(results, baseline, max_regression, slack):
+    """
+    :return: list of (scenario, phase, baseline ms, current ms) for phases that got slower than allowed
+    """
+    regressions = []
+    for scenario, phases in sorted(results.items()):
+        for phase, value in sorted(phases.items()):
+            base = baseline.get(scenario, {}).get(phase)
+            if base is not None and value > base * (1 + max_regression / 100.0) + slack:
+                regressions.append((scenario, phase, base, value))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark kc-compat.py and kernelchecker.py on a fake host')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every scenario (default: %(default)s)')
+    parser.add_argument('--kernels', type=int, default=50,
+                        help='kernel packages installed and available (default: %(default)s)')
+    parser.add_argument('--packages', type=int, default=2000,
+                        help='other packages in databases and metadata (default: %(default)s)')
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='seconds every fake package manager takes (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds patches server stub takes to answer (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of patches server requests failing with 500 (default: %(default)s)')
+    parser.add_argument('--hosts', type=int, default=2000,
+                        help='kernel hashes checked in batch mode (default: %(default)s)')
+    parser.add_argument('--distinct', type=int, default=200,
+                        help='distinct kernel hashes among them (default: %(default)s)')
+    parser.add_argument('--only', metavar='PREFIX', help='run only scenarios starting with PREFIX')
+    parser.add_argument('--save', metavar='FILE', help='save median timings as baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare median timings with saved baseline')
+    parser.add_argument('--max-regression', type=float, default=20, metavar='PERCENT',
+                        help='fail if a phase is slower than baseline by more than PERCENT (default: %(default)s)')
+    parser.add_argument('--slack', type=float, default=5, metavar='MS',
+                        help='ignore regressions smaller than MS milliseconds (default: %(default)s)')
+    parser.add_argument('--startup-budget', type=float, default=20, metavar='MS',
+                        help='fail if kc-compat.py startup takes more than MS milliseconds '
+                             'on top of interpreter startup (default: %(default)s)')
+    parser.add_argument('--records', type=int, default=100000,
+                        help='packages or versions every parser phase handles (default: %(default)s)')
+    parser.add_argument('--driver', metavar='CONFIG', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.driver:
+        run_driver(args.driver)
+        return 0
+
+    random.seed(0)
+    host = FakeHost(args.kernels, args.packages, args.delay)
+    server = PatchServerStub(args.latency, args.error_rate)
+    server.start()
+    try:
+        samples = {}
+        for name, config in scenarios(host, server, args.hosts, args.distinct):
+            if args.only and not name.startswith(args.only):
+                continue
+            for _ in range(args.repeat):
+                for phase, value in run_scenario(host, config).items():
+                    samples.setdefault(name, {}).setdefault(phase, []).append(value)
+        if not args.only or 'kc-compat-startup'.startswith(args.only):
+            for _ in range(args.repeat):
+                for phase, value in measure_startup().items():
+                    samples.setdefault('kc-compat-startup', {}).setdefault(phase, []).append(value)
+        if not args.only or 'kernelchecker-parsers'.startswith(args.only):
+            spec = importlib.util.spec_from_file_location('bench_kernelchecker', KERNELCHECKER)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            for _ in range(args.repeat):
+                seconds, counts = measure_parsers(module, args.records)
+                for phase, value in seconds.items():
+                    samples.setdefault('kernelchecker-parsers', {}).setdefault(phase, []).append(value)
+    finally:
+        server.shutdown()
+        host.remove()
+
+    results = {}
+    print('%-24s %-46s %10s %10s' % ('scenario', 'phase', 'median ms', 'max ms'))
+    for name, phases in sorted(samples.items()):
+        results[name] = {}
+        for phase, values in sorted(phases.items(), key=lambda item: (item[0] == 'total', item[0])):
+            results[name][phase] = median(values) * 1000
+            print('%-24s %-46s %10.1f %10.1f' % (name, phase, median(values) * 1000, max(values) * 1000))
+    print('patches server requests: %d' % server.requests)
+    for phase, values in sorted(samples.get('kernelchecker-parsers', {}).items()):
+        print('%-24s %-46s %10.0f records/s' % ('kernelchecker-parsers', phase, counts[phase] / median(values)))
+
+    rc = 0
+    startup = results.get('kc-compat-startup', {}).get('startup')
+    if startup is not None and startup > args.startup_budget:
+        print('OVER BUDGET; kc-compat-startup: %.1f ms > %.1f ms' % (startup, args.startup_budget))
+        rc = 1
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression, args.slack)
+        for scenario, phase, base, value in regressions:
+            print('REGRESSION; %s %s: %.1f ms -> %.1f ms' % (scenario, phase, base, value))
+        if regressions:
+            rc = 1
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
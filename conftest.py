@@ -0,0 +1,25 @@
+import pytest
+from unittest.mock import patch
+
+import kernelchecker
+
+KernelChecker = kernelchecker.KernelChecker
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    with patch.object(kernelchecker, 'default_cache_dir', return_value=str(tmp_path / 'cache')):
+        yield tmp_path / 'cache'
+
+
+@pytest.fixture
+def rpm_host(tmp_path):
+    installed = kernelchecker.PackageQuery(['printf', '3.10.0-1160.el7\\n'], kernelchecker.RpmHandler.parse_rpm_output)
+    with patch.object(kernelchecker.HostFacts, 'kernel_release', '3.10.0-1160.el7.x86_64'), \
+            patch.object(kernelchecker.HostFacts, 'kernel_hash', 'a' * 40), \
+            patch.object(kernelchecker.HostFacts, 'container', None), \
+            patch.object(KernelChecker, 'get_distro_type', return_value='rpm'), \
+            patch.object(kernelchecker, 'KCARE_BIN', str(tmp_path / 'kcarectl')), \
+            patch.object(kernelchecker.RpmHandler, 'query_installed', return_value=installed), \
+            patch.object(kernelchecker.RpmHandler, 'query_available', return_value=['3.10.0-1160.2']):
+        yield tmp_path
@@ -1,13 +1,12 @@
 from __future__ import print_function
-import struct
 import sys
 import os
+import itertools
+import time
 
-try:
-    from urllib.request import urlopen
-    from urllib.error import HTTPError, URLError
-except ImportError:
-    from urllib2 import urlopen, HTTPError, URLError
+# Everything else is imported where it is used: the script usually runs once per host through
+# curl | python, and the HTTP stack alone costs more than the whole check when the answer is
+# known without it (container, cache, index)
 
 __author__ = 'Igor Seletskiy'
 __copyright__ = "Copyright (c) Cloud Linux GmbH & Cloud Linux Software, Inc"
@@ -33,18 +32,645 @@ SUPPORTED_DISTROS = {
     "proxmox",
 }
 
+PATCH_SERVER = 'patches.kernelcare.com'
+BATCH_WORKERS = 16
 
-def get_kernel_hash():
+# patches server probe: worst case is PROBE_RETRIES + 1 attempts of connect and read timeouts,
+# with exponential backoff between them, ~25 seconds with the defaults
+PROBE_CONNECT_TIMEOUT = 3
+PROBE_TIMEOUT = 5
+PROBE_RETRIES = 2
+PROBE_BACKOFF = 0.5
+
+CACHE_FILE = 'compat.json'
+# compatible kernels stay compatible, unknown ones may get support later
+CACHE_TTL = 24 * 60 * 60
+CACHE_NEGATIVE_TTL = 60 * 60
+# expired compatible answers are kept for their ETag / Last-Modified, to be revalidated
+# with a conditional request the server answers with a bodyless 304
+CACHE_VALIDATORS_TTL = 30 * 24 * 60 * 60
+# (cache entry key, response header, conditional request header)
+VALIDATOR_HEADERS = (
+    ('etag', 'ETag', 'If-None-Match'),
+    ('last_modified', 'Last-Modified', 'If-Modified-Since'),
+)
+# host-stable seed of --splay delay, hostname if there is none
+MACHINE_ID_FILES = ('/etc/machine-id', '/var/lib/dbus/machine-id')
+
+# /proc/1/cgroup paths of init inside containers, cgroup v1 or host cgroup namespace
+CGROUP_CONTAINERS = (
+    ('/lxc/', 'lxc'),
+    ('/lxc.payload', 'lxc'),
+    ('/docker', 'docker'),
+    ('/libpod', 'podman'),
+    ('/machine.slice/', 'systemd-nspawn'),
+)
+
+INDEX_MAGIC = b'KCIDX\x00\x00\x01'
+INDEX_HEADER_SIZE = 16
+INDEX_DIGEST_SIZE = 20
+
+
+def _cpu_time():
     try:
-        # noinspection PyCompatibility
-        from hashlib import sha1
+        return time.process_time()
+    except AttributeError:
+        return time.clock()
+
+
+class Timings(object):
+    """
+    Wall and cpu time of kc-compat phases
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    def span(self, name):
+        return _Span(self.spans, name)
+
+    def report(self):
+        return 'TIMINGS; ' + ', '.join('%s %.1fms wall %.1fms cpu' % (name, wall * 1000, cpu * 1000)
+                                       for name, wall, cpu in self.spans)
+
+
+class _Span(object):
+    """
+    Context manager timing one phase, contextlib is not worth importing for it
+    """
+
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+
+    def __enter__(self):
+        self.wall, self.cpu = time.time(), _cpu_time()
+
+    def __exit__(self, *exc_info):
+        self.spans.append((self.name, time.time() - self.wall, _cpu_time() - self.cpu))
+
+
+timings = Timings()
+
+
+def url_errors():
+    """
+    :return: HTTPError and URLError classes
+    """
+    try:
+        from urllib.error import HTTPError, URLError
     except ImportError:
-        from sha import sha as sha1
-    f = open('/proc/version', 'rb')
+        from urllib2 import HTTPError, URLError
+    return HTTPError, URLError
+
+
+def server_url(server):
+    """
+    :param server: host[:port], optionally prefixed with http:// or https://
+    """
+    if '://' in server:
+        return server.rstrip('/')
+    return 'http://' + server
+
+
+def http_connection(server, timeout):
+    """
+    :param server: host[:port], optionally prefixed with http:// or https://
+    """
+    try:
+        from http.client import HTTPConnection, HTTPSConnection
+    except ImportError:
+        from httplib import HTTPConnection, HTTPSConnection
+    scheme, _, host = server_url(server).partition('://')
+    if scheme == 'https':
+        return HTTPSConnection(host, timeout=timeout)
+    return HTTPConnection(host, timeout=timeout)
+
+
+def conditional_headers(validators):
+    """
+    :param validators: ETag / Last-Modified dict of an earlier answer, or None
+    :return: headers asking server to answer 304 Not Modified if nothing changed since, or None
+    """
+    headers = {}
+    for key, _, header in VALIDATOR_HEADERS:
+        if validators and validators.get(key):
+            headers[header] = validators[key]
+    return headers or None
+
+
+def response_validators(response):
+    """
+    :param response: http response
+    :return: ETag / Last-Modified dict of the response, or None if it has neither
+    """
+    validators = {}
+    for key, header, _ in VALIDATOR_HEADERS:
+        value = response.getheader(header)
+        if value:
+            validators[key] = value
+    return validators or None
+
+
+def splay_delay(splay):
+    """
+    Random, but host-stable delay: it is derived from machine id, so a host waits the same on every run,
+    while hosts started by cron at the same minute spread evenly over splay seconds
+    :return: seconds in [0, splay)
+    """
+    if not splay or splay <= 0:
+        return 0
+    seed = None
+    for path in MACHINE_ID_FILES:
+        try:
+            with open(path) as f:
+                seed = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if seed:
+            break
+    if not seed:
+        import socket
+        seed = socket.gethostname()
+    from hashlib import sha1
+    digest = sha1(('splay:' + seed).encode('utf-8')).hexdigest()
+    return splay * int(digest[:8], 16) / float(1 << 32)
+
+
+class ProbeClient(object):
+    """
+    Asks patches servers if they know a kernel hash with HEAD requests, so no body is downloaded.
+    Failed attempts are retried with exponential backoff and jitter. With several servers (mirrors)
+    they are asked concurrently, and the first definitive answer wins.
+    ETag / Last-Modified of compatible answers are remembered, to make the next checks conditional
+    """
+
+    def __init__(self, servers=None, connect_timeout=PROBE_CONNECT_TIMEOUT, timeout=PROBE_TIMEOUT,
+                 retries=PROBE_RETRIES, backoff=PROBE_BACKOFF, splay=0, keep_alive=False):
+        """
+        :param servers: list of host[:port] or http(s) urls, PATCH_SERVER by default
+        :param timeout: seconds to wait for a response once connected
+        :param retries: attempts to make after the first one failed, per server
+        :param backoff: seconds to wait before the first retry, doubled for every next one
+        :param splay: wait up to splay seconds before the first request, see splay_delay
+        :param keep_alive: keep connections open and reuse them for the next requests, for many checks
+        """
+        self.servers = servers or [PATCH_SERVER]
+        self.connect_timeout = min(connect_timeout, timeout)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.splay = splay
+        self.keep_alive = keep_alive
+        # request path -> ETag / Last-Modified dict of the last compatible answer
+        self.validators = {}
+        # server -> idle keep-alive connections
+        self.idle = {}
+
+    def answer_validators(self, kernel_hash):
+        """
+        :return: ETag / Last-Modified dict of the last compatible answer for kernel_hash, or None
+        """
+        return self.validators.get('/' + kernel_hash + '/version')
+
+    def check(self, kernel_hash, validators=None):
+        """
+        :param validators: ETag / Last-Modified dict of an earlier compatible answer, see CompatCache.validators
+        :return: True if kernel is known to patches server, False if it is not
+        :raises HTTPError, URLError: no server gave a definitive answer
+        """
+        if self.splay:
+            # only before the first request of the client
+            delay, self.splay = splay_delay(self.splay), 0
+            time.sleep(delay)
+        path = '/' + kernel_hash + '/version'
+        headers = conditional_headers(validators)
+        if len(self.servers) == 1:
+            return self.check_server(self.servers[0], path, headers)
+
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        results = queue.Queue()
+
+        def race(server):
+            try:
+                results.put(self.check_server(server, path, headers))
+            except Exception as e:
+                results.put(e)
+
+        for server in self.servers:
+            t = threading.Thread(target=race, args=(server,))
+            # losers are left behind, their answers don't matter anymore
+            t.daemon = True
+            t.start()
+        error = None
+        for _ in self.servers:
+            result = results.get()
+            if isinstance(result, bool):
+                return result
+            error = result
+        raise error
+
+    def check_server(self, server, path, headers=None):
+        """
+        :return: True if path is found on server, False if it is not
+        :raises HTTPError, URLError: of the last attempt
+        """
+        HTTPError, URLError = url_errors()
+        try:
+            from http.client import HTTPException
+        except ImportError:
+            from httplib import HTTPException
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                import random
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                status, reason = self.request(server, path, headers)
+            except (HTTPException, IOError, OSError) as e:
+                error = URLError(e)
+                continue
+            # 304: not modified since the compatible answer headers came from
+            if status in (200, 206, 304):
+                return True
+            if status == 404:
+                return False
+            error = HTTPError(server_url(server) + path, status, reason, None, None)
+            # server errors and throttling may be transient, anything else won't change on retry
+            if status != 429 and status < 500:
+                break
+        raise error
+
+    def request(self, server, path, headers=None):
+        """
+        HEAD request, falls back to GET of a single byte if server doesn't allow HEAD.
+        Validators of a successful response are stored in self.validators
+        :param headers: conditional request headers, see conditional_headers
+        :return: response status and reason
+        """
+        idle = self.idle.setdefault(server, [])
+        try:
+            conn = idle.pop()
+        except IndexError:
+            conn = None
+        if conn is not None:
+            try:
+                from http.client import HTTPException
+            except ImportError:
+                from httplib import HTTPException
+            try:
+                return self.exchange(server, conn, path, headers)
+            except (HTTPException, IOError, OSError):
+                # server may have closed the idle connection, that is not a failed attempt yet
+                pass
+        conn = http_connection(server, self.connect_timeout)
+        try:
+            conn.connect()
+            conn.sock.settimeout(self.timeout)
+        except Exception:
+            conn.close()
+            raise
+        return self.exchange(server, conn, path, headers)
+
+    def exchange(self, server, conn, path, headers):
+        """
+        Send request over connected conn, which is kept for the next requests with keep_alive, closed otherwise
+        :return: response status and reason
+        """
+        try:
+            conn.request('HEAD', path, headers=headers or {})
+            response = conn.getresponse()
+            # body has to be drained before the connection can be reused
+            response.read()
+            if response.status in (405, 501):
+                conn.request('GET', path, headers=dict(headers or {}, Range='bytes=0-0'))
+                response = conn.getresponse()
+                response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.status in (200, 206):
+            self.validators[path] = response_validators(response)
+        if self.keep_alive and not response.will_close:
+            self.idle[server].append(conn)
+        else:
+            conn.close()
+        return response.status, response.reason
+
+
+def in_root(root, path):
+    """
+    :param root: mount point of system image or chroot, None for the live host
+    :return: absolute path resolved inside root
+    """
+    if not root:
+        return path
+    return os.path.join(root, path.lstrip('/'))
+
+
+# kernel images, named by their releases
+BOOT_IMAGES = '/boot/vmlinuz-*'
+# linux_banner, the same string as /proc/version of the booted kernel
+BANNER_PATTERN = br'Linux version \d[\x20-\x7e]{8,1024}\n'
+BANNER_MAX = 1100
+# compressed bytes decompressed at a time while looking for the banner
+BANNER_CHUNK = 256 * 1024
+# payloads of each compression tried, magics of the others are usually false positives
+BANNER_CANDIDATES = 8
+
+
+def _zstd_decompressor():
     try:
-        return sha1(f.read()).hexdigest()
+        from compression import zstd
+        return zstd.ZstdDecompressor()
+    except ImportError:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _payload_decompressors():
+    """
+    :return: list of (magic, function returning new decompressor object), for available modules only
+    """
+    import zlib
+    result = [(b'\x1f\x8b\x08', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))]
+    try:
+        import lzma
+        result.append((b'\xfd7zXZ\x00', lzma.LZMADecompressor))
+    except ImportError:
+        pass
+    try:
+        import bz2
+        result.append((b'BZh', bz2.BZ2Decompressor))
+    except ImportError:
+        pass
+    try:
+        _zstd_decompressor()
+        result.append((b'\x28\xb5\x2f\xfd', _zstd_decompressor))
+    except ImportError:
+        pass
+    return result
+
+
+def _scan_payload(data, offset, decompressor, banner_re):
+    """
+    Decompress payload chunk by chunk, stopping as soon as the banner is found
+    :return: banner or None
+    """
+    tail = b''
+    while offset < len(data):
+        chunk = decompressor.decompress(data[offset:offset + BANNER_CHUNK])
+        offset += BANNER_CHUNK
+        if not chunk:
+            if getattr(decompressor, 'eof', False):
+                return None
+            continue
+        buf = tail + chunk
+        match = banner_re.search(buf)
+        if match:
+            return match.group(0)
+        tail = buf[-BANNER_MAX:]
+    return None
+
+
+def read_kernel_banner(path):
+    """
+    Find kernel banner, the same string as /proc/version of the kernel booted from the image.
+    The image is memory mapped and scanned as is, then its compressed payloads are decompressed until the banner
+    :param path: kernel image, e.g. /boot/vmlinuz-5.14.0-70.el9.x86_64
+    :return: banner bytes
+    """
+    import mmap
+    import re
+    banner_re = re.compile(BANNER_PATTERN)
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise IOError('no kernel banner found in %s' % path)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        match = banner_re.search(data)
+        if match:
+            return match.group(0)
+        candidates = []
+        for magic, decompressor in _payload_decompressors():
+            offset = data.find(magic)
+            for _ in range(BANNER_CANDIDATES):
+                if offset < 0:
+                    break
+                candidates.append((offset, decompressor))
+                offset = data.find(magic, offset + 1)
+        for offset, decompressor in sorted(candidates, key=lambda candidate: candidate[0]):
+            try:
+                banner = _scan_payload(data, offset, decompressor(), banner_re)
+            except Exception:
+                # not a real payload, or corrupted one
+                continue
+            if banner:
+                return banner
     finally:
-        f.close()
+        data.close()
+    raise IOError('no kernel banner found in %s' % path)
+
+
+def release_key(release):
+    """
+    Natural sort key of kernel release, numbers compare as numbers: 5.14.0-70 is older than 5.14.0-162
+    """
+    key = []
+    for digits, chars in itertools.groupby(release, lambda char: char.isdigit()):
+        part = ''.join(chars)
+        key.append((1, int(part)) if digits else (0, part))
+    return key
+
+
+class HostFacts(object):
+    """
+    Snapshot of kernel, distribution and container facts of the host or of a system image.
+    Every file is read at most once, on first use, so all answers come from the same reads
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: mount point of system image or chroot, None for the live host
+        """
+        self.root = root
+        self._facts = {}
+
+    def _memoized(self, name, compute):
+        try:
+            return self._facts[name]
+        except KeyError:
+            value = self._facts[name] = compute()
+            return value
+
+    def exists(self, path):
+        return self._memoized('exists:' + path, lambda: os.path.exists(in_root(self.root, path)))
+
+    def read(self, path, mode='r'):
+        """
+        :return: file contents, empty if it can't be read
+        """
+        def read():
+            try:
+                with open(in_root(self.root, path), mode) as f:
+                    return f.read()
+            except (IOError, OSError):
+                return b'' if 'b' in mode else ''
+        return self._memoized('read:%s:%s' % (mode, path), read)
+
+    @property
+    def proc_version(self):
+        """
+        /proc/version, or the banner of boot_image if a system image has none, e.g. unpacked one
+        :raises IOError: neither can be read
+        """
+        def read():
+            try:
+                with open(in_root(self.root, '/proc/version'), 'rb') as f:
+                    return f.read()
+            except (IOError, OSError):
+                image = self.root and self.boot_image
+                if not image:
+                    raise
+            return read_kernel_banner(image)
+        return self._memoized('proc_version', read)
+
+    @property
+    def boot_image(self):
+        """
+        :return: kernel image of the newest kernel, the one system image boots by default, or None
+        """
+        def find():
+            import glob
+            images = {}
+            for pattern in ('/usr/lib/modules/*/vmlinuz', '/lib/modules/*/vmlinuz'):
+                for path in glob.glob(in_root(self.root, pattern)):
+                    images[os.path.basename(os.path.dirname(path))] = path
+            for path in glob.glob(in_root(self.root, BOOT_IMAGES)):
+                images[os.path.basename(path)[len('vmlinuz-'):]] = path
+            if not images:
+                return None
+            return images[max(images, key=release_key)]
+        return self._memoized('boot_image', find)
+
+    @property
+    def kernel_hash(self):
+        try:
+            # noinspection PyCompatibility
+            from hashlib import sha1
+        except ImportError:
+            from sha import sha as sha1
+        return self._memoized('kernel_hash', lambda: sha1(self.proc_version).hexdigest())
+
+    @property
+    def kernel_release(self):
+        """
+        :return: release of the running kernel, of the one system image boots, or None
+        """
+        def release():
+            try:
+                words = self.proc_version.split()
+            except (IOError, OSError):
+                words = []
+            if len(words) > 2 and words[:2] == [b'Linux', b'version']:
+                return words[2].decode('utf-8', 'replace')
+            if not self.root:
+                return os.uname()[2]
+            return None
+        return self._memoized('kernel_release', release)
+
+    @property
+    def os_release(self):
+        """
+        :return: dict of /etc/os-release variables
+        """
+        def parse():
+            for path in ('/etc/os-release', '/usr/lib/os-release'):
+                if self.exists(path):
+                    break
+            else:
+                return {}
+            result = {}
+            for line in self.read(path).splitlines():
+                name, sep, value = line.strip().partition('=')
+                if sep and not name.startswith('#'):
+                    result[name] = value.strip().strip('"\'')
+            return result
+        return self._memoized('os_release', parse)
+
+    @property
+    def distro_id(self):
+        return self.os_release.get('ID')
+
+    @property
+    def distro_version(self):
+        return self.os_release.get('VERSION_ID')
+
+    @property
+    def distro_like(self):
+        return self.os_release.get('ID_LIKE', '').split()
+
+    @property
+    def init_cgroup(self):
+        return self.read('/proc/1/cgroup')
+
+    @property
+    def cgroup_version(self):
+        return 2 if self.exists('/sys/fs/cgroup/cgroup.controllers') else 1
+
+    @property
+    def inside_openvz(self):
+        return self.exists('/proc/vz/veinfo') and not self.exists('/proc/vz/version')
+
+    @property
+    def container(self):
+        """
+        :return: container type (openvz, lxc, docker, podman, systemd-nspawn, ...), None if not inside a container
+        """
+        def detect():
+            if self.inside_openvz:
+                return 'openvz'
+            # set by container managers, the only reliable way with cgroup v2 namespaces
+            marker = self.read('/run/systemd/container').strip()
+            if not marker:
+                for variable in self.read('/proc/1/environ', 'rb').split(b'\0'):
+                    if variable.startswith(b'container='):
+                        marker = variable[10:].decode('utf-8', 'replace')
+            if marker:
+                return marker
+            if self.exists('/run/.containerenv'):
+                return 'podman'
+            if self.exists('/.dockerenv'):
+                return 'docker'
+            cgroup = self.init_cgroup
+            for pattern, name in CGROUP_CONTAINERS:
+                if pattern in cgroup:
+                    return name
+            return None
+        return self._memoized('container', detect)
+
+
+def get_kernel_hash(facts=None):
+    return (facts or HostFacts()).kernel_hash
+
+
+def hash_kernel_version(version):
+    """
+    Compute kernel hash for a /proc/version line the same way get_kernel_hash() does
+    :param version: /proc/version contents, with or without trailing newline
+    :return: SHA1 hex digest
+    """
+    try:
+        from hashlib import sha1
+    except ImportError:
+        from sha import sha as sha1
+    if not isinstance(version, bytes):
+        version = version.encode('utf-8')
+    return sha1(version.rstrip(b'\r\n') + b'\n').hexdigest()
 
 
 def inside_vz_container():
@@ -52,34 +678,26 @@ def inside_vz_container():
     determines if we are inside Virtuozzo container
     :return: True if inside container, false otherwise
     """
-    return os.path.exists('/proc/vz/veinfo') and not os.path.exists('/proc/vz/version')
+    return HostFacts().inside_openvz
 
 
 def inside_lxc_container():
-    return '/lxc/' in open('/proc/1/cgroup').read()
+    return '/lxc/' in HostFacts().init_cgroup
+
+
+def detect_container(facts):
+    """
+    :return: container type, None if not inside a container
+    """
+    return facts.container
 
 
-def get_distro_info():
+def get_distro_info(facts=None):
     """
     Get current distribution name and version
     :return: distro name or None if detection fails
     """
-    
-    def parse_value(line):
-        return line.split('=', 1)[1].strip().strip('"\'')
-    
-    os_release_path = '/etc/os-release'
-    if not os.path.exists(os_release_path):
-        return None
-
-    try:
-        with open(os_release_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('ID='):
-                    return parse_value(line)
-    except (IOError, OSError):
-        return None
+    return (facts or HostFacts()).distro_id
 
 
 def is_distro_supported(distro_name):
@@ -89,43 +707,577 @@ def is_distro_supported(distro_name):
     return distro_name in SUPPORTED_DISTROS
 
 
-def is_compat():
-    url = 'http://patches.kernelcare.com/' + get_kernel_hash() + '/version'
+def is_compat(cache=None, index=None, client=None, facts=None):
+    """
+    Check if running kernel is supported by KernelCare
+    :param cache: CompatCache to look up and store the answer, None to always ask patches server
+    :param index: CompatIndex to look the kernel up in instead of asking patches server
+    :param client: ProbeClient to ask patches server with, default one if None
+    :param facts: HostFacts of the host or system image to check, the live host if None
+    :return: True if supported, False if kernel is unknown to patches server
+    """
+    with timings.span('hash'):
+        kernel_hash = get_kernel_hash(facts)
+    if index is not None:
+        with timings.span('index'):
+            return kernel_hash in index
+    validators = None
+    if cache is not None:
+        with timings.span('cache'):
+            result = cache.get(kernel_hash)
+            validators = cache.validators(kernel_hash)
+        if result is not None:
+            return result
+    client = client or ProbeClient()
+    with timings.span('request'):
+        result = client.check(kernel_hash, validators)
+    if cache is not None:
+        # 304 answers have no validators of their own, the old ones stay valid
+        cache.put(kernel_hash, result, result and (client.answer_validators(kernel_hash) or validators) or None)
+        cache.save()
+    return result
+
+
+def read_batch_hashes(stream):
+    """
+    Read kernel hashes from stream, one per line.
+    Each line is either a SHA1 kernel hash or a /proc/version string, empty lines are skipped
+    :return: generator of kernel hashes
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if len(line) == 40 and all(c in '0123456789abcdef' for c in line.lower()):
+            yield line.lower()
+        elif line.startswith('Linux version'):
+            yield hash_kernel_version(line)
+        else:
+            sys.stderr.write('SKIPPED; not a kernel hash or /proc/version: %s\n' % line)
+
+
+def _batch_worker(tasks, results, client, validators):
+    """
+    Resolve kernel hashes from tasks queue
+    :param validators: dict of kernel hash -> ETag / Last-Modified dict, updated with those of compatible answers
+    """
+    HTTPError, URLError = url_errors()
+    while True:
+        kernel_hash = tasks.get()
+        if kernel_hash is None:
+            break
+        try:
+            result = client.check(kernel_hash, validators.get(kernel_hash))
+        except Exception as e:
+            result = e if isinstance(e, (HTTPError, URLError)) else URLError(e)
+        else:
+            if result:
+                # 304 answers have no validators of their own, the old ones stay valid
+                validators[kernel_hash] = client.answer_validators(kernel_hash) or validators.get(kernel_hash)
+        results.put((kernel_hash, result))
+
+
+def check_batch(hashes, workers=BATCH_WORKERS, client=None, validators=None):
+    """
+    Check compatibility of many kernel hashes concurrently.
+    Identical hashes are checked only once, results are yielded as soon as they are ready
+    :param hashes: iterable of kernel hashes
+    :param client: ProbeClient to ask patches servers with, one keeping connections alive by default
+    :param validators: dict of kernel hash -> ETag / Last-Modified dict of earlier compatible answers to send
+        conditional requests with, updated with those of new answers
+    :return: generator of (kernel hash, True/False or exception) tuples
+    """
+    if client is None:
+        client = ProbeClient(keep_alive=True)
+    if validators is None:
+        validators = {}
+    unique = []
+    seen = set()
+    for kernel_hash in hashes:
+        if kernel_hash not in seen:
+            seen.add(kernel_hash)
+            unique.append(kernel_hash)
+    if not unique:
+        return
+
+    import threading
     try:
-        urlopen(url)
-        return True
-    except HTTPError as e:
-        if e.code == 404:
-            return False
+        import queue
+    except ImportError:
+        import Queue as queue
+    tasks = queue.Queue()
+    results = queue.Queue()
+    for kernel_hash in unique:
+        tasks.put(kernel_hash)
+    threads = []
+    for _ in range(max(1, min(workers, len(unique)))):
+        tasks.put(None)
+        t = threading.Thread(target=_batch_worker, args=(tasks, results, client, validators))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for _ in unique:
+        yield results.get()
+    for t in threads:
+        t.join()
+    for connections in client.idle.values():
+        while connections:
+            connections.pop().close()
+
+
+def read_batch_source(source):
+    """
+    :param source: file name, "-" for stdin
+    :return: list of kernel hashes
+    """
+    if source == '-':
+        return list(read_batch_hashes(sys.stdin))
+    with open(source) as stream:
+        return list(read_batch_hashes(stream))
+
+
+def batch_main(source, workers, silent, cache=None, index=None, client=None):
+    """
+    Check kernels listed in source and print one line per distinct kernel hash
+    :param client: ProbeClient to ask patches servers with, see check_batch
+    :return: highest exit code among all checked kernels
+    """
+    HTTPError = url_errors()[0]
+    hashes = read_batch_source(source)
+
+    cached = {}
+    if index is not None:
+        cache = None
+        for kernel_hash in hashes:
+            cached[kernel_hash] = kernel_hash in index
+        hashes = []
+    validators = {}
+    if cache is not None:
+        unknown = []
+        for kernel_hash in hashes:
+            result = cache.get(kernel_hash)
+            if result is None:
+                unknown.append(kernel_hash)
+                validators[kernel_hash] = cache.validators(kernel_hash)
+            else:
+                cached[kernel_hash] = result
+        hashes = unknown
+
+    rc = 0
+    checked = check_batch(hashes, workers=workers, client=client, validators=validators)
+    for kernel_hash, result in itertools.chain(cached.items(), checked):
+        if cache is not None and isinstance(result, bool) and kernel_hash not in cached:
+            cache.put(kernel_hash, result, result and validators.get(kernel_hash) or None)
+        if result is True:
+            code, message = 0, "COMPATIBLE"
+        elif result is False:
+            code, message = 1, "NEEDS REVIEW"
+        elif isinstance(result, HTTPError):
+            code, message = 3, "CONNECTION ERROR; HTTP %d" % result.code
         else:
-            raise
-    except URLError:
+            code, message = 3, "CONNECTION ERROR; %s" % str(result.reason)
+        myprint(silent, "%s %s" % (kernel_hash, message))
+        if not silent:
+            sys.stdout.flush()
+        rc = max(rc, code)
+    if cache is not None:
+        cache.save()
+    return rc
+
+
+def write_atomic(path, data, mode=None):
+    """
+    Replace file contents via rename, so concurrent readers never see it half-written.
+    Missing parent directories are created
+    :param data: str, or bytes
+    :param mode: permissions of the file, readable by owner only by default
+    """
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
         raise
 
 
+class CompatIndex(object):
+    """
+    Offline compatibility index: sorted SHA1 digests of supported kernels after a 16 bytes header
+    (INDEX_MAGIC and number of digests). The file is memory mapped and binary searched
+    """
+
+    def __init__(self, path):
+        import mmap
+        import struct
+        with open(path, 'rb') as f:
+            header = f.read(INDEX_HEADER_SIZE)
+            if len(header) != INDEX_HEADER_SIZE or header[:8] != INDEX_MAGIC:
+                raise ValueError('%s is not a compatibility index' % path)
+            self.count = struct.unpack('>Q', header[8:])[0]
+            if os.fstat(f.fileno()).st_size != INDEX_HEADER_SIZE + self.count * INDEX_DIGEST_SIZE:
+                raise ValueError('%s is truncated' % path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def digest(self, i):
+        offset = INDEX_HEADER_SIZE + i * INDEX_DIGEST_SIZE
+        return self.map[offset:offset + INDEX_DIGEST_SIZE]
+
+    def __contains__(self, kernel_hash):
+        import binascii
+        try:
+            digest = binascii.unhexlify(kernel_hash)
+        except (TypeError, ValueError):
+            return False
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.count and self.digest(lo) == digest
+
+    def digests(self):
+        for i in range(self.count):
+            yield self.digest(i)
+
+    def close(self):
+        self.map.close()
+
+
+def build_index(path, hashes, update=False):
+    """
+    Write compatibility index of kernel hashes
+    :param update: add hashes to existing index instead of replacing it
+    :return: number of kernel hashes in the index
+    """
+    import binascii
+    import struct
+    digests = set(binascii.unhexlify(kernel_hash) for kernel_hash in hashes)
+    if update and os.path.exists(path):
+        index = CompatIndex(path)
+        try:
+            digests.update(index.digests())
+        finally:
+            index.close()
+    digests = sorted(digests)
+    write_atomic(path, INDEX_MAGIC + struct.pack('>Q', len(digests)) + b''.join(digests))
+    return len(digests)
+
+
+def default_cache_dir():
+    """
+    :return: system cache directory for root, user cache directory otherwise
+    """
+    if os.geteuid() == 0:
+        return '/var/cache/kcare-scripts'
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'kcare-scripts')
+
+
+class CompatCache(object):
+    """
+    On-disk cache of compatibility answers keyed by kernel hash.
+    Compatible and not found answers expire after ttl and negative_ttl seconds respectively.
+    The cache is best effort: it is ignored if it can't be read or written.
+    Answers can be put and saved from several threads, e.g. kernelchecker.py checking kernel images in /boot
+    """
+
+    def __init__(self, path=None, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, refresh=False,
+                 validators_ttl=CACHE_VALIDATORS_TTL):
+        """
+        :param refresh: don't use cached answers, only store new ones
+        :param validators_ttl: seconds to keep expired answers having ETag / Last-Modified for
+        """
+        import threading
+        self.path = path or os.path.join(default_cache_dir(), CACHE_FILE)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.validators_ttl = validators_ttl
+        self.refresh = refresh
+        self.entries = {}
+        self.updated = {}
+        self.lock = threading.Lock()
+        if not refresh:
+            self.entries = self._load()
+
+    def _load(self):
+        import json
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _fresh(self, entry, now):
+        try:
+            ttl = self.ttl if entry['compatible'] else self.negative_ttl
+            return 0 <= now - entry['checked'] < ttl
+        except (KeyError, TypeError):
+            return False
+
+    def _keep(self, entry, now):
+        if self._fresh(entry, now):
+            return True
+        try:
+            return bool(entry.get('validators')) and 0 <= now - entry['checked'] < self.validators_ttl
+        except (AttributeError, KeyError, TypeError):
+            return False
+
+    def get(self, kernel_hash):
+        """
+        :return: True/False cached answer or None if there is no fresh one
+        """
+        entry = self.updated.get(kernel_hash) or self.entries.get(kernel_hash)
+        if entry is None or not self._fresh(entry, time.time()):
+            return None
+        return entry['compatible']
+
+    def validators(self, kernel_hash):
+        """
+        :return: ETag / Last-Modified dict of the last compatible answer, even an expired one, or None
+        """
+        entry = self.updated.get(kernel_hash) or self.entries.get(kernel_hash)
+        if isinstance(entry, dict) and isinstance(entry.get('validators'), dict):
+            return entry['validators']
+        return None
+
+    def put(self, kernel_hash, compatible, validators=None):
+        """
+        :param validators: ETag / Last-Modified dict of the answer, see ProbeClient.answer_validators
+        """
+        entry = {'compatible': compatible, 'checked': time.time()}
+        if validators:
+            entry['validators'] = validators
+        with self.lock:
+            self.updated[kernel_hash] = entry
+
+    def save(self):
+        """
+        Merge new answers into the cache file, dropping expired entries unless they can be revalidated.
+        File is replaced atomically, so concurrent runs never see it half-written
+        """
+        import json
+        with self.lock:
+            if not self.updated:
+                return
+            now = time.time()
+            entries = self._load()
+            entries.update(self.updated)
+            entries = dict((k, v) for k, v in entries.items() if self._keep(v, now))
+            try:
+                write_atomic(self.path, json.dumps(entries))
+            except (IOError, OSError):
+                return
+            self.entries = entries
+            self.updated = {}
+
+
 def myprint(silent, message):
     if not silent:
         print(message)
 
 
+# the usual curl | python invocations are parsed without importing argparse
+FAST_ARGS = {'-q': 'silent', '--silent': 'silent', '--one-shot': 'one_shot'}
+ARG_DEFAULTS = {
+    'silent': False,
+    'one_shot': False,
+    'batch': None,
+    'workers': BATCH_WORKERS,
+    'no_cache': False,
+    'refresh': False,
+    'cache_file': None,
+    'index': None,
+    'build_index': None,
+    'update_index': None,
+    'root': None,
+    'server': None,
+    'timeout': PROBE_TIMEOUT,
+    'retries': PROBE_RETRIES,
+    'splay': 0,
+    'timings': False,
+    'profile': None,
+}
+
+
+class Args(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def parse_args(argv):
+    if all(arg in FAST_ARGS for arg in argv):
+        args = Args(**ARG_DEFAULTS)
+        for arg in argv:
+            setattr(args, FAST_ARGS[arg], True)
+        return args
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Check if kernel is compatible with KernelCare')
+
+    def error(message):
+        # argparse exits with 2, which means UNSUPPORTED; INSIDE CONTAINER here
+        parser.print_usage(sys.stderr)
+        sys.stderr.write('%s: error: %s\n' % (parser.prog, message))
+        sys.exit(6)
+
+    parser.error = error
+    parser.set_defaults(**ARG_DEFAULTS)
+    parser.add_argument('-q', '--silent', action='store_true',
+                        help="don't print anything, just use exit code")
+    parser.add_argument('--one-shot', action='store_true',
+                        help="skip everything that doesn't change the verdict: "
+                             "no compatibility cache, no distribution lookup")
+    parser.add_argument('--batch', metavar='FILE',
+                        help='check /proc/version strings or kernel hashes listed in FILE, one per line '
+                             '("-" to read from stdin)')
+    parser.add_argument('--workers', type=int,
+                        help='number of concurrent connections in batch mode (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write cached compatibility answers")
+    parser.add_argument('--refresh', action='store_true',
+                        help='ignore cached compatibility answers, but store new ones')
+    parser.add_argument('--cache-file', metavar='PATH',
+                        help='compatibility cache location (default: %s)' % os.path.join('<cache dir>', CACHE_FILE))
+    parser.add_argument('--index', metavar='PATH',
+                        help='look kernels up in offline compatibility index instead of asking patches server')
+    parser.add_argument('--server', action='append', metavar='URL',
+                        help='patches server or its mirror to ask, host[:port] or http(s) url; repeat to ask '
+                             'several concurrently and take the first answer (default: %s)' % PATCH_SERVER)
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='seconds to wait for patches server response (default: %(default)s)')
+    parser.add_argument('--retries', type=int, metavar='N',
+                        help='retries of failed patches server requests, with exponential backoff '
+                             '(default: %(default)s)')
+    parser.add_argument('--splay', type=float, metavar='SECONDS',
+                        help='wait up to SECONDS before asking patches server, the same time on every run of '
+                             'the host (derived from its machine id), so that hosts started by cron at once '
+                             "don't ask it all at the same moment")
+    parser.add_argument('--root', metavar='PATH',
+                        help='check kernel of system image mounted at PATH (its proc/version, or the newest '
+                             'kernel image if it has none) instead of the running one, container checks are skipped')
+    parser.add_argument('--build-index', nargs=2, metavar=('INDEX', 'FILE'),
+                        help='create offline compatibility index of supported kernels listed in FILE '
+                             '(hashes or /proc/version strings, "-" for stdin)')
+    parser.add_argument('--update-index', nargs=2, metavar=('INDEX', 'FILE'),
+                        help='add supported kernels listed in FILE to offline compatibility index')
+    parser.add_argument('--timings', action='store_true',
+                        help='print wall and cpu time of every phase to stderr')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save cProfile stats to FILE')
+    # unknown arguments were always ignored, scripts may pass some
+    args, unknown = parser.parse_known_args(argv)
+    if unknown and not args.silent:
+        sys.stderr.write('%s: ignoring unknown arguments: %s\n' % (parser.prog, ' '.join(unknown)))
+    return args
+
+
+def index_main(index_path, source, update, silent):
+    """
+    Build or update offline compatibility index
+    """
+    try:
+        count = build_index(index_path, read_batch_source(source), update)
+    except (IOError, OSError) as e:
+        myprint(silent, "SYSTEM ERROR; %s" % str(e))
+        return 4
+    except ValueError as e:
+        myprint(silent, "UNEXPECTED ERROR; %s" % str(e))
+        return 5
+    myprint(silent, "INDEX; %d kernels" % count)
+    return 0
+
+
 def main():
     """
     if --silent or -q argument provided, don't print anything, just use exit code
     otherwise print results (COMPATIBLE or support contact messages)
     else exit with 0 if COMPATIBLE, 1 or more otherwise
+    if --batch FILE is provided, check every kernel listed in FILE and print one result per kernel hash
+    if --index PATH is provided, look kernels up in offline compatibility index instead of patches server
+    if --timings is provided, print time spent in every phase to stderr
+    if --one-shot is provided, skip compatibility cache and distribution lookup
+    if --server URL is provided (possibly several times), ask these patches servers instead of the default one
+    if --root PATH is provided, check kernel of system image mounted at PATH
     """
-    silent = len(sys.argv) > 1 and (sys.argv[1] == '--silent' or sys.argv[1] == '-q')
-    if inside_vz_container() or inside_lxc_container():
-        myprint(silent, "UNSUPPORTED; INSIDE CONTAINER")
-        return 2
-    
+    args = parse_args(sys.argv[1:])
+    profile = None
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        with timings.span('total'):
+            return run(args)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.timings:
+            sys.stderr.write(timings.report() + '\n')
+
+
+def run(args):
+    silent = args.silent
+    if args.build_index or args.update_index:
+        index_path, source = args.build_index or args.update_index
+        return index_main(index_path, source, bool(args.update_index), silent)
+
+    facts = HostFacts(args.root)
+    if not (args.batch or args.root):
+        # the verdict doesn't depend on anything else inside a container, check it first
+        with timings.span('container'):
+            container = detect_container(facts)
+        if container:
+            myprint(silent, "UNSUPPORTED; INSIDE CONTAINER")
+            return 2
+
+    cache = None
+    if not (args.no_cache or args.one_shot):
+        cache = CompatCache(args.cache_file, refresh=args.refresh)
+    index = None
+    if args.index:
+        try:
+            index = CompatIndex(args.index)
+        except (IOError, OSError, ValueError) as e:
+            myprint(silent, "SYSTEM ERROR; %s" % str(e))
+            return 4
+    # batch mode sends many requests, over connections kept alive between them
+    client = ProbeClient(args.server, timeout=args.timeout, retries=args.retries, splay=args.splay,
+                         keep_alive=bool(args.batch))
+    if args.batch:
+        try:
+            with timings.span('batch'):
+                return batch_main(args.batch, args.workers, silent, cache, index, client)
+        except (IOError, OSError) as e:
+            myprint(silent, "SYSTEM ERROR; %s" % str(e))
+            return 4
+
     try:
-        if is_compat():
+        if is_compat(cache, index, client, facts):
             myprint(silent, "COMPATIBLE")
             return 0
         else:
-            # Handle 404 case - check if distro is supported
-            distro_name = get_distro_info()
+            # Handle 404 case - check if distro is supported, only the message depends on it
+            distro_name = None
+            if not (silent or args.one_shot):
+                with timings.span('distro'):
+                    distro_name = get_distro_info(facts)
             if distro_name and is_distro_supported(distro_name):
                 myprint(silent, "NEEDS REVIEW")
                 myprint(silent, "We support your distribution, but we're having trouble detecting your precise kernel configuration. Please, contact CloudLinux Inc. support by email at support@cloudlinux.com or by request form at https://www.cloudlinux.com/index.php/support")
@@ -134,13 +1286,15 @@ def main():
                 myprint(silent, "NEEDS REVIEW")
                 myprint(silent, "Please contact CloudLinux Inc. support by email at support@cloudlinux.com or by request form at https://www.cloudlinux.com/index.php/support")
                 return 1
-    except HTTPError as e:
-        myprint(silent, "CONNECTION ERROR; HTTP %d" % e.code)
-        return 3
-    except URLError as e:
-        myprint(silent, "CONNECTION ERROR; %s" % str(e.reason))
-        return 3
     except (IOError, OSError) as e:
+        # urllib errors are IOErrors, and urllib is already imported if one was raised
+        HTTPError, URLError = url_errors()
+        if isinstance(e, HTTPError):
+            myprint(silent, "CONNECTION ERROR; HTTP %d" % e.code)
+            return 3
+        if isinstance(e, URLError):
+            myprint(silent, "CONNECTION ERROR; %s" % str(e.reason))
+            return 3
         myprint(silent, "SYSTEM ERROR; %s" % str(e))
         return 4
     except Exception as e:
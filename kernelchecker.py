@@ -1,7 +1,25 @@
-from distutils.version import LooseVersion
+from __future__ import print_function
 import platform
+import contextlib
 import subprocess
+import threading
+import itertools
+import glob
+import io
 import os
+import re
+import select
+import time
+
+try:
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import HTTPError, URLError
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection
 
 __author__ = 'Igor Seletskiy'
 __copyright__ = "Cloud Linux Zug GmbH 2016, KernelCare Project"
@@ -13,272 +31,2904 @@ __status__ = 'Production'
 __version__ = '1.0'
 
 # recognizable kernel package names
-KERNEL_PREFIXES = ['pve-kernel', 'kernel-xen', 'vzkernel', 'kernel', 'linux']
+KERNEL_PREFIXES = ['pve-kernel', 'proxmox-kernel', 'kernel-xen', 'vzkernel', 'kernel', 'linux-image', 'linux']
+# debian kernel packages are named after the kernel release they contain: version, abi and flavor
+DEB_KERNEL_PREFIXES = ['linux-image', 'pve-kernel', 'proxmox-kernel']
+# rpm kernel subpackages, not kernels themselves, e.g. kernel-devel or kernel-rt-modules-extra
+RPM_SUBPACKAGES = ['devel', 'headers', 'core', 'modules', 'tools', 'doc', 'debuginfo', 'firmware', 'cross-headers',
+                   'abi-stablelists', 'abi-whitelists', 'uki-virt', 'srpm-macros']
+# package matchers, prefixes are tried longest first, so that kernel-xen is not taken for a kernel of xen flavor
+DEB_KERNEL_RE = re.compile(
+    r'(?P<prefix>%s)-(?P<version>\d+(?:\.\d+)+)-(?P<release>\d+(?:\.\d+)*)'
+    r'(?:-(?P<flavor>[a-z0-9][a-z0-9.+-]*?))?(?:-(?:un)?signed)?$'
+    % '|'.join(sorted(map(re.escape, DEB_KERNEL_PREFIXES), key=len, reverse=True)))
+RPM_KERNEL_RE = re.compile(
+    r'(?P<prefix>%s)(?:-(?P<flavor>[a-z0-9]+(?:-[a-z0-9]+)*?))??(?P<subpackage>-(?:%s)(?:-.*)?)?$' % (
+        '|'.join(sorted((re.escape(prefix) for prefix in KERNEL_PREFIXES if prefix not in DEB_KERNEL_PREFIXES),
+                        key=len, reverse=True)),
+        '|'.join(RPM_SUBPACKAGES)))
+# rpm package of a kernel release other than kernel, e.g. 4.18.0-372.9.1.rt7.166.el8.x86_64 is of kernel-rt
+RPM_RELEASE_FLAVOR_RE = re.compile(r'(?P<vzkernel>stab|\.vz\d)|\.(?P<kernel_rt>rt)\d|(?P<kernel_uek>uek)|'
+                                   r'[.+](?P<kernel_debug>debug)$|\+(?P<kernel_64k>64k)$')
+# [epoch:]version-release of rpm --queryformat, and name.arch [epoch:]version-release of yum list
+RPM_EVR_RE = re.compile(r'\s*(?:(\d+):)?([^\s:-]+)-(\S+)\s*$')
+YUM_LINE_RE = re.compile(r'(\S+)\.([^.\s]+)\s+(?:(\d+):)?([^\s:-]+)-(\S+)')
+# version-release up to the first non-numeric part of release, e.g. 3.10.0-1160.2.1 of 1:3.10.0-1160.2.1.el7
+RPM_SHORT_VERSION_RE = re.compile(r'(?:[^.:]*:)?([^.]*(?:\.[0-9][^.]*)*)')
+# os-release ID and ID_LIKE values
 DPKG_DISTRO = ['ubuntu', 'debian']
-RPM_DISTRO = ['redhat', 'centos', 'cloudlinux', 'fedora']
+RPM_DISTRO = ['redhat', 'rhel', 'centos', 'cloudlinux', 'fedora', 'almalinux', 'rocky', 'ol', 'amzn']
+
+# /proc/1/cgroup paths of init inside containers, cgroup v1 or host cgroup namespace
+CGROUP_CONTAINERS = (
+    ('/lxc/', 'lxc'),
+    ('/lxc.payload', 'lxc'),
+    ('/docker', 'docker'),
+    ('/libpod', 'podman'),
+    ('/machine.slice/', 'systemd-nspawn'),
+)
+
+# shared with kc-compat.py
+CACHE_FILE = 'compat.json'
+# compatible kernels stay compatible, unknown ones may get support later
+CACHE_TTL = 24 * 60 * 60
+CACHE_NEGATIVE_TTL = 60 * 60
+# expired compatible answers are kept for their ETag / Last-Modified, to be revalidated
+# with a conditional request the server answers with a bodyless 304
+CACHE_VALIDATORS_TTL = 30 * 24 * 60 * 60
+# (cache entry key, response header, conditional request header)
+VALIDATOR_HEADERS = (
+    ('etag', 'ETag', 'If-None-Match'),
+    ('last_modified', 'Last-Modified', 'If-Modified-Since'),
+)
+# host-stable seed of --splay delay, hostname if there is none
+MACHINE_ID_FILES = ('/etc/machine-id', '/var/lib/dbus/machine-id')
+INSTALLED_CACHE_FILE = 'installed.json'
+# results shared between concurrent runs, computed by one of them at a time under the lock file
+RESULT_CACHE_FILE = 'results.json'
+RESULT_TTL = 5 * 60
+
+# offline compatibility index, built by kc-compat.py --build-index
+INDEX_MAGIC = b'KCIDX\x00\x00\x01'
+INDEX_HEADER_SIZE = 16
+INDEX_DIGEST_SIZE = 20
+
+# package databases, read directly instead of running rpm / dpkg-query
+DPKG_STATUS = '/var/lib/dpkg/status'
+RPMDB_SQLITE = ['/var/lib/rpm/rpmdb.sqlite', '/usr/lib/sysimage/rpm/rpmdb.sqlite']
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+# python bindings of package managers, used instead of running them when installed
+PACKAGE_BINDINGS = ('rpm', 'apt_pkg')
+
+# repository metadata downloaded by package managers, used instead of refreshing it
+APT_LISTS_DIR = '/var/lib/apt/lists'
+RPM_METADATA_GLOBS = [
+    '/var/cache/yum/*/*/*/gen/primary_db.sqlite',
+    '/var/cache/yum/*/gen/primary_db.sqlite',
+    '/var/cache/dnf/*/repodata/*primary.xml*',
+    '/var/cache/libdnf5/*/repodata/*primary.xml*',
+]
+# where yum/dnf keep repository metadata, watched for repositories added or refreshed
+RPM_METADATA_DIRS = ['/var/cache/yum', '/var/cache/dnf', '/var/cache/libdnf5']
+# metadata older than that is refreshed by yum/apt-get update
+METADATA_MAX_AGE = 24 * 60 * 60
+# compressed bytes read at a time from metadata without a file class for its compression
+METADATA_CHUNK = 64 * 1024
+REPO_XML_NS = '{http://linux.duke.edu/metadata/common}'
+
+PATCH_SERVER = 'patches.kernelcare.com'
+# patches server probe, same as in kc-compat.py: worst case is PROBE_RETRIES + 1 attempts of connect and
+# read timeouts, with exponential backoff between them, ~25 seconds with the defaults
+PROBE_CONNECT_TIMEOUT = 3
+PROBE_TIMEOUT = 5
+PROBE_RETRIES = 2
+PROBE_BACKOFF = 0.5
+KCARE_BIN = '/usr/bin/kcarectl'
+KCARE_STATE_DIR = '/var/cache/kcare'
+# loaded patch level, and patches downloaded by kcarectl as <kernel hash>-<level> directories
+KCARE_INFO = '/proc/kcare/info'
+KCARE_PATCHES_DIR = '/var/cache/kcare/patches'
+# kcarectl downloads new patches every 4 hours, an older download may have missed some
+KCARE_STATE_MAX_AGE = 12 * 60 * 60
+
+# service mode
+SERVE_SOCKET = '/run/kernelchecker.sock'
+# seconds between checks of watched files, when inotify is unavailable it is the only way to notice changes
+SERVE_POLL_INTERVAL = 60
+# seconds to wait after an inotify event, for package manager to finish its transaction
+SERVE_SETTLE_TIME = 1
+# node_exporter textfile collector mode, readable by node_exporter running as another user
+TEXTFILE_MODE = 0o644
+# gauges of results with their help texts
+TEXTFILE_GAUGES = (
+    ('needs_update', 'Newer kernel exists, reboot will be needed'),
+    ('latest_installed', 'Latest kernel is already installed'),
+    ('latest_available', 'Latest kernel is available in repositories'),
+    ('inside_container', 'Running inside container, kernel cannot be updated'),
+    ('kernelcare_installed', 'KernelCare is installed'),
+    ('kernelcare_up2date', 'Kernel is patched with all KernelCare patches'),
+    ('kernelcare_supported', 'KernelCare supports running kernel'),
+)
+# seconds to wait for each probe before reporting its result as unknown
+PROBE_TIMEOUTS = {
+    'installed': 30,
+    'available': 120,
+    'supported': 30,
+    'kcarectl': 60,
+}
+
+
+_span_hooks = []
+_current_span = threading.local()
+
+
+def add_span_hook(hook):
+    """
+    Register function to be called with every finished span, see Timings.span
+    """
+    _span_hooks.append(hook)
+
+
+def remove_span_hook(hook):
+    _span_hooks.remove(hook)
+
+
+def _cpu_time():
+    try:
+        return time.thread_time()
+    except AttributeError:
+        return sum(os.times()[:2])
+
+
+class Timings(object):
+    """
+    Wall and cpu time of KernelChecker phases, with exit codes of commands they ran
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Measure the block as a span: dict with name, wall and cpu milliseconds (cpu of the running thread only)
+        and exit_codes, list of [command, exit code] of commands executed in it
+        """
+        span = {'name': name, 'wall': None, 'cpu': None, 'exit_codes': []}
+        parent = getattr(_current_span, 'span', None)
+        _current_span.span = span
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield span
+        finally:
+            span['wall'] = round((time.time() - wall) * 1000, 3)
+            span['cpu'] = round((_cpu_time() - cpu) * 1000, 3)
+            _current_span.span = parent
+            self.spans.append(span)
+            for hook in list(_span_hooks):
+                hook(span)
+
+    def timed_out(self, name):
+        self.spans.append({'name': name, 'wall': None, 'cpu': None, 'exit_codes': [], 'timed_out': True})
+
+
+def record_exit_code(command, code):
+    """
+    Attach exit code of command to the span running in current thread, if any
+    """
+    span = getattr(_current_span, 'span', None)
+    if span is not None:
+        span['exit_codes'].append([command, code])
+
+
+def run_command(args, timeout):
+    """
+    Run command without reading its output, which is discarded so it can't block on a full pipe
+    :param timeout: seconds to wait, the command is killed after that
+    :return: exit code, None if the command was killed
+    """
+    devnull = open(os.devnull, 'r+b')
+    try:
+        p = subprocess.Popen(args, stdin=devnull, stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+    deadline = time.time() + timeout
+    delay = 0.001
+    # Popen.wait(timeout) is python 3 only
+    while p.poll() is None:
+        if time.time() >= deadline:
+            p.kill()
+            p.wait()
+            record_exit_code(args[0], None)
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    record_exit_code(args[0], p.returncode)
+    return p.returncode
 
 
-def check_output(args):
+def check_output(args, timeout=None):
     """
     Execute command, and return output stream. Provided for convenience/compatiblity with python 2.4
     :param args: command to execute
+    :param timeout: seconds to wait, the command is killed after that, e.g. package manager holding its lock
     :return: output stream
+    :raises OSError: the command was killed
     """
-    return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    killed = []
+    timer = None
+    if timeout is not None:
+        def kill():
+            killed.append(True)
+            try:
+                p.kill()
+            except OSError:
+                pass
+        # communicate(timeout) is python 3 only
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        out = p.communicate()[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+    if killed:
+        record_exit_code(args[0], None)
+        raise OSError('%s killed after %s seconds' % (args[0], timeout))
+    record_exit_code(args[0], p.returncode)
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+    return out
 
 
-class RpmHandler:
-    def __init__(self, current_version):
-        if 'stab' in current_version:
-            self.kernel_name = 'vzkernel'
-        else:
-            self.kernel_name = 'kernel'
+def default_cache_dir():
+    """
+    :return: system cache directory for root, user cache directory otherwise
+    """
+    if os.geteuid() == 0:
+        return '/var/cache/kcare-scripts'
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'kcare-scripts')
 
-    def get_installed(self):
-        result = []
-        for version in check_output(
-            ['rpm', '--queryformat=%{VERSION}-%{RELEASE}\n', '-qq', self.kernel_name]).split('\n'):
-            version = RpmHandler.strip_version(version)
-            if version:
-                result.append(version)
-        return result
 
-    def get_available(self):
-        yum_output = check_output(
-            ['yum', 'list', 'updates', self.kernel_name]).split('\n')
-        result = []
-        for line in yum_output:
-            if line.startswith(self.kernel_name):
-                result.append(RpmHandler.strip_version(line.split()[1]))
-        return result
+def write_atomic(path, data, mode=None):
+    """
+    Replace file contents via rename, so concurrent readers never see it half-written.
+    Missing parent directories are created
+    :param data: str, or bytes
+    :param mode: permissions of the file, readable by owner only by default
+    """
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
 
-    @staticmethod
-    def strip_version(version):
-        parts = version.split('.')
-        result = parts[0]
-        parts.pop(0)
-        for part in parts:
-            if part and part[0].isdigit():
-                result += '.'+part
-            else:
-                break
-        if ':' in result:
-            result = result.split(':')[1]
-        return result
+
+def in_root(root, path):
+    """
+    :param root: mount point of system image or chroot, None for the live host
+    :return: absolute path resolved inside root
+    """
+    if not root:
+        return path
+    return os.path.join(root, path.lstrip('/'))
 
 
-class DpkgHandler:
-    def __init__(self, current_version):
-        parts = current_version.split('-')
-        self.pkg_version = parts[0]
-        self.pkg_prefix = 'linux-image-'+parts[0]
-        self.pkg_suffix = parts[-1]
-        self.is_rt = '-rt-' in current_version
-
-    def extract_version(self, line):
-        if len(line):
-            pkg_name = line.split()[0]
-            return pkg_name[len(self.pkg_prefix)-len(self.pkg_version):]
-        else:
+def release_key(release):
+    """
+    Natural sort key of kernel release, numbers compare as numbers: 5.14.0-70 is older than 5.14.0-162
+    """
+    key = []
+    for digits, chars in itertools.groupby(release, lambda char: char.isdigit()):
+        part = ''.join(chars)
+        key.append((1, int(part)) if digits else (0, part))
+    return key
+
+
+class HostFacts(object):
+    """
+    Snapshot of kernel, distribution and container facts of the host or of a system image.
+    Every file is read at most once, on first use, so all answers come from the same reads
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: mount point of system image or chroot, None for the live host
+        """
+        self.root = root
+        self._facts = {}
+
+    def _memoized(self, name, compute):
+        try:
+            return self._facts[name]
+        except KeyError:
+            value = self._facts[name] = compute()
+            return value
+
+    def exists(self, path):
+        return self._memoized('exists:' + path, lambda: os.path.exists(in_root(self.root, path)))
+
+    def read(self, path, mode='r'):
+        """
+        :return: file contents, empty if it can't be read
+        """
+        def read():
+            try:
+                with open(in_root(self.root, path), mode) as f:
+                    return f.read()
+            except (IOError, OSError):
+                return b'' if 'b' in mode else ''
+        return self._memoized('read:%s:%s' % (mode, path), read)
+
+    @property
+    def proc_version(self):
+        """
+        /proc/version, or the banner of boot_image if a system image has none, e.g. unpacked one
+        :raises IOError: neither can be read
+        """
+        def read():
+            try:
+                with open(in_root(self.root, '/proc/version'), 'rb') as f:
+                    return f.read()
+            except (IOError, OSError):
+                image = self.root and self.boot_image
+                if not image:
+                    raise
+            return read_kernel_banner(image)
+        return self._memoized('proc_version', read)
+
+    @property
+    def boot_image(self):
+        """
+        :return: kernel image of the newest kernel, the one system image boots by default, or None
+        """
+        def find():
+            import glob
+            images = {}
+            for pattern in ('/usr/lib/modules/*/vmlinuz', '/lib/modules/*/vmlinuz'):
+                for path in glob.glob(in_root(self.root, pattern)):
+                    images[os.path.basename(os.path.dirname(path))] = path
+            for path in glob.glob(in_root(self.root, BOOT_IMAGES)):
+                images[os.path.basename(path)[len('vmlinuz-'):]] = path
+            if not images:
+                return None
+            return images[max(images, key=release_key)]
+        return self._memoized('boot_image', find)
+
+    @property
+    def kernel_hash(self):
+        try:
+            # noinspection PyCompatibility
+            from hashlib import sha1
+        except ImportError:
+            from sha import sha as sha1
+        return self._memoized('kernel_hash', lambda: sha1(self.proc_version).hexdigest())
+
+    @property
+    def kernel_release(self):
+        """
+        :return: release of the running kernel, of the one system image boots, or None
+        """
+        def release():
+            try:
+                words = self.proc_version.split()
+            except (IOError, OSError):
+                words = []
+            if len(words) > 2 and words[:2] == [b'Linux', b'version']:
+                return words[2].decode('utf-8', 'replace')
+            if not self.root:
+                return os.uname()[2]
             return None
+        return self._memoized('kernel_release', release)
 
-    def get_versions(self, command):
-        out = check_output(command)
-        result = []
-        for line in out.split('\n'):
-            ver = self.extract_version(line)
-            if ver:
-		if self.is_rt:
-			if '-rt-' in ver: 
-                		result.append(ver)
-		elif '-rt-' not in ver:
-			result.append(ver)
-        return result
+    @property
+    def os_release(self):
+        """
+        :return: dict of /etc/os-release variables
+        """
+        def parse():
+            for path in ('/etc/os-release', '/usr/lib/os-release'):
+                if self.exists(path):
+                    break
+            else:
+                return {}
+            result = {}
+            for line in self.read(path).splitlines():
+                name, sep, value = line.strip().partition('=')
+                if sep and not name.startswith('#'):
+                    result[name] = value.strip().strip('"\'')
+            return result
+        return self._memoized('os_release', parse)
 
-    def get_installed(self):
-        return self.get_versions(['dpkg-query', '-W', self.pkg_prefix+'-*-'+self.pkg_suffix])
+    @property
+    def distro_id(self):
+        return self.os_release.get('ID')
 
-    def get_available(self):
-        check_output(['apt-get', 'update'])
-        return self.get_versions(['apt-cache', 'search', self.pkg_prefix+'-.*-'+self.pkg_suffix+'$'])
+    @property
+    def distro_version(self):
+        return self.os_release.get('VERSION_ID')
 
+    @property
+    def distro_like(self):
+        return self.os_release.get('ID_LIKE', '').split()
 
-class UnknownHandler:
-    def __init__(self):
-        pass
+    @property
+    def init_cgroup(self):
+        return self.read('/proc/1/cgroup')
 
-    @staticmethod
-    def get_installed():
-        return []
+    @property
+    def cgroup_version(self):
+        return 2 if self.exists('/sys/fs/cgroup/cgroup.controllers') else 1
 
-    @staticmethod
-    def get_available():
-        return []
+    @property
+    def inside_openvz(self):
+        return self.exists('/proc/vz/veinfo') and not self.exists('/proc/vz/version')
+
+    @property
+    def container(self):
+        """
+        :return: container type (openvz, lxc, docker, podman, systemd-nspawn, ...), None if not inside a container
+        """
+        def detect():
+            if self.inside_openvz:
+                return 'openvz'
+            # set by container managers, the only reliable way with cgroup v2 namespaces
+            marker = self.read('/run/systemd/container').strip()
+            if not marker:
+                for variable in self.read('/proc/1/environ', 'rb').split(b'\0'):
+                    if variable.startswith(b'container='):
+                        marker = variable[10:].decode('utf-8', 'replace')
+            if marker:
+                return marker
+            if self.exists('/run/.containerenv'):
+                return 'podman'
+            if self.exists('/.dockerenv'):
+                return 'docker'
+            cgroup = self.init_cgroup
+            for pattern, name in CGROUP_CONTAINERS:
+                if pattern in cgroup:
+                    return name
+            return None
+        return self._memoized('container', detect)
 
 
-class KernelChecker:
+def file_signature(paths):
     """
-    This class performs checks to determine if kernel update & reboot needed
+    :return: list of [path, mtime, size], mtime and size are None for missing files
     """
-    kernelcare = None
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            result.append([path, st.st_mtime, st.st_size])
+        except OSError:
+            result.append([path, None, None])
+    return result
 
-    def __init__(self):
-        self.current_version = platform.release()
-        self.inside_container = False
-        self.distro_type = KernelChecker.get_distro_type()
-        if 'stab' in self.current_version:
-            self.inside_container = KernelChecker.inside_vz_container()
-        else:
-            self.inside_container = KernelChecker.inside_lxc_container()
 
-        if self.distro_type == "rpm":
-            handler = RpmHandler(self.current_version)
-            self.current_version = handler.strip_version(self.current_version)
-        elif self.distro_type == "dpkg":
-            handler = DpkgHandler(self.current_version)
+def cached_by_signature(paths, key, compute, cache_dir=None):
+    """
+    Reuse result of compute() from the previous run while files in paths are unchanged
+    :param paths: files result depends on, e.g. package database
+    :param key: what is computed from these files
+    :param compute: function returning json-serializable result
+    :param cache_dir: where to keep results between runs, None to always compute
+    """
+    if cache_dir is None:
+        return compute()
+    import json
+    path = os.path.join(cache_dir, INSTALLED_CACHE_FILE)
+    signature = file_signature(paths)
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+        entry = entries[key]
+        if entry['signature'] == signature:
+            return entry['result']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        entries = {}
+    if not isinstance(entries, dict):
+        entries = {}
+    result = compute()
+    entries[key] = {'signature': signature, 'result': result}
+    try:
+        write_atomic(path, json.dumps(entries))
+    except (IOError, OSError):
+        pass
+    return result
+
+
+def single_flight(path, key, compute, ttl=RESULT_TTL, refresh=False, paths=None):
+    """
+    Share result of compute() between concurrent runs: while one run computes it holding an advisory lock on
+    path + '.lock', others wait for the lock and reuse the result. Results are reused for ttl seconds, unless
+    files KernelChecker results depend on change. Lock and cache are best effort,
+    if they can't be used the result is just computed
+    :param path: shared result cache file
+    :param key: what is computed, e.g. system image root and options affecting results
+    :param compute: function returning json-serializable result
+    :param refresh: don't reuse results computed before the call, only the ones computed while waiting
+    :param paths: files result depends on (default: watched_paths() of the live host); their signature is
+        stored as of after compute, which may refresh some of them, e.g. repository metadata
+    """
+    import collections
+    import json
+    if paths is None:
+        paths = watched_paths()
+    signature = file_signature(paths)
+    started = time.time()
+
+    def load():
+        try:
+            with open(path) as f:
+                entries = json.load(f, object_pairs_hook=collections.OrderedDict)
+        except (IOError, OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def cached(since):
+        entry = load().get(key)
+        try:
+            if entry['signature'] == signature and since <= entry['checked'] and time.time() - entry['checked'] < ttl:
+                return entry['result']
+        except (KeyError, TypeError):
             pass
-        else:
-            handler = UnknownHandler()
+        return None
+
+    result = None if refresh else cached(0)
+    if result is not None:
+        return result
+    try:
+        import fcntl
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        lock = open(path + '.lock', 'a')
+    except (ImportError, IOError, OSError):
+        return compute()
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        result = cached(started if refresh else 0)
+        if result is not None:
+            return result
+        result = compute()
+        entries = load()
+        entries[key] = {'signature': file_signature(paths), 'checked': time.time(), 'result': result}
+        try:
+            write_atomic(path, json.dumps(entries))
+        except (IOError, OSError):
             pass
+        return result
+    finally:
+        lock.close()
 
-        self.installed_versions = handler.get_installed()
-        self.available_versions = handler.get_available()
 
-        self.latest_version = self.get_latest()
+class CompatIndex(object):
+    """
+    Offline compatibility index: sorted SHA1 digests of supported kernels after a 16 bytes header
+    (INDEX_MAGIC and number of digests). The file is memory mapped and binary searched
+    """
 
-        self.needs_update = self.latest_version != self.current_version
-        self.latest_installed = self.latest_version in self.installed_versions
-        self.latest_available = self.latest_version in self.available_versions
+    def __init__(self, path):
+        import mmap
+        import struct
+        with open(path, 'rb') as f:
+            header = f.read(INDEX_HEADER_SIZE)
+            if len(header) != INDEX_HEADER_SIZE or header[:8] != INDEX_MAGIC:
+                raise ValueError('%s is not a compatibility index' % path)
+            self.count = struct.unpack('>Q', header[8:])[0]
+            if os.fstat(f.fileno()).st_size != INDEX_HEADER_SIZE + self.count * INDEX_DIGEST_SIZE:
+                raise ValueError('%s is truncated' % path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        self.check_kernelcare()
+    def __len__(self):
+        return self.count
 
+    def digest(self, i):
+        offset = INDEX_HEADER_SIZE + i * INDEX_DIGEST_SIZE
+        return self.map[offset:offset + INDEX_DIGEST_SIZE]
 
-    @staticmethod
-    def get_kernel_hash():
+    def __contains__(self, kernel_hash):
+        import binascii
         try:
-            # noinspection PyCompatibility
-            from hashlib import sha1
-        except ImportError:
-            from sha import sha as sha1
-        f = open('/proc/version', 'rb')
+            digest = binascii.unhexlify(kernel_hash)
+        except (TypeError, ValueError):
+            return False
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.count and self.digest(lo) == digest
+
+    def digests(self):
+        for i in range(self.count):
+            yield self.digest(i)
+
+    def close(self):
+        self.map.close()
+
+
+class CompatCache(object):
+    """
+    On-disk cache of compatibility answers keyed by kernel hash.
+    Compatible and not found answers expire after ttl and negative_ttl seconds respectively.
+    The cache is best effort: it is ignored if it can't be read or written.
+    Answers can be put and saved from several threads, e.g. kernelchecker.py checking kernel images in /boot
+    """
+
+    def __init__(self, path=None, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, refresh=False,
+                 validators_ttl=CACHE_VALIDATORS_TTL):
+        """
+        :param refresh: don't use cached answers, only store new ones
+        :param validators_ttl: seconds to keep expired answers having ETag / Last-Modified for
+        """
+        import threading
+        self.path = path or os.path.join(default_cache_dir(), CACHE_FILE)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.validators_ttl = validators_ttl
+        self.refresh = refresh
+        self.entries = {}
+        self.updated = {}
+        self.lock = threading.Lock()
+        if not refresh:
+            self.entries = self._load()
+
+    def _load(self):
+        import json
         try:
-            return sha1(f.read()).hexdigest()
-        finally:
-            f.close()
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
 
-    @staticmethod
-    def is_kernelcare_supported_kernel():
-        url = 'http://patches.kernelcare.com/'+KernelChecker.get_kernel_hash()+'/version'
-        import urllib2
+    def _fresh(self, entry, now):
         try:
-            urllib2.urlopen(url)
+            ttl = self.ttl if entry['compatible'] else self.negative_ttl
+            return 0 <= now - entry['checked'] < ttl
+        except (KeyError, TypeError):
+            return False
+
+    def _keep(self, entry, now):
+        if self._fresh(entry, now):
             return True
-        except:
+        try:
+            return bool(entry.get('validators')) and 0 <= now - entry['checked'] < self.validators_ttl
+        except (AttributeError, KeyError, TypeError):
             return False
 
-    def check_kernelcare(self):
+    def get(self, kernel_hash):
         """
-        checks if kernelcare (http://kernelcare.com) is installed, and kernel is patched
-        :return: tupple ( INSTALLED, UP2DATE, SUPPORTED )
+        :return: True/False cached answer or None if there is no fresh one
         """
-        supported = KernelChecker.is_kernelcare_supported_kernel()
-        kcare_bin = '/usr/bin/kcarectl'
-        if os.path.exists(kcare_bin):
-            p = subprocess.Popen([kcare_bin, '--check'], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            self.kernelcare = (True, p.wait() == 1, supported)
-        else:
-            self.kernelcare = (False, False, supported)
+        entry = self.updated.get(kernel_hash) or self.entries.get(kernel_hash)
+        if entry is None or not self._fresh(entry, time.time()):
+            return None
+        return entry['compatible']
 
-    @staticmethod
-    def get_version(fullname):
-        for prefix in KERNEL_PREFIXES:
-            if fullname.startswith(prefix):
-                return fullname[len(prefix)+1:]
+    def validators(self, kernel_hash):
+        """
+        :return: ETag / Last-Modified dict of the last compatible answer, even an expired one, or None
+        """
+        entry = self.updated.get(kernel_hash) or self.entries.get(kernel_hash)
+        if isinstance(entry, dict) and isinstance(entry.get('validators'), dict):
+            return entry['validators']
         return None
 
-    def get_latest(self):
+    def put(self, kernel_hash, compatible, validators=None):
         """
-        Figures out latest kernel version
-        :return: latest version from all versions
+        :param validators: ETag / Last-Modified dict of the answer, see ProbeClient.answer_validators
         """
-        latest = '0'
-        all = [self.current_version] + self.installed_versions + self.available_versions
-        for k in all:
-            if LooseVersion(latest) < LooseVersion(k):
-                latest = k
-        return latest
+        entry = {'compatible': compatible, 'checked': time.time()}
+        if validators:
+            entry['validators'] = validators
+        with self.lock:
+            self.updated[kernel_hash] = entry
 
-    @staticmethod
-    def get_distro_type():
-        import platform
+    def save(self):
+        """
+        Merge new answers into the cache file, dropping expired entries unless they can be revalidated.
+        File is replaced atomically, so concurrent runs never see it half-written
+        """
+        import json
+        with self.lock:
+            if not self.updated:
+                return
+            now = time.time()
+            entries = self._load()
+            entries.update(self.updated)
+            entries = dict((k, v) for k, v in entries.items() if self._keep(v, now))
+            try:
+                write_atomic(self.path, json.dumps(entries))
+            except (IOError, OSError):
+                return
+            self.entries = entries
+            self.updated = {}
+
+def url_errors():
+    """
+    :return: HTTPError and URLError classes
+    """
+    try:
+        from urllib.error import HTTPError, URLError
+    except ImportError:
+        from urllib2 import HTTPError, URLError
+    return HTTPError, URLError
+
+
+def server_url(server):
+    """
+    :param server: host[:port], optionally prefixed with http:// or https://
+    """
+    if '://' in server:
+        return server.rstrip('/')
+    return 'http://' + server
+
+
+def http_connection(server, timeout):
+    """
+    :param server: host[:port], optionally prefixed with http:// or https://
+    """
+    scheme, _, host = server_url(server).partition('://')
+    if scheme == 'https':
+        return HTTPSConnection(host, timeout=timeout)
+    return HTTPConnection(host, timeout=timeout)
+
+
+def conditional_headers(validators):
+    """
+    :param validators: ETag / Last-Modified dict of an earlier answer, or None
+    :return: headers asking server to answer 304 Not Modified if nothing changed since, or None
+    """
+    headers = {}
+    for key, _, header in VALIDATOR_HEADERS:
+        if validators and validators.get(key):
+            headers[header] = validators[key]
+    return headers or None
+
+
+def response_validators(response):
+    """
+    :param response: http response
+    :return: ETag / Last-Modified dict of the response, or None if it has neither
+    """
+    validators = {}
+    for key, header, _ in VALIDATOR_HEADERS:
+        value = response.getheader(header)
+        if value:
+            validators[key] = value
+    return validators or None
+
+
+def splay_delay(splay):
+    """
+    Random, but host-stable delay: it is derived from machine id, so a host waits the same on every run,
+    while hosts started by cron at the same minute spread evenly over splay seconds
+    :return: seconds in [0, splay)
+    """
+    if not splay or splay <= 0:
+        return 0
+    seed = None
+    for path in MACHINE_ID_FILES:
         try:
-            name = platform.dist()[0]
-        except AttributeError:
-            name = platform.linux_distribution()[0]
-        if name.lower() in RPM_DISTRO:
-            return "rpm"
-        elif name.lower() in DPKG_DISTRO:
-            return "dpkg"
-        elif os.path.exists('/usr/bin/rpm'):
-            return "rpm"
-        elif os.path.exists('/usr/bin/dpkg'):
-            return "dpkg"
-        return "unknown"
+            with open(path) as f:
+                seed = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if seed:
+            break
+    if not seed:
+        import socket
+        seed = socket.gethostname()
+    from hashlib import sha1
+    digest = sha1(('splay:' + seed).encode('utf-8')).hexdigest()
+    return splay * int(digest[:8], 16) / float(1 << 32)
 
-    @staticmethod
-    def inside_vz_container():
+
+class ProbeClient(object):
+    """
+    Asks patches servers if they know a kernel hash with HEAD requests, so no body is downloaded.
+    Failed attempts are retried with exponential backoff and jitter. With several servers (mirrors)
+    they are asked concurrently, and the first definitive answer wins.
+    ETag / Last-Modified of compatible answers are remembered, to make the next checks conditional
+    """
+
+    def __init__(self, servers=None, connect_timeout=PROBE_CONNECT_TIMEOUT, timeout=PROBE_TIMEOUT,
+                 retries=PROBE_RETRIES, backoff=PROBE_BACKOFF, splay=0, keep_alive=False):
         """
-        determines if we are inside Virtuozzo container
-        :return: True if inside container, false otherwise
+        :param servers: list of host[:port] or http(s) urls, PATCH_SERVER by default
+        :param timeout: seconds to wait for a response once connected
+        :param retries: attempts to make after the first one failed, per server
+        :param backoff: seconds to wait before the first retry, doubled for every next one
+        :param splay: wait up to splay seconds before the first request, see splay_delay
+        :param keep_alive: keep connections open and reuse them for the next requests, for many checks
         """
-        return os.path.exists('/proc/vz/veinfo') and not os.path.exists('/proc/vz/version')
+        self.servers = servers or [PATCH_SERVER]
+        self.connect_timeout = min(connect_timeout, timeout)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.splay = splay
+        self.keep_alive = keep_alive
+        # request path -> ETag / Last-Modified dict of the last compatible answer
+        self.validators = {}
+        # server -> idle keep-alive connections
+        self.idle = {}
 
-    @staticmethod
-    def inside_lxc_container():
-        return '/lxc/' in open('/proc/1/cgroup').read()
+    def answer_validators(self, kernel_hash):
+        """
+        :return: ETag / Last-Modified dict of the last compatible answer for kernel_hash, or None
+        """
+        return self.validators.get('/' + kernel_hash + '/version')
 
-    def get_data(self):
-        return (self.latest_version, self.current_version, self.distro_type,
-                self.needs_update, self.latest_installed,
-                self.latest_available, self.inside_container,
-                self.kernelcare[0], self.kernelcare[1], self.kernelcare[2])
+    def check(self, kernel_hash, validators=None):
+        """
+        :param validators: ETag / Last-Modified dict of an earlier compatible answer, see CompatCache.validators
+        :return: True if kernel is known to patches server, False if it is not
+        :raises HTTPError, URLError: no server gave a definitive answer
+        """
+        if self.splay:
+            # only before the first request of the client
+            delay, self.splay = splay_delay(self.splay), 0
+            time.sleep(delay)
+        path = '/' + kernel_hash + '/version'
+        headers = conditional_headers(validators)
+        if len(self.servers) == 1:
+            return self.check_server(self.servers[0], path, headers)
 
-    def tojson(self):
-        result = '{ "latest" : "%s", ' \
-                 '"current" : "%s", ' \
-                 '"distro" : "%s", ' \
-                 '"needs_update" : %r, ' \
-                 '"latest_installed" : %r, ' \
-                 '"latest_available" : %r, ' \
-                 '"inside_container" : %r,' \
-                 '"kernelcare" : { "installed" : %r, "up2date" : %r, "supported" : %r } }' % self.get_data()
-        return result
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        results = queue.Queue()
+
+        def race(server):
+            try:
+                results.put(self.check_server(server, path, headers))
+            except Exception as e:
+                results.put(e)
+
+        for server in self.servers:
+            t = threading.Thread(target=race, args=(server,))
+            # losers are left behind, their answers don't matter anymore
+            t.daemon = True
+            t.start()
+        error = None
+        for _ in self.servers:
+            result = results.get()
+            if isinstance(result, bool):
+                return result
+            error = result
+        raise error
+
+    def check_server(self, server, path, headers=None):
+        """
+        :return: True if path is found on server, False if it is not
+        :raises HTTPError, URLError: of the last attempt
+        """
+        HTTPError, URLError = url_errors()
+        try:
+            from http.client import HTTPException
+        except ImportError:
+            from httplib import HTTPException
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                import random
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                status, reason = self.request(server, path, headers)
+            except (HTTPException, IOError, OSError) as e:
+                error = URLError(e)
+                continue
+            # 304: not modified since the compatible answer headers came from
+            if status in (200, 206, 304):
+                return True
+            if status == 404:
+                return False
+            error = HTTPError(server_url(server) + path, status, reason, None, None)
+            # server errors and throttling may be transient, anything else won't change on retry
+            if status != 429 and status < 500:
+                break
+        raise error
+
+    def request(self, server, path, headers=None):
+        """
+        HEAD request, falls back to GET of a single byte if server doesn't allow HEAD.
+        Validators of a successful response are stored in self.validators
+        :param headers: conditional request headers, see conditional_headers
+        :return: response status and reason
+        """
+        idle = self.idle.setdefault(server, [])
+        try:
+            conn = idle.pop()
+        except IndexError:
+            conn = None
+        if conn is not None:
+            try:
+                from http.client import HTTPException
+            except ImportError:
+                from httplib import HTTPException
+            try:
+                return self.exchange(server, conn, path, headers)
+            except (HTTPException, IOError, OSError):
+                # server may have closed the idle connection, that is not a failed attempt yet
+                pass
+        conn = http_connection(server, self.connect_timeout)
+        try:
+            conn.connect()
+            conn.sock.settimeout(self.timeout)
+        except Exception:
+            conn.close()
+            raise
+        return self.exchange(server, conn, path, headers)
+
+    def exchange(self, server, conn, path, headers):
+        """
+        Send request over connected conn, which is kept for the next requests with keep_alive, closed otherwise
+        :return: response status and reason
+        """
+        try:
+            conn.request('HEAD', path, headers=headers or {})
+            response = conn.getresponse()
+            # body has to be drained before the connection can be reused
+            response.read()
+            if response.status in (405, 501):
+                conn.request('GET', path, headers=dict(headers or {}, Range='bytes=0-0'))
+                response = conn.getresponse()
+                response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.status in (200, 206):
+            self.validators[path] = response_validators(response)
+        if self.keep_alive and not response.will_close:
+            self.idle[server].append(conn)
+        else:
+            conn.close()
+        return response.status, response.reason
+
+
+_RPM_SEGMENT_RE = re.compile(r'~|\^|[0-9]+|[a-zA-Z]+')
+_DPKG_PART_RE = re.compile(r'([^0-9]*)([0-9]*)')
+_DPKG_END = ((0,), 0)
+
+
+def rpm_version_key(version):
+    """
+    Sort key for a version or release string, ordering as rpmvercmp does:
+    numeric segments > alphabetic ones > '^' > end of string > '~', separators are ignored
+    """
+    key = []
+    for segment in _RPM_SEGMENT_RE.findall(version):
+        if segment == '~':
+            key.append((0, 0, ''))
+        elif segment == '^':
+            key.append((2, 0, ''))
+        elif segment.isdigit():
+            key.append((4, int(segment), ''))
+        else:
+            key.append((3, 0, segment))
+    key.append((1, 0, ''))
+    return tuple(key)
+
+
+def rpm_evr_key(evr):
+    """
+    Sort key for [epoch:]version[-release] string, as compared by rpm
+    """
+    epoch, _, vr = evr.rpartition(':')
+    version, _, release = vr.partition('-')
+    try:
+        epoch = int(epoch or 0)
+    except ValueError:
+        epoch = 0
+    return epoch, rpm_version_key(version), rpm_version_key(release)
+
+
+def _dpkg_char_order(c):
+    if c == '~':
+        return -1
+    if 'a' <= c <= 'z' or 'A' <= c <= 'Z':
+        return ord(c)
+    return ord(c) + 256
+
+
+def _dpkg_part_key(part):
+    """
+    Sort key for upstream version or debian revision, ordering as dpkg --compare-versions does:
+    alternating non-digit parts compared char by char ('~' < end < letters < others) and numbers
+    """
+    key = []
+    for chars, digits in _DPKG_PART_RE.findall(part):
+        key.append((tuple(_dpkg_char_order(c) for c in chars) + (0,), int(digits or 0)))
+    # the first part is kept even if it is empty, e.g. of '0', to compare with the next part of '0~rc1'
+    while len(key) > 1 and key[-1] == _DPKG_END:
+        key.pop()
+    key.append(_DPKG_END)
+    return tuple(key)
+
+
+def dpkg_version_key(version):
+    """
+    Sort key for [epoch:]upstream_version[-debian_revision] string, as compared by dpkg
+    """
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    try:
+        epoch = int(epoch)
+    except ValueError:
+        epoch = 0
+    return epoch, _dpkg_part_key(upstream), _dpkg_part_key(revision)
+
+
+def memoize_key(key):
+    """
+    :return: key function that parses every version only once
+    """
+    cache = {}
+
+    def memoized(version):
+        try:
+            return cache[version]
+        except KeyError:
+            result = cache[version] = key(version)
+            return result
+    return memoized
+
+
+def probe_timeout(timeouts, name):
+    """
+    :param timeouts: dict of probe name -> seconds, PROBE_TIMEOUTS if None
+    :return: seconds to wait for probe, the longest of timeouts if it has none of its own
+    """
+    if timeouts is None:
+        timeouts = PROBE_TIMEOUTS
+    return timeouts.get(name, max(timeouts.values()))
+
+
+def run_probes(probes, timeouts=None, timings=None):
+    """
+    Run independent probes concurrently, each in its own thread
+    :param probes: dict of probe name -> callable
+    :param timeouts: dict of probe name -> seconds to wait for it, PROBE_TIMEOUTS by default
+    :param timings: Timings to record a span per probe to
+    :return: dict of probe name -> result, None if probe failed or didn't finish in time
+    """
+    if timings is None:
+        timings = Timings()
+    results = {}
+
+    def run(name, probe):
+        try:
+            with timings.span(name):
+                results[name] = probe()
+        except Exception:
+            pass
+
+    started = time.time()
+    threads = []
+    for name, probe in probes.items():
+        t = threading.Thread(target=run, args=(name, probe))
+        # probe that didn't finish in time must not keep the process alive
+        t.daemon = True
+        t.start()
+        threads.append((name, t))
+    for name, t in threads:
+        t.join(max(0, started + probe_timeout(timeouts, name) - time.time()))
+        if t.is_alive():
+            timings.timed_out(name)
+    return dict((name, results.get(name)) for name in probes)
+
+
+class _DecompressingReader(io.RawIOBase):
+    """
+    Raw binary stream of file decompressed by decompressor object, for formats without a file class of their own
+    """
+
+    def __init__(self, f, decompressor):
+        self.f = f
+        self.decompressor = decompressor
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.pending:
+            chunk = self.f.read(METADATA_CHUNK)
+            if not chunk:
+                return 0
+            self.pending = self.decompressor.decompress(chunk)
+        size = min(len(buf), len(self.pending))
+        buf[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.f.close()
+        io.RawIOBase.close(self)
+
+
+def open_metadata(path):
+    """
+    Open package metadata file, decompressing it on the fly if needed
+    :return: binary file object
+    :raises ImportError: there is no module for its compression, e.g. zstd before python 3.14
+    """
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(path, 'rb')
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.open(path, 'rb')
+    if path.endswith('.zst'):
+        decompressor = _zstd_decompressor()
+        return io.BufferedReader(_DecompressingReader(open(path, 'rb'), decompressor))
+    if path.endswith('.lz4'):
+        import lz4.frame
+        return lz4.frame.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def metadata_readable(path):
+    """
+    :return: False if metadata is compressed with a format there is no module for, then package manager
+        has to read it instead
+    """
+    try:
+        open_metadata(path).close()
+    except ImportError:
+        return False
+    except (IOError, OSError):
+        pass
+    return True
+
+
+def metadata_age(paths):
+    """
+    :param paths: metadata files
+    :return: seconds since the files or their directories were last updated, None if there are no files
+    """
+    mtimes = []
+    for path in paths:
+        for name in (path, os.path.dirname(path)):
+            try:
+                mtimes.append(os.stat(name).st_mtime)
+            except OSError:
+                pass
+    if not mtimes:
+        return None
+    return time.time() - max(mtimes)
+
+
+def metadata_is_fresh(paths, max_age):
+    age = metadata_age(paths)
+    return age is not None and age <= max_age
+
+
+def read_apt_packages(paths, name_re):
+    """
+    Stream apt Packages indexes
+    :param paths: Packages files from /var/lib/apt/lists
+    :param name_re: compiled regex that package names should match
+    :return: generator of matching package names
+    """
+    for path in paths:
+        try:
+            f = open_metadata(path)
+        except (IOError, OSError, ImportError):
+            continue
+        try:
+            for line in f:
+                if line.startswith(b'Package:'):
+                    name = line[8:].strip().decode('utf-8', 'replace')
+                    if name_re.match(name):
+                        yield name
+        except (IOError, OSError, EOFError):
+            pass
+        finally:
+            f.close()
+
+
+def read_repo_packages(paths, name, arch):
+    """
+    Read versions of a package from yum/dnf repository metadata, primary sqlite databases or primary.xml files
+    :param paths: metadata files
+    :return: generator of (epoch, version, release) tuples
+    """
+    for path in paths:
+        try:
+            if path.endswith('.sqlite'):
+                for evr in _read_primary_sqlite(path, name, arch):
+                    yield evr
+            elif '.xml' in path:
+                for evr in _read_primary_xml(path, name, arch):
+                    yield evr
+        except Exception:
+            # unreadable or unsupported metadata of a single repository
+            continue
+
+
+def _read_primary_sqlite(path, name, arch):
+    import sqlite3
+    conn = sqlite3.connect(path)
+    try:
+        for row in conn.execute('SELECT epoch, version, release FROM packages WHERE name = ? AND arch = ?',
+                                (name, arch)):
+            yield tuple(row)
+    finally:
+        conn.close()
+
+
+def _read_primary_xml(path, name, arch):
+    from xml.etree.ElementTree import iterparse
+    f = open_metadata(path)
+    try:
+        for event, elem in iterparse(f):
+            if elem.tag != REPO_XML_NS + 'package':
+                continue
+            if elem.findtext(REPO_XML_NS + 'name') == name and elem.findtext(REPO_XML_NS + 'arch') == arch:
+                version = elem.find(REPO_XML_NS + 'version')
+                yield (version.get('epoch'), version.get('ver'), version.get('rel'))
+            elem.clear()
+    finally:
+        f.close()
+
+
+def read_dpkg_status(path, pattern):
+    """
+    Stream dpkg status database stanza by stanza
+    :param path: usually /var/lib/dpkg/status
+    :param pattern: compiled regex, or shell-style pattern, that package names should match
+    :return: generator of names of installed packages
+    """
+    if not hasattr(pattern, 'match'):
+        from fnmatch import translate
+        pattern = re.compile(translate(pattern))
+    name = status = None
+    with open(path, 'rb') as f:
+        for line in itertools.chain(f, [b'\n']):
+            if line.startswith(b'Package:'):
+                name = line[8:].strip().decode('utf-8', 'replace')
+            elif line.startswith(b'Status:'):
+                status = line[7:].split()
+            elif not line.strip():
+                if name and status and status[-1] == b'installed' and pattern.match(name):
+                    yield name
+                name = status = None
+
+
+def parse_rpm_header(blob, tags):
+    """
+    Parse rpm header as stored in rpmdb: index length, data length, index entries, data store
+    :param tags: tags to extract, only STRING and INT32 ones are supported
+    :return: dict of tag -> value
+    """
+    import struct
+    il, dl = struct.unpack('>ii', blob[:8])
+    store = 8 + il * 16
+    result = {}
+    for i in range(il):
+        tag, type_, offset, count = struct.unpack('>iiii', blob[8 + i * 16:24 + i * 16])
+        if tag not in tags:
+            continue
+        if type_ == 6:  # RPM_STRING_TYPE
+            end = blob.index(b'\0', store + offset)
+            result[tag] = blob[store + offset:end].decode('utf-8', 'replace')
+        elif type_ == 4:  # RPM_INT32_TYPE
+            result[tag] = struct.unpack('>i', blob[store + offset:store + offset + 4])[0]
+    return result
+
+
+def read_rpmdb_sqlite(path, name):
+    """
+    Read headers of installed packages from sqlite rpmdb (rpm >= 4.16)
+    :return: list of (epoch, version, release, arch) tuples
+    """
+    import sqlite3
+    try:
+        conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    except TypeError:
+        conn = sqlite3.connect(path)
+    try:
+        result = []
+        query = 'SELECT blob FROM Packages WHERE hnum IN (SELECT hnum FROM Name WHERE key = ?)'
+        for blob, in conn.execute(query, (name,)):
+            header = parse_rpm_header(bytes(blob), (RPMTAG_VERSION, RPMTAG_RELEASE, RPMTAG_EPOCH, RPMTAG_ARCH))
+            result.append((header.get(RPMTAG_EPOCH), header.get(RPMTAG_VERSION),
+                           header.get(RPMTAG_RELEASE), header.get(RPMTAG_ARCH)))
+        return result
+    finally:
+        conn.close()
+
+
+def package_bindings(name):
+    """
+    :param name: one of PACKAGE_BINDINGS
+    :return: python bindings module of package manager, None if they are not installed or disabled
+    """
+    if name not in PACKAGE_BINDINGS:
+        return None
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def read_rpm_bindings(rpm, name, root=None):
+    """
+    Read installed packages with rpm python bindings, from any rpmdb format
+    :param rpm: rpm module
+    :return: list of (epoch, version, release, arch) tuples
+    """
+    ts = rpm.TransactionSet(root or '/')
+    # headers are read, not installed, no need to verify them
+    ts.setVSFlags(getattr(rpm, '_RPMVSF_NOSIGNATURES', 0) | getattr(rpm, '_RPMVSF_NODIGESTS', 0))
+    result = []
+    for header in ts.dbMatch('name', name):
+        result.append((header['epoch'], _text(header['version']), _text(header['release']), _text(header['arch'])))
+    return result
+
+
+def read_apt_cache(apt_pkg, name_re, installed=False):
+    """
+    Look packages up in apt package cache (pkgcache.bin) with apt python bindings
+    :param apt_pkg: apt_pkg module
+    :param name_re: compiled regex that package names should match
+    :param installed: only installed packages, instead of all available ones
+    :return: generator of matching package names
+    """
+    apt_pkg.init()
+    cache = apt_pkg.Cache(None)
+    for package in cache.packages:
+        if not name_re.match(package.name):
+            continue
+        if package.current_ver if installed else package.has_versions:
+            yield package.name
+
+
+class PackageRecord(object):
+    """
+    Kernel package: name, epoch, version, release, flavor and arch, unknown ones are None.
+    flavor tells kernels of a distribution apart, e.g. rt of kernel-rt or aws of linux-image-5.15.0-1019-aws,
+    it is empty for plain kernels. Debian package versions are those of the kernel in their names,
+    e.g. version 5.15.0, release 91 and flavor generic of linux-image-5.15.0-91-generic
+    """
+    __slots__ = ('name', 'epoch', 'version', 'release', 'flavor', 'arch')
+
+    def __init__(self, name, epoch, version, release, flavor='', arch=None):
+        self.name = name
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+        self.flavor = flavor
+        self.arch = arch
+
+    def astuple(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, PackageRecord) and self.astuple() == other.astuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return 'PackageRecord(%s)' % ', '.join(repr(value) for value in self.astuple())
+
+
+def deb_package_record(name):
+    """
+    :param name: debian package name, e.g. linux-image-5.15.0-91-generic
+    :return: PackageRecord, None if it is not a kernel image package
+    """
+    match = DEB_KERNEL_RE.match(name)
+    if match is None:
+        return None
+    return PackageRecord(name, None, match.group('version'), match.group('release'), match.group('flavor') or '')
+
+
+def rpm_package_record(name, epoch, version, release, arch=None):
+    """
+    :return: PackageRecord, None if name is not of a kernel package, e.g. kernel-devel
+    """
+    match = RPM_KERNEL_RE.match(name)
+    if match is None or match.group('subpackage'):
+        return None
+    return PackageRecord(name, epoch, version, release, match.group('flavor') or '', arch)
+
+
+def parse_packages(lines, fmt, name=None):
+    """
+    Turn package manager output into kernel PackageRecords in a single pass, line by line.
+    Lines of other packages, headers and messages are skipped
+    :param lines: iterable of output lines
+    :param fmt: 'rpm' for [epoch:]version-release lines of rpm --queryformat, all of package name;
+        'yum' for yum list lines: name.arch [epoch:]version-release repository;
+        'deb' for lines starting with debian package name: dpkg-query -W, apt-cache search or just names
+    :return: generator of PackageRecord
+    """
+    pending = ''
+    for line in lines:
+        if fmt == 'deb':
+            package, tab, version = line.partition('\t')
+            # dpkg-query lists packages it knows of, but that are not installed, with empty version
+            if tab and not version.strip():
+                continue
+            record = deb_package_record(package.split(' ', 1)[0].strip())
+        elif fmt == 'yum':
+            if pending:
+                line, pending = pending + ' ' + line, ''
+            match = YUM_LINE_RE.match(line)
+            if match is None:
+                # names too long for the column are printed on a line of their own
+                if len(line.split()) == 1 and '.' in line:
+                    pending = line.strip()
+                continue
+            package, arch, epoch, version, release = match.groups()
+            record = rpm_package_record(package, epoch, version, release, arch)
+        else:
+            match = RPM_EVR_RE.match(line)
+            if match is None:
+                continue
+            record = PackageRecord(name, match.group(1), match.group(2), match.group(3))
+        if record is not None:
+            yield record
+
+
+class PackageQuery(object):
+    """
+    Package manager command a query has to run, and parse(output) returning the result or the next PackageQuery.
+    Handlers return it instead of running commands, so that they can be run synchronously or asynchronously
+    """
+
+    def __init__(self, command, parse):
+        self.command = command
+        self.parse = parse
+
+
+def run_query(result, timeout=None):
+    """
+    :param result: result of package query, or PackageQuery to run commands for it
+    :param timeout: seconds to wait for all the commands, the one running after that is killed
+    :return: result
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while isinstance(result, PackageQuery):
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        result = result.parse(check_output(result.command, remaining))
+    return result
+
+
+class RpmHandler:
+    def __init__(self, current_version, max_metadata_age=METADATA_MAX_AGE, cache_dir=None, root=None):
+        """
+        :param max_metadata_age: seconds, refresh repository metadata with yum if it is older
+        :param cache_dir: where to keep installed kernels between runs, None to always read them
+        :param root: system image to query instead of the live host, its metadata is never refreshed
+        """
+        match = RPM_RELEASE_FLAVOR_RE.search(current_version)
+        self.kernel_name = match.lastgroup.replace('_', '-') if match else 'kernel'
+        self.max_metadata_age = max_metadata_age
+        self.cache_dir = cache_dir
+        self.root = root
+
+    def get_installed(self, timeout=None):
+        return run_query(self.query_installed(), timeout)
+
+    def query_installed(self):
+        """
+        :return: installed versions, or PackageQuery to run for them
+        """
+        for path in RPMDB_SQLITE:
+            path = in_root(self.root, path)
+            if os.path.exists(path):
+                try:
+                    return cached_by_signature([path, path + '-wal'], 'rpm:' + self.kernel_name,
+                                               lambda: self.read_installed(path), self.cache_dir)
+                except Exception:
+                    # locked, corrupted or unknown format, let rpm deal with it
+                    break
+        rpm = package_bindings('rpm')
+        if rpm is not None:
+            try:
+                return self.parse_installed(read_rpm_bindings(rpm, self.kernel_name, self.root))
+            except Exception:
+                pass
+        command = ['rpm', '--queryformat=%{VERSION}-%{RELEASE}\n', '-qq', self.kernel_name]
+        if self.root:
+            command[1:1] = ['--root', self.root]
+        return PackageQuery(command, RpmHandler.parse_rpm_output)
+
+    @staticmethod
+    def parse_rpm_output(output):
+        return RpmHandler.versions(parse_packages(output.splitlines(), 'rpm'))
+
+    @staticmethod
+    def versions(records):
+        """
+        :param records: PackageRecords
+        :return: short versions of the packages, see strip_version
+        """
+        return [RpmHandler.strip_version('%s-%s' % (record.version, record.release)) for record in records]
+
+    def read_installed(self, rpmdb):
+        return self.parse_installed(read_rpmdb_sqlite(rpmdb, self.kernel_name))
+
+    @staticmethod
+    def parse_installed(packages):
+        """
+        :param packages: (epoch, version, release, arch) tuples
+        """
+        return RpmHandler.versions(PackageRecord(None, epoch, version, release, arch=arch)
+                                   for epoch, version, release, arch in packages if version and release)
+
+    def get_available(self, timeout=None):
+        return run_query(self.query_available(), timeout)
+
+    def query_available(self):
+        """
+        :return: versions in repositories, installed ones included, None if unknown, or PackageQuery to run
+            for them
+        """
+        paths = self.metadata_paths()
+        if paths is None:
+            return None if self.root else self.list_available()
+        if metadata_is_fresh(paths, self.max_metadata_age) or (self.root and paths):
+            return self.read_available(paths)
+        if self.root:
+            return None
+        return PackageQuery(['yum', 'makecache'], lambda output: self.search_updated())
+
+    def metadata_paths(self):
+        """
+        :return: repository metadata files, None if some of them can't be read here, e.g. zstd compressed ones
+            of current dnf: skipping them would miss kernels of their repositories
+        """
+        paths = []
+        for pattern in RPM_METADATA_GLOBS:
+            paths.extend(glob.glob(in_root(self.root, pattern)))
+        if not all(metadata_readable(path) for path in paths):
+            return None
+        return paths
+
+    def read_available(self, paths):
+        return sorted(set(self.versions(PackageRecord(self.kernel_name, epoch, version, release)
+                                        for epoch, version, release in
+                                        read_repo_packages(paths, self.kernel_name, platform.machine()))))
+
+    def search_updated(self):
+        """
+        :return: versions from repository metadata just refreshed, or PackageQuery to run for them
+        """
+        paths = self.metadata_paths()
+        if paths:
+            return self.read_available(paths)
+        # metadata is kept where it isn't looked for or can't be read here
+        return self.list_available()
+
+    def list_available(self):
+        """
+        :return: PackageQuery listing versions in repositories, yum lists installed versions along with them
+        """
+        return PackageQuery(['yum', '--showduplicates', 'list', self.kernel_name], self.parse_yum_output)
+
+    def parse_yum_output(self, output):
+        return sorted(set(self.versions(record for record in parse_packages(output.splitlines(), 'yum')
+                                        if record.name == self.kernel_name)))
+
+    @staticmethod
+    def strip_version(version):
+        """
+        :param version: [epoch:]version-release[.arch], e.g. 1:3.10.0-1160.2.1.el7.x86_64
+        :return: version-release up to the first non-numeric part of release, e.g. 3.10.0-1160.2.1
+        """
+        return RPM_SHORT_VERSION_RE.match(version).group(1)
+
+
+class DpkgHandler:
+    def __init__(self, current_version, max_metadata_age=METADATA_MAX_AGE, cache_dir=None, root=None):
+        """
+        :param max_metadata_age: seconds, refresh package lists with apt-get update if they are older
+        :param cache_dir: where to keep installed kernels between runs, None to always read them
+        :param root: system image to query instead of the live host, its package lists are never refreshed
+        """
+        current = deb_package_record(DEB_KERNEL_PREFIXES[0] + '-' + current_version)
+        if current is not None:
+            self.pkg_version, self.flavor = current.version, current.flavor
+        else:
+            # custom kernel, without abi number
+            parts = current_version.split('-')
+            self.pkg_version, self.flavor = parts[0], '-'.join(parts[1:])
+        # kernels of the same major.minor series and of any flavor, the flavor is told by the parser.
+        # Proxmox bumps patch level with every update, debian distributions keep it. The regex is a posix
+        # extended one as well, for apt-cache search
+        self.series = '.'.join(self.pkg_version.split('.')[:2])
+        self.pattern = '^(%s)-%s(\\.[0-9]+)*-' % ('|'.join(DEB_KERNEL_PREFIXES), re.escape(self.series))
+        self.name_re = re.compile(self.pattern)
+        self.max_metadata_age = max_metadata_age
+        self.cache_dir = cache_dir
+        self.root = root
+
+    def parse_output(self, output):
+        return self.filter_versions(output.splitlines())
+
+    def filter_versions(self, lines):
+        """
+        :param lines: package names, or lines of dpkg-query -W or apt-cache search output
+        :return: kernel releases of packages of the running kernel's series and flavor, e.g. 5.15.0-91-generic
+        """
+        result = []
+        for record in parse_packages(lines, 'deb'):
+            if record.flavor == self.flavor and self.name_re.match(record.name):
+                version = '-'.join(part for part in (record.version, record.release, record.flavor) if part)
+                # signed and unsigned packages of the same kernel
+                if version not in result:
+                    result.append(version)
+        return result
+
+    def get_installed(self, timeout=None):
+        return run_query(self.query_installed(), timeout)
+
+    def query_installed(self):
+        """
+        :return: installed versions, or PackageQuery to run for them
+        """
+        status = in_root(self.root, DPKG_STATUS)
+        if os.path.exists(status):
+            return cached_by_signature([status], 'dpkg:%s:%s' % (self.pattern, self.flavor),
+                                       lambda: self.filter_versions(read_dpkg_status(status, self.name_re)),
+                                       self.cache_dir)
+        patterns = ['%s-%s.*' % (prefix, self.series) for prefix in DEB_KERNEL_PREFIXES]
+        if self.root:
+            return PackageQuery(['dpkg-query', '--admindir=' + os.path.dirname(status), '-W'] + patterns,
+                                self.parse_output)
+        names = self.read_apt_cache(self.pattern, installed=True)
+        if names is not None:
+            return names
+        return PackageQuery(['dpkg-query', '-W'] + patterns, self.parse_output)
+
+    def get_available(self, timeout=None):
+        return run_query(self.query_available(), timeout)
+
+    def query_available(self):
+        """
+        :return: available versions, None if unknown, or PackageQuery to run for them
+        """
+        lists_dir = in_root(self.root, APT_LISTS_DIR)
+        paths = glob.glob(os.path.join(lists_dir, '*_Packages')) + \
+            glob.glob(os.path.join(lists_dir, '*_Packages.*'))
+        if not all(metadata_readable(path) for path in paths):
+            # e.g. lz4 compressed lists, apt reads them itself; skipping them would miss their kernels
+            return None if self.root else self.search_updated()
+        if metadata_is_fresh(paths, self.max_metadata_age) or (self.root and paths):
+            names = set(read_apt_packages(paths, self.name_re))
+            return self.filter_versions(sorted(names))
+        if self.root:
+            return None
+        return PackageQuery(['apt-get', 'update'], lambda output: self.search_updated())
+
+    def search_updated(self):
+        """
+        :return: versions from package lists just updated, or PackageQuery to run for them
+        """
+        names = self.read_apt_cache(self.pattern)
+        if names is not None:
+            return names
+        return PackageQuery(['apt-cache', 'search', '--names-only', self.pattern], self.parse_output)
+
+    def read_apt_cache(self, pattern, installed=False):
+        """
+        :param pattern: regex that package names should match
+        :return: filtered versions of matching packages, None if apt bindings are not installed or failed
+        """
+        apt_pkg = package_bindings('apt_pkg')
+        if apt_pkg is None:
+            return None
+        try:
+            return self.filter_versions(sorted(read_apt_cache(apt_pkg, re.compile(pattern), installed)))
+        except Exception:
+            return None
+
+
+class UnknownHandler:
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get_installed(timeout=None):
+        return []
+
+    @staticmethod
+    def get_available(timeout=None):
+        return []
+
+
+# kernel images, named by their releases
+BOOT_IMAGES = '/boot/vmlinuz-*'
+# linux_banner, the same string as /proc/version of the booted kernel
+BANNER_PATTERN = br'Linux version \d[\x20-\x7e]{8,1024}\n'
+BANNER_MAX = 1100
+# compressed bytes decompressed at a time while looking for the banner
+BANNER_CHUNK = 256 * 1024
+# payloads of each compression tried, magics of the others are usually false positives
+BANNER_CANDIDATES = 8
+
+
+def _zstd_decompressor():
+    try:
+        from compression import zstd
+        return zstd.ZstdDecompressor()
+    except ImportError:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _payload_decompressors():
+    """
+    :return: list of (magic, function returning new decompressor object), for available modules only
+    """
+    import zlib
+    result = [(b'\x1f\x8b\x08', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))]
+    try:
+        import lzma
+        result.append((b'\xfd7zXZ\x00', lzma.LZMADecompressor))
+    except ImportError:
+        pass
+    try:
+        import bz2
+        result.append((b'BZh', bz2.BZ2Decompressor))
+    except ImportError:
+        pass
+    try:
+        _zstd_decompressor()
+        result.append((b'\x28\xb5\x2f\xfd', _zstd_decompressor))
+    except ImportError:
+        pass
+    return result
+
+
+def _scan_payload(data, offset, decompressor, banner_re):
+    """
+    Decompress payload chunk by chunk, stopping as soon as the banner is found
+    :return: banner or None
+    """
+    tail = b''
+    while offset < len(data):
+        chunk = decompressor.decompress(data[offset:offset + BANNER_CHUNK])
+        offset += BANNER_CHUNK
+        if not chunk:
+            if getattr(decompressor, 'eof', False):
+                return None
+            continue
+        buf = tail + chunk
+        match = banner_re.search(buf)
+        if match:
+            return match.group(0)
+        tail = buf[-BANNER_MAX:]
+    return None
+
+
+def read_kernel_banner(path):
+    """
+    Find kernel banner, the same string as /proc/version of the kernel booted from the image.
+    The image is memory mapped and scanned as is, then its compressed payloads are decompressed until the banner
+    :param path: kernel image, e.g. /boot/vmlinuz-5.14.0-70.el9.x86_64
+    :return: banner bytes
+    """
+    import mmap
+    import re
+    banner_re = re.compile(BANNER_PATTERN)
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise IOError('no kernel banner found in %s' % path)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        match = banner_re.search(data)
+        if match:
+            return match.group(0)
+        candidates = []
+        for magic, decompressor in _payload_decompressors():
+            offset = data.find(magic)
+            for _ in range(BANNER_CANDIDATES):
+                if offset < 0:
+                    break
+                candidates.append((offset, decompressor))
+                offset = data.find(magic, offset + 1)
+        for offset, decompressor in sorted(candidates, key=lambda candidate: candidate[0]):
+            try:
+                banner = _scan_payload(data, offset, decompressor(), banner_re)
+            except Exception:
+                # not a real payload, or corrupted one
+                continue
+            if banner:
+                return banner
+    finally:
+        data.close()
+    raise IOError('no kernel banner found in %s' % path)
+
+
+class lazy_result(object):
+    """
+    KernelChecker attribute computed by the decorated method on first access, and memoized until refresh().
+    Assigning the attribute overrides it
+    """
+
+    def __init__(self, compute):
+        self.compute = compute
+        self.name = compute.__name__
+        self.__doc__ = compute.__doc__
+
+    def __get__(self, checker, owner):
+        if checker is None:
+            return self
+        try:
+            return checker.results[self.name]
+        except KeyError:
+            value = checker.results[self.name] = self.compute(checker)
+            return value
+
+    def __set__(self, checker, value):
+        checker.results[self.name] = value
+
+
+class KernelChecker:
+    """
+    This class performs checks to determine if kernel update & reboot needed
+    """
+
+    def __init__(self, cache=None, timeouts=None, max_metadata_age=METADATA_MAX_AGE, index=None, client=None,
+                 root=None, lazy=False):
+        """
+        Package queries, patches server request and kcarectl run concurrently.
+        Results of probes that didn't finish in time are None
+        :param cache: CompatCache for KernelCare support answers, None to always ask patches server
+        :param timeouts: dict of probe name -> seconds, see PROBE_TIMEOUTS
+        :param max_metadata_age: seconds, refresh repository metadata if it is older
+        :param index: CompatIndex to look KernelCare support up in instead of asking patches server
+        :param client: ProbeClient to ask patches server with
+        :param root: mount point of system image or chroot to check instead of the live host.
+            Its current kernel is the newest one in /lib/modules, kcarectl is not run there
+        :param lazy: don't check anything yet, compute each result when it is first accessed, running only
+            the probes it depends on, e.g. inside_container needs none and needs_update only package queries
+        """
+        self.lazy = lazy
+        self.cache = cache
+        self.timeouts = timeouts
+        self.max_metadata_age = max_metadata_age
+        self.index = index
+        self.client = client
+        self.root = root
+        self.refresh()
+
+    def refresh(self):
+        """
+        Forget all results, and compute them again: right away, or on access if lazy
+        """
+        self.results = {}
+        self.timings = Timings()
+        if self.lazy:
+            return
+        with self.timings.span('total'):
+            # cheap, and fail early if the kernel can't be found
+            for name in ('current_version', 'inside_container'):
+                getattr(self, name)
+            probes = self.probes()
+            for name, result in run_probes(probes, self.timeouts, self.timings).items():
+                self.results['probe:' + name] = result
+
+    def probes(self):
+        """
+        :return: dict of probe name -> function, of all probes this check runs
+        """
+        timeout = lambda name: probe_timeout(self.timeouts, name)
+        # commands of probes that didn't finish in time are killed, not left holding package manager locks
+        probes = {
+            'installed': lambda: self.handler.get_installed(timeout('installed')),
+            'available': lambda: self.handler.get_available(timeout('available')),
+            'supported': lambda: KernelChecker.is_kernelcare_supported_kernel(self.cache, self.index, self.client,
+                                                                              self.facts),
+        }
+        if self.kcare_installed and not self.root:
+            probes['kcarectl'] = lambda: KernelChecker.is_kernelcare_up2date(timeout('kcarectl'), self.facts)
+        return probes
+
+    def run_pending(self, *names):
+        """
+        Run those of the probes that didn't run yet, concurrently
+        """
+        probes = self.probes()
+        pending = dict((name, probes[name]) for name in names
+                       if name in probes and 'probe:' + name not in self.results)
+        if pending:
+            for name, result in run_probes(pending, self.timeouts, self.timings).items():
+                self.results['probe:' + name] = result
+
+    def probe(self, name):
+        """
+        :return: result of probe, run now unless it already ran; None if it failed, didn't finish in time
+            or isn't run for this host
+        """
+        self.run_pending(name)
+        return self.results.get('probe:' + name)
+
+    @lazy_result
+    def facts(self):
+        return HostFacts(self.root)
+
+    @lazy_result
+    def distro_type(self):
+        return KernelChecker.get_distro_type(self.facts)
+
+    @lazy_result
+    def version_key(self):
+        if self.distro_type == "dpkg":
+            return memoize_key(dpkg_version_key)
+        return memoize_key(rpm_evr_key)
+
+    @lazy_result
+    def release(self):
+        """
+        Release of running kernel, or of the one system image boots by default
+        """
+        return self.facts.kernel_release or KernelChecker.get_root_release(self.root, self.version_key)
+
+    @lazy_result
+    def handler(self):
+        cache_dir = None
+        if self.cache is not None:
+            cache_dir = os.path.dirname(self.cache.path)
+        if self.distro_type == "rpm":
+            return RpmHandler(self.release, self.max_metadata_age, cache_dir, self.root)
+        elif self.distro_type == "dpkg":
+            return DpkgHandler(self.release, self.max_metadata_age, cache_dir, self.root)
+        return UnknownHandler()
+
+    @lazy_result
+    def current_version(self):
+        if self.distro_type == "rpm":
+            return RpmHandler.strip_version(self.release)
+        return self.release
+
+    @lazy_result
+    def inside_container(self):
+        # system image is not running anywhere, so it is not inside a container either
+        return not self.root and self.facts.container is not None
+
+    @lazy_result
+    def installed_versions(self):
+        return self.sort_versions(self.probe('installed'))
+
+    @lazy_result
+    def available_versions(self):
+        return self.sort_versions(self.probe('available'))
+
+    @lazy_result
+    def latest_version(self):
+        # needs both package queries, run them at once
+        self.run_pending('installed', 'available')
+        return self.get_latest()
+
+    @lazy_result
+    def needs_update(self):
+        """
+        None if the latest version is unknown
+        """
+        if self.latest_version is None:
+            return None
+        return self.latest_version != self.current_version
+
+    @lazy_result
+    def latest_installed(self):
+        latest = self.latest_version
+        return KernelChecker.contains(self.installed_versions, latest)
+
+    @lazy_result
+    def latest_available(self):
+        latest = self.latest_version
+        return KernelChecker.contains(self.available_versions, latest)
+
+    @lazy_result
+    def kcare_installed(self):
+        return os.path.exists(in_root(self.root, KCARE_BIN))
+
+    @lazy_result
+    def kernelcare(self):
+        """
+        (INSTALLED, UP2DATE, SUPPORTED)
+        """
+        self.run_pending('kcarectl', 'supported')
+        if self.kcare_installed:
+            return (True, self.probe('kcarectl'), self.probe('supported'))
+        return (False, False, self.probe('supported'))
+
+    @staticmethod
+    def contains(versions, version):
+        """
+        :return: True/False, or None if versions or version are unknown
+        """
+        if versions is None or version is None:
+            return None
+        return version in versions
+
+    @staticmethod
+    def get_kernel_hash(facts=None):
+        return (facts or HostFacts()).kernel_hash
+
+    @staticmethod
+    def is_kernelcare_supported_kernel(cache=None, index=None, client=None, facts=None, kernel_hash=None):
+        """
+        :param client: ProbeClient to ask patches server with, default one if None
+        :param facts: HostFacts of the host or system image to check, the live host if None
+        :param kernel_hash: hash of another kernel to check instead, see read_kernel_banner
+        :return: True/False, or None if patches server didn't give an answer
+        """
+        if kernel_hash is None:
+            kernel_hash = KernelChecker.get_kernel_hash(facts)
+        if index is not None:
+            return kernel_hash in index
+        validators = None
+        if cache is not None:
+            result = cache.get(kernel_hash)
+            if result is not None:
+                return result
+            validators = cache.validators(kernel_hash)
+        client = client or ProbeClient()
+        try:
+            result = client.check(kernel_hash, validators)
+        except (HTTPError, URLError):
+            # don't remember answers for network errors
+            return None
+        if cache is not None:
+            # 304 answers have no validators of their own, the old ones stay valid
+            cache.put(kernel_hash, result, result and (client.answer_validators(kernel_hash) or validators) or None)
+            cache.save()
+        return result
+
+    @staticmethod
+    def is_kernelcare_up2date(timeout=PROBE_TIMEOUTS['kcarectl'], facts=None):
+        """
+        Read patch levels from KernelCare state, or run kcarectl --check if the state doesn't tell
+        :param timeout: seconds to wait for kcarectl
+        :return: True/False, or None if kcarectl didn't finish in time
+        """
+        state = KernelChecker.kernelcare_state(facts or HostFacts())
+        if state is not None:
+            return state
+        rc = run_command([KCARE_BIN, '--check'], timeout)
+        if rc is None:
+            return None
+        return rc == 1
+
+    @staticmethod
+    def kernelcare_state(facts, max_age=KCARE_STATE_MAX_AGE):
+        """
+        Compare loaded patch level with the newest patches downloaded by kcarectl, without running it
+        :param max_age: seconds, downloads older than that can't tell the kernel is up to date
+        :return: True/False, or None if the state is missing or too old
+        """
+        level = None
+        for line in facts.read(KCARE_INFO).splitlines():
+            key, _, value = line.partition(':')
+            if key.strip() == 'kpatch-level':
+                level = value.strip()
+        if not level or not level.isdigit():
+            return None
+        try:
+            prefix = facts.kernel_hash + '-'
+            downloaded = os.stat(KCARE_PATCHES_DIR).st_mtime
+            levels = [int(name[len(prefix):]) for name in os.listdir(KCARE_PATCHES_DIR)
+                      if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        except (IOError, OSError):
+            return None
+        if not levels:
+            return None
+        if max(levels) > int(level):
+            return False
+        if time.time() - downloaded > max_age:
+            return None
+        return True
+
+    @staticmethod
+    def get_version(fullname):
+        """
+        :param fullname: kernel package name with version, e.g. kernel-ml-6.5.7-1.el8 or linux-image-5.15.0-91-generic
+        :return: version of the package, e.g. 6.5.7-1.el8 or 5.15.0-91-generic, None if it is not a kernel package
+        """
+        record = deb_package_record(fullname)
+        if record is not None:
+            return '-'.join(part for part in (record.version, record.release, record.flavor) if part)
+        name, _, release = fullname.rpartition('-')
+        name, _, version = name.rpartition('-')
+        if not (name and version and release) or rpm_package_record(name, None, version, release) is None:
+            return None
+        return '%s-%s' % (version, release)
+
+    def sort_versions(self, versions):
+        """
+        :return: versions sorted from oldest to newest, None if versions are unknown
+        """
+        if versions is None:
+            return None
+        return sorted(versions, key=self.version_key)
+
+    def get_latest(self):
+        """
+        Figures out latest kernel version
+        :return: latest version from all versions, None if installed or available versions are unknown:
+            a newer kernel might be among them
+        """
+        if self.installed_versions is None or self.available_versions is None:
+            return None
+        all = [self.current_version] + self.installed_versions + self.available_versions
+        return max(all, key=self.version_key)
+
+    @staticmethod
+    def get_distro_type(facts=None):
+        """
+        :param facts: HostFacts of the host or system image, the live host if None
+        """
+        facts = facts or HostFacts()
+        names = [(facts.distro_id or '').lower()] + [name.lower() for name in facts.distro_like]
+        for name in names:
+            if name in RPM_DISTRO:
+                return "rpm"
+            elif name in DPKG_DISTRO:
+                return "dpkg"
+        if facts.exists('/usr/bin/rpm'):
+            return "rpm"
+        elif facts.exists('/usr/bin/dpkg'):
+            return "dpkg"
+        return "unknown"
+
+    @staticmethod
+    def get_root_release(root, version_key):
+        """
+        :return: release of the newest kernel with modules in system image, the one it boots by default
+        """
+        releases = set()
+        for path in ('/lib/modules', '/usr/lib/modules'):
+            try:
+                releases.update(os.listdir(in_root(root, path)))
+            except OSError:
+                pass
+        if not releases:
+            raise IOError('no kernels found in %s' % in_root(root, '/lib/modules'))
+        return max(releases, key=version_key)
+
+    @staticmethod
+    def inside_vz_container():
+        """
+        determines if we are inside Virtuozzo container
+        :return: True if inside container, false otherwise
+        """
+        return HostFacts().inside_openvz
+
+    @staticmethod
+    def inside_lxc_container():
+        return '/lxc/' in HostFacts().init_cgroup
+
+    def todict(self, timings=False):
+        """
+        :param timings: add timings of all phases
+        :return: results as a record for format_record, fields in output order
+        """
+        import collections
+        (latest, current, distro, needs_update, latest_installed, latest_available, inside_container,
+         kcare_installed, kcare_up2date, kcare_supported) = self.get_data()
+        result = collections.OrderedDict([
+            ('latest', latest),
+            ('current', current),
+            ('distro', distro),
+            ('needs_update', needs_update),
+            ('latest_installed', latest_installed),
+            ('latest_available', latest_available),
+            ('inside_container', inside_container),
+            ('kernelcare', collections.OrderedDict([
+                ('installed', kcare_installed),
+                ('up2date', kcare_up2date),
+                ('supported', kcare_supported),
+            ])),
+        ])
+        if timings:
+            result['timings'] = self.timings.spans
+        return result
+
+    def get_data(self):
+        return (self.latest_version, self.current_version, self.distro_type,
+                self.needs_update, self.latest_installed,
+                self.latest_available, self.inside_container,
+                self.kernelcare[0], self.kernelcare[1], self.kernelcare[2])
+
+    def tojson(self, timings=False):
+        """
+        :param timings: add timings of all phases
+        """
+        return format_record(self.todict(timings), 'json')
+
+    def toyaml(self, timings=False):
+        """
+        :param timings: add timings of all phases
+        """
+        return format_record(self.todict(timings), 'yaml')
+
+
+OUTPUT_FORMATS = ('yaml', 'json', 'jsonl', 'msgpack')
+# plain yaml scalars that would be read back as something else than a string
+YAML_SPECIAL = re.compile(r'^(?:[-+]?(?:\d[\d_]*(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?|[-+]?\.(?:inf|Inf|INF)|'
+                          r'\.(?:nan|NaN|NAN)|~|null|Null|NULL|y|Y|yes|Yes|YES|n|N|no|No|NO|true|True|TRUE|'
+                          r'false|False|FALSE|on|On|ON|off|Off|OFF|)$')
+YAML_PLAIN = re.compile(r'^[A-Za-z0-9_.+/~(][A-Za-z0-9_.+/~()@ -]*$')
+
+
+def yaml_scalar(value):
+    """
+    :return: value as yaml scalar; strings are quoted unless they are plain and unambiguous
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        # kept as before for existing consumers, YAML 1.1 reads True/False as booleans
+        return repr(value)
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if not isinstance(value, (list, dict)) and YAML_PLAIN.match(value) and not YAML_SPECIAL.match(value) \
+            and not value.endswith(' '):
+        return value
+    import json
+    # json strings, lists and objects are valid yaml flow scalars
+    return json.dumps(value)
+
+
+def _yaml_lines(value, indent=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) and item:
+                yield '%s%s :' % (indent, key)
+                for line in _yaml_lines(item, indent + '    '):
+                    yield line
+            else:
+                yield '%s%s : %s' % (indent, key, yaml_scalar(item))
+        return
+    for item in value:
+        if isinstance(item, (dict, list)) and item:
+            lines = list(_yaml_lines(item, indent + '  '))
+        else:
+            lines = [indent + '  ' + yaml_scalar(item)]
+        yield indent + '- ' + lines[0][len(indent) + 2:]
+        for line in lines[1:]:
+            yield line
+
+
+def msgpack_dumps(value):
+    """
+    Minimal msgpack encoder of records: None, bool, int, float, str, bytes, list and dict
+    :return: bytes
+    """
+    import struct
+    if value is None:
+        return b'\xc0'
+    if isinstance(value, bool):
+        return b'\xc3' if value else b'\xc2'
+    if isinstance(value, int):
+        if 0 <= value < 0x80:
+            return struct.pack('>B', value)
+        if -0x20 <= value < 0:
+            return struct.pack('>b', value)
+        if -0x80000000 <= value < 0x100000000:
+            return struct.pack('>Bi', 0xd2, value) if value < 0 else struct.pack('>BI', 0xce, value)
+        return struct.pack('>Bq', 0xd3, value) if value < 0 else struct.pack('>BQ', 0xcf, value)
+    if isinstance(value, float):
+        return struct.pack('>Bd', 0xcb, value)
+    if isinstance(value, (list, tuple)):
+        head = struct.pack('>B', 0x90 | len(value)) if len(value) < 16 else struct.pack('>BI', 0xdd, len(value))
+        return head + b''.join(msgpack_dumps(item) for item in value)
+    if isinstance(value, dict):
+        head = struct.pack('>B', 0x80 | len(value)) if len(value) < 16 else struct.pack('>BI', 0xdf, len(value))
+        return head + b''.join(msgpack_dumps(key) + msgpack_dumps(item) for key, item in value.items())
+    if isinstance(value, bytes):
+        return struct.pack('>BI', 0xc6, len(value)) + value
+    data = value.encode('utf-8')
+    if len(data) < 32:
+        return struct.pack('>B', 0xa0 | len(data)) + data
+    return struct.pack('>BI', 0xdb, len(data)) + data
+
+
+def format_record(record, fmt):
+    """
+    :param record: dict of results, see KernelChecker.todict
+    :param fmt: one of OUTPUT_FORMATS
+    :return: str, without trailing newline, or bytes for msgpack
+    """
+    if fmt == 'msgpack':
+        return msgpack_dumps(record)
+    if fmt == 'yaml':
+        return '\n'.join(_yaml_lines(record)) + '\n'
+    import json
+    if fmt == 'jsonl':
+        return json.dumps(record, separators=(',', ':'))
+    return json.dumps(record)
+
+
+class RecordWriter(object):
+    """
+    Writes records to a stream one at a time, flushing after each, so consumers get them as soon as they are ready.
+    Yaml records are separated as documents, json ones by newlines, msgpack ones need no separator.
+    """
+
+    def __init__(self, fmt, stream=None):
+        import sys
+        self.fmt = fmt
+        self.stream = stream or sys.stdout
+        if fmt == 'msgpack' and stream is None:
+            self.stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        self.count = 0
+
+    def write(self, record):
+        data = format_record(record, self.fmt)
+        if self.fmt == 'yaml' and self.count:
+            data = '---\n' + data
+        elif self.fmt != 'yaml' and self.fmt != 'msgpack':
+            data += '\n'
+        self.stream.write(data)
+        self.stream.flush()
+        self.count += 1
+
+
+def watched_paths(root=None):
+    """
+    :param root: system image to watch the files of instead of the live host
+    :return: files and directories KernelChecker results depend on
+    """
+    paths = ([DPKG_STATUS, APT_LISTS_DIR] + RPMDB_SQLITE + [path + '-wal' for path in RPMDB_SQLITE] +
+             ['/var/lib/rpm/Packages', '/proc/version', KCARE_BIN, KCARE_STATE_DIR, KCARE_PATCHES_DIR])
+    paths = [in_root(root, path) for path in paths + RPM_METADATA_DIRS]
+    # refreshed metadata replaces files in their directories, often under new names
+    for pattern in RPM_METADATA_GLOBS:
+        for path in sorted(glob.glob(in_root(root, pattern))):
+            paths.extend([path, os.path.dirname(path)])
+    return paths
+
+
+class StateWatcher(object):
+    """
+    Detects changes of files by comparing their signatures.
+    inotify on their directories is used to notice changes early, without it files are polled every interval seconds
+    """
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    INOTIFY_MASK = 0x2 | 0x8 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, paths, interval=SERVE_POLL_INTERVAL, use_inotify=True):
+        self.paths = paths
+        self.interval = interval
+        self.signature = file_signature(paths)
+        self.inotify_fd = None
+        if use_inotify:
+            self.inotify_fd = StateWatcher.inotify(paths)
+
+    @staticmethod
+    def inotify(paths):
+        """
+        :return: non-blocking inotify descriptor watching directories of paths, None if inotify is unavailable
+        """
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0o2000000))
+        except (AttributeError, OSError):
+            return None
+        if fd < 0:
+            return None
+        directories = set()
+        for path in paths:
+            directories.add(path if os.path.isdir(path) else os.path.dirname(path))
+        watched = 0
+        for directory in directories:
+            if os.path.isdir(directory) and libc.inotify_add_watch(fd, directory.encode(), StateWatcher.INOTIFY_MASK) >= 0:
+                watched += 1
+        if not watched:
+            os.close(fd)
+            return None
+        return fd
+
+    def drain(self):
+        try:
+            while os.read(self.inotify_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def wait(self, timeout=None):
+        """
+        Block until watched files change, or timeout seconds pass
+        :return: True if files changed, False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            interval = self.interval
+            if deadline is not None:
+                interval = max(0, min(interval, deadline - time.time()))
+            if self.inotify_fd is not None:
+                if select.select([self.inotify_fd], [], [], interval)[0]:
+                    time.sleep(SERVE_SETTLE_TIME)
+                    self.drain()
+            else:
+                time.sleep(interval)
+            signature = file_signature(self.paths)
+            if signature != self.signature:
+                self.signature = signature
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+
+class KernelCheckerService(object):
+    """
+    Keeps KernelChecker results in memory as a ready json response, recomputing them when watched files change,
+    or when they get old: new kernels may be published without any local file changing
+    """
+
+    def __init__(self, factory, watcher, max_age=METADATA_MAX_AGE, retry=RESULT_TTL):
+        """
+        :param factory: function returning new KernelChecker
+        :param watcher: StateWatcher for files results depend on
+        :param max_age: seconds to keep results while files they depend on are unchanged
+        :param retry: seconds to keep results with unknown fields, e.g. patches server was unreachable,
+            or previous results after the check failed
+        """
+        self.factory = factory
+        self.watcher = watcher
+        self.max_age = max_age
+        self.retry = retry
+        self.response = None
+        self.complete = False
+        self.refresh()
+
+    def refresh(self):
+        import json
+        result = self.factory().todict()
+        self.response = (json.dumps(result) + '\n').encode('utf-8')
+        self.complete = None not in list(result.values()) + list(result['kernelcare'].values())
+
+    def watch(self):
+        while True:
+            self.watcher.wait(self.max_age if self.complete else min(self.max_age, self.retry))
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving previous results
+                self.complete = False
+
+    def start(self):
+        t = threading.Thread(target=self.watch)
+        t.daemon = True
+        t.start()
+
+
+def make_server(service, socket_path=None, listen=None):
+    """
+    Create http server returning service results as json on GET /
+    :param socket_path: unix socket to listen on
+    :param listen: (host, port) to listen on instead of unix socket
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn, UnixStreamServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn, UnixStreamServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/':
+                self.send_error(404)
+                return
+            body = service.response
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            return str(self.client_address and self.client_address[0])
+
+        def log_message(self, format, *args):
+            pass
+
+    if listen is not None:
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        return Server(listen, Handler)
+
+    class UnixServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    return UnixServer(socket_path, Handler)
+
+
+def serve(factory, socket_path=SERVE_SOCKET, listen=None, interval=SERVE_POLL_INTERVAL, max_age=METADATA_MAX_AGE):
+    """
+    Run KernelChecker service until interrupted
+    :param max_age: seconds to serve results while files they depend on are unchanged
+    """
+    import signal
+    import sys
+    service = KernelCheckerService(factory, StateWatcher(watched_paths(), interval), max_age)
+    service.start()
+    server = make_server(service, socket_path, listen)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if listen is None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+    return 0
+
+
+def prometheus_label(value):
+    """
+    :param value: label value, None for unknown, same as an empty label
+    """
+    if value is None:
+        value = ''
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_metrics(checker, timestamp, success=True):
+    """
+    :param checker: KernelChecker of the last successful check
+    :param timestamp: time of the last successful check
+    :param success: False if the latest check failed and checker results are stale
+    :return: prometheus text exposition of results; unknown (None) results are left out
+    """
+    result = checker.todict()
+    values = dict(result, **dict(('kernelcare_' + key, value) for key, value in result['kernelcare'].items()))
+    lines = []
+
+    def gauge(name, description, samples):
+        lines.extend(['# HELP kernelchecker_%s %s' % (name, description), '# TYPE kernelchecker_%s gauge' % name])
+        for labels, value in samples:
+            labels = ','.join('%s=%s' % (key, prometheus_label(label)) for key, label in labels)
+            lines.append('kernelchecker_%s%s %s' % (name, labels and '{%s}' % labels, value))
+
+    gauge('info', 'Running and latest kernel, and package manager', [(
+        [('current', result['current']), ('latest', result['latest']), ('distro', result['distro'])], 1)])
+    for key, description in TEXTFILE_GAUGES:
+        if values[key] is not None:
+            gauge(key, description, [([], int(values[key]))])
+    spans = [span for span in checker.timings.spans if span['name'] != 'total']
+    gauge('probe_duration_seconds', 'Wall time of probes that finished in time',
+          [([('probe', span['name'])], span['wall'] / 1000.0) for span in spans if span['wall'] is not None])
+    gauge('probe_timed_out', 'Probe did not finish in time and its results are unknown',
+          [([('probe', span['name'])], int(bool(span.get('timed_out')))) for span in spans])
+    gauge('last_check_success', 'Latest check succeeded', [([], int(success))])
+    gauge('last_success_timestamp_seconds', 'Time of the last successful check', [([], '%.3f' % timestamp)])
+    return '\n'.join(lines) + '\n'
+
+
+def textfile_main(factory, path, interval=None, max_age=METADATA_MAX_AGE):
+    """
+    Write results as gauges to node_exporter textfile collector file, replacing it atomically
+    :param factory: function returning new KernelChecker
+    :param interval: keep running and refresh the file every interval seconds, write it once if None
+    :param max_age: in interval mode, seconds to reuse results while files they depend on are unchanged
+    """
+    import sys
+    signature = file_signature(watched_paths())
+    checker, checked, success = factory(), time.time(), True
+    while True:
+        write_atomic(path, prometheus_metrics(checker, checked, success), TEXTFILE_MODE)
+        if not interval:
+            return 0
+        while True:
+            time.sleep(interval)
+            current = file_signature(watched_paths())
+            if current != signature or time.time() - checked >= max_age:
+                break
+        try:
+            checker, checked, signature, success = factory(), time.time(), current, True
+        except Exception as e:
+            # keep previous results, and try again on the next interval
+            print('kernelchecker: check failed: %s' % e, file=sys.stderr)
+            signature, success = None, False
+
+
+def support_options(options):
+    """
+    :param options: dict of command line options, see parse_args
+    :return: (cache, index, client) to check KernelCare support with
+    """
+    cache = None
+    if not options['no_cache']:
+        cache = CompatCache(options['cache_file'], refresh=options['refresh'])
+    index = None
+    if options['index']:
+        index = CompatIndex(options['index'])
+    return cache, index, ProbeClient(options['server'], retries=options['retries'])
+
+
+def checker_factory(options):
+    """
+    :param options: dict of command line options, see parse_args
+    :return: function creating KernelChecker for a system image root, or for the live host without arguments
+    """
+    cache, index, client = support_options(options)
+    timeouts = None
+    if options['timeout'] is not None:
+        timeouts = dict((name, options['timeout']) for name in PROBE_TIMEOUTS)
+    return lambda root=None: KernelChecker(cache, timeouts, options['max_metadata_age'], index, client, root)
+
+
+_root_factory = None
+
+
+def _init_root_worker(options):
+    global _root_factory
+    _root_factory = checker_factory(options)
+
+
+def _check_root(root):
+    try:
+        return root, _root_factory(root).todict(), None
+    except Exception as e:
+        return root, None, str(e)
+
+
+def check_roots(roots, options, workers=None):
+    """
+    Check system images in a pool of processes
+    :param options: dict of command line options, see parse_args
+    :param workers: number of processes, number of cpus by default
+    :return: generator of (root, todict() results or None, error message or None), in order of completion
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _init_root_worker, (options,))
+    try:
+        for result in pool.imap_unordered(_check_root, roots):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def roots_main(roots, options, workers=None, fmt='jsonl'):
+    """
+    Print one record per system image as soon as it is checked
+    :param fmt: one of OUTPUT_FORMATS
+    :return: 0 if all images were checked, 1 otherwise
+    """
+    writer = RecordWriter(fmt)
+    rc = 0
+    for root, result, error in check_roots(roots, options, workers):
+        if error is not None:
+            result = {'error': error}
+            rc = 1
+        result['root'] = root
+        writer.write(result)
+    return rc
+
+
+def check_boot_kernel(path, cache=None, index=None, client=None):
+    """
+    :param path: kernel image
+    :return: record with release, hash and KernelCare support of the kernel, or error
+    """
+    import hashlib
+    record = {'image': path}
+    try:
+        banner = read_kernel_banner(path)
+    except (IOError, OSError, ValueError) as e:
+        record['error'] = str(e)
+        return record
+    record['release'] = banner.split()[2].decode('utf-8', 'replace')
+    record['hash'] = hashlib.sha1(banner).hexdigest()
+    record['supported'] = KernelChecker.is_kernelcare_supported_kernel(cache, index, client,
+                                                                       kernel_hash=record['hash'])
+    return record
+
+
+def check_boot_kernels(paths, cache=None, index=None, client=None, workers=None):
+    """
+    Check KernelCare support of kernel images concurrently, in a pool of threads:
+    decompression and requests release the GIL
+    :param workers: number of threads, number of images by default
+    :return: generator of check_boot_kernel records, in order of completion
+    """
+    from multiprocessing.pool import ThreadPool
+    if not paths:
+        return
+    pool = ThreadPool(workers or len(paths))
+    try:
+        for record in pool.imap_unordered(lambda path: check_boot_kernel(path, cache, index, client), paths):
+            yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def boot_main(options, root=None, workers=None, fmt='jsonl'):
+    """
+    Print one record per kernel image in /boot as soon as it is checked, marking the running kernel
+    :param root: system image to check the kernels of instead of the live host
+    :return: 0 if all images were checked, 1 otherwise
+    """
+    cache, index, client = support_options(options)
+    running = None
+    if not root:
+        try:
+            running = HostFacts().kernel_hash
+        except (IOError, OSError):
+            pass
+    writer = RecordWriter(fmt)
+    rc = 0
+    for record in check_boot_kernels(sorted(glob.glob(in_root(root, BOOT_IMAGES))), cache, index, client, workers):
+        if 'error' in record:
+            rc = 1
+        else:
+            record['running'] = record['hash'] == running
+        writer.write(record)
+    return rc
 
-    def toyaml(self):
-        result = 'latest : %s\n' \
-                 'current : %s\n' \
-                 'distro : %s\n' \
-                 'needs_update : %r\n' \
-                 'latest_installed : %r\n' \
-                 'latest_available : %r\n' \
-                 'inside_container : %r\n' \
-                 'kernelcare :\n    ' \
-                 'installed : %r\n    up2date : %r\n    supported : %r\n' % self.get_data()
-        return result
 
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Check if kernel update & reboot needed')
+    parser.add_argument('-j', '--json', action='store_const', dest='format', const='json',
+                        help='print results in json instead of yaml, same as --format json')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+                        help='output format: yaml, json, jsonl (compact json, one record per line) or msgpack '
+                             '(default: yaml, jsonl with several --root images)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write cached KernelCare support answers")
+    parser.add_argument('--refresh', action='store_true',
+                        help='ignore cached KernelCare support answers, but store new ones')
+    parser.add_argument('--cache-file', metavar='PATH',
+                        help='compatibility cache location (default: %s)' % os.path.join('<cache dir>', CACHE_FILE))
+    parser.add_argument('--result-ttl', type=float, default=RESULT_TTL, metavar='SECONDS',
+                        help='share results between runs started within SECONDS, only one of concurrent runs '
+                             'checks the host while others wait for its results; 0 to always check '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='report probes that take longer than SECONDS as unknown '
+                             '(default: %s)' % ', '.join('%s %ds' % item for item in sorted(PROBE_TIMEOUTS.items())))
+    parser.add_argument('--max-metadata-age', type=int, default=METADATA_MAX_AGE, metavar='SECONDS',
+                        help='read available kernels from repository metadata downloaded by yum/dnf/apt '
+                             'unless it is older than SECONDS, 0 to always refresh it (default: %(default)s)')
+    parser.add_argument('--index', metavar='PATH',
+                        help='look KernelCare support up in offline compatibility index built by kc-compat.py '
+                             'instead of asking patches server')
+    parser.add_argument('--server', action='append', metavar='URL',
+                        help='patches server or its mirror to ask, host[:port] or http(s) url; repeat to ask '
+                             'several concurrently and take the first answer (default: %s)' % PATCH_SERVER)
+    parser.add_argument('--retries', type=int, default=PROBE_RETRIES, metavar='N',
+                        help='retries of failed patches server requests, with exponential backoff '
+                             '(default: %(default)s)')
+    parser.add_argument('--splay', type=float, default=0, metavar='SECONDS',
+                        help='wait up to SECONDS before checking, the same time on every run of the host '
+                             '(derived from its machine id), so that hosts started by cron at once '
+                             "don't ask patches server all at the same moment; not with --serve")
+    parser.add_argument('--root', nargs='+', metavar='PATH',
+                        help='check system images mounted at PATH instead of the live host; with several '
+                             'images, check them concurrently and print one json line per image')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='processes checking system images (default: number of cpus), '
+                             'or threads checking kernel images with --boot (default: one per image)')
+    parser.add_argument('--boot', action='store_true',
+                        help='check KernelCare support of all kernels in /boot before rebooting into them, '
+                             'print one record per kernel image')
+    parser.add_argument('--timings', action='store_true',
+                        help='add wall and cpu time of every phase and exit codes of commands to results')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save cProfile stats to FILE')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep running and serve results as json over http, recomputing them when '
+                             'package databases, repository metadata or KernelCare state change, or results are '
+                             'older than --max-metadata-age')
+    parser.add_argument('--socket', default=SERVE_SOCKET, metavar='PATH',
+                        help='unix socket to serve results on (default: %(default)s)')
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help='serve results on tcp address instead of unix socket')
+    parser.add_argument('--textfile', metavar='PATH',
+                        help='write results as gauges to node_exporter textfile collector file PATH, '
+                             'e.g. /var/lib/node_exporter/textfile_collector/kernelchecker.prom')
+    parser.add_argument('--interval', type=float, metavar='SECONDS',
+                        help='with --textfile, keep running and refresh the file every SECONDS, rechecking only '
+                             'when package databases or KernelCare state change, or results are older than '
+                             '--max-metadata-age')
+    parser.add_argument('--poll-interval', type=float, default=SERVE_POLL_INTERVAL, metavar='SECONDS',
+                        help='check watched files for changes every SECONDS (default: %(default)s)')
+    return parser.parse_args(argv)
 
 
 def main():
     """
-    if --json or -j argument provided, print results in json, otherwise in yaml format
-    :return: 0
+    print results in --format, json if --json or -j argument provided, otherwise in yaml format
+    if --serve argument provided, keep serving results over http instead
+    if --textfile argument provided, write results for node_exporter instead
+    if --root argument provided with several paths, print one record per system image, json lines by default
+    if --boot argument provided, print one record per kernel image in /boot, json lines by default
+    :return: 0, or 1 if some system images couldn't be checked
     """
-    kchecker = KernelChecker()
     import sys
-    if len(sys.argv) > 1 and (sys.argv[1] == '--json' or sys.argv[1] == '-j'):
-        print(kchecker.tojson())
+    args = parse_args(sys.argv[1:])
+    if args.splay and not args.serve:
+        # up front rather than in ProbeClient, the delay would count against the supported probe timeout
+        time.sleep(splay_delay(args.splay))
+    if args.boot:
+        return boot_main(vars(args), args.root[0] if args.root else None, args.workers, args.format or 'jsonl')
+    if args.root and len(args.root) > 1:
+        return roots_main(args.root, vars(args), args.workers, args.format or 'jsonl')
+    factory = checker_factory(vars(args))
+    if args.serve:
+        listen = None
+        if args.listen:
+            host, _, port = args.listen.rpartition(':')
+            listen = (host or '127.0.0.1', int(port))
+        return serve(factory, args.socket, listen, args.poll_interval, args.max_metadata_age)
+    if args.textfile:
+        return textfile_main(factory, args.textfile, args.interval, args.max_metadata_age)
+    profile = None
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    root = args.root[0] if args.root else None
+    compute = lambda: factory(root).todict(args.timings)
+    # timings and profiles are of this run, not shared
+    if args.no_cache or not args.result_ttl or args.timings or profile is not None:
+        result = compute()
     else:
-        print(kchecker.toyaml())
+        cache_dir = os.path.dirname(args.cache_file) if args.cache_file else default_cache_dir()
+        key = ' '.join(str(option) for option in (root or '/', args.index, args.max_metadata_age,
+                                                  ','.join(args.server or []), args.retries, args.timeout))
+        result = single_flight(os.path.join(cache_dir, RESULT_CACHE_FILE), key, compute, args.result_ttl,
+                               args.refresh, watched_paths(root))
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile)
+    RecordWriter(args.format or 'yaml').write(result)
+    return 0
 
 if __name__ == "__main__":
-    main()
+    exit(main())
@@ -0,0 +1,288 @@
+"""
+asyncio counterparts of kernelchecker.py and kc-compat.py checks, for applications running an event loop.
+Package manager commands run with asyncio.create_subprocess_exec and patches server is asked over asyncio
+streams, so a single loop can run many checks at once. Checks can be cancelled, commands they started are
+killed then. Python 3 only, unlike the scripts
+"""
+import asyncio
+import random
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+import kernelchecker
+from kernelchecker import (METADATA_MAX_AGE, PROBE_TIMEOUTS, HostFacts, KernelChecker, PackageQuery, ProbeClient,
+                           Timings, conditional_headers, response_validators, server_url, splay_delay)
+
+__all__ = ['AsyncProbeClient', 'run_command', 'run_query', 'is_kernelcare_supported_kernel',
+           'is_kernelcare_up2date', 'is_compat', 'check', 'get_data']
+
+
+async def run_command(args, timeout=None):
+    """
+    :param timeout: seconds to wait, the command is killed after that
+    :return: (output, exit code)
+    :raises asyncio.TimeoutError: command didn't finish in time
+    """
+    process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    try:
+        out, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # timed out or cancelled
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return out.decode('utf-8', 'replace'), process.returncode
+
+
+async def run_query(query):
+    """
+    Async kernelchecker.run_query
+    :param query: handler method returning result of package query, or PackageQuery to run commands for it,
+        e.g. handler.query_installed
+    """
+    # direct readers of package databases and metadata, keep them off the loop
+    result = await asyncio.to_thread(query)
+    while isinstance(result, PackageQuery):
+        output, _ = await run_command(result.command)
+        result = await asyncio.to_thread(result.parse, output)
+    return result
+
+
+class _Headers(dict):
+    """
+    Response headers by lowercase name, with getheader of http.client responses
+    """
+
+    def getheader(self, name, default=None):
+        return self.get(name.lower(), default)
+
+
+class AsyncProbeClient(ProbeClient):
+    """
+    ProbeClient with coroutine check, check_server and request: same options, retries, racing of mirrors,
+    conditional requests and splay
+    """
+
+    async def check(self, kernel_hash, validators=None):
+        """
+        :param validators: ETag / Last-Modified dict of an earlier compatible answer, see CompatCache.validators
+        :return: True if kernel is known to patches server, False if it is not
+        :raises HTTPError, URLError: no server gave a definitive answer
+        """
+        if self.splay:
+            delay, self.splay = splay_delay(self.splay), 0
+            await asyncio.sleep(delay)
+        path = '/' + kernel_hash + '/version'
+        headers = conditional_headers(validators)
+        tasks = [asyncio.ensure_future(self.check_server(server, path, headers)) for server in self.servers]
+        error = None
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    return await task
+                except (HTTPError, URLError) as e:
+                    error = e
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise error
+
+    async def check_server(self, server, path, headers=None):
+        """
+        :return: True if path is found on server, False if it is not
+        :raises HTTPError, URLError: of the last attempt
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                status, reason = await self.request(server, path, headers)
+            except (asyncio.TimeoutError, asyncio.LimitOverrunError, EOFError, ValueError, OSError) as e:
+                error = URLError(e)
+                continue
+            if status in (200, 206, 304):
+                return True
+            if status == 404:
+                return False
+            error = HTTPError(server_url(server) + path, status, reason, None, None)
+            # server errors and throttling may be transient, anything else won't change on retry
+            if status != 429 and status < 500:
+                break
+        raise error
+
+    async def request(self, server, path, headers=None):
+        """
+        HEAD request, falls back to GET of a single byte if server doesn't allow HEAD.
+        Validators of a successful response are stored in self.validators
+        :param headers: conditional request headers, see conditional_headers
+        :return: response status and reason
+        """
+        status, reason, response = await self.exchange(server, 'HEAD', path, headers)
+        if status in (405, 501):
+            status, reason, response = await self.exchange(server, 'GET', path,
+                                                           dict(headers or {}, Range='bytes=0-0'))
+        if status in (200, 206):
+            self.validators[path] = response_validators(response)
+        return status, reason
+
+    async def exchange(self, server, method, path, headers=None):
+        """
+        Send request over a new connection and read status line and headers of the response
+        :param headers: dict of request headers
+        :return: response status, reason and headers
+        """
+        url = urlsplit(server_url(server))
+        context = None
+        if url.scheme == 'https':
+            import ssl
+            context = ssl.create_default_context()
+        port = url.port or (443 if context else 80)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(url.hostname, port, ssl=context),
+                                                self.connect_timeout)
+        try:
+            writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n%s\r\n' % (
+                method, path, url.netloc, ''.join('%s: %s\r\n' % item for item in (headers or {}).items()))
+            ).encode('latin-1'))
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            line, _, fields = head.decode('latin-1').partition('\r\n')
+            version, status, reason = (line.split(' ', 2) + [''])[:3]
+            if not version.startswith('HTTP/'):
+                raise ValueError('bad status line %r' % line)
+            response = _Headers()
+            for field in fields.split('\r\n'):
+                name, sep, value = field.partition(':')
+                if sep:
+                    response[name.strip().lower()] = value.strip()
+            return int(status), reason, response
+        finally:
+            writer.close()
+
+
+async def is_kernelcare_supported_kernel(cache=None, index=None, client=None, facts=None, kernel_hash=None):
+    """
+    Async KernelChecker.is_kernelcare_supported_kernel
+    :param client: AsyncProbeClient to ask patches server with, default one if None
+    :return: True/False, or None if patches server didn't give an answer
+    """
+    if kernel_hash is None:
+        kernel_hash = await asyncio.to_thread(KernelChecker.get_kernel_hash, facts)
+    if index is not None:
+        return kernel_hash in index
+    validators = None
+    if cache is not None:
+        result = cache.get(kernel_hash)
+        if result is not None:
+            return result
+        validators = cache.validators(kernel_hash)
+    client = client or AsyncProbeClient()
+    try:
+        result = await client.check(kernel_hash, validators)
+    except (HTTPError, URLError):
+        # don't remember answers for network errors
+        return None
+    if cache is not None:
+        cache.put(kernel_hash, result, result and (client.answer_validators(kernel_hash) or validators) or None)
+        await asyncio.to_thread(cache.save)
+    return result
+
+
+async def is_kernelcare_up2date(timeout=PROBE_TIMEOUTS['kcarectl'], facts=None):
+    """
+    Async KernelChecker.is_kernelcare_up2date
+    :return: True/False, or None if kcarectl didn't finish in time
+    """
+    state = await asyncio.to_thread(KernelChecker.kernelcare_state, facts or HostFacts())
+    if state is not None:
+        return state
+    try:
+        _, rc = await run_command([kernelchecker.KCARE_BIN, '--check'], timeout)
+    except asyncio.TimeoutError:
+        return None
+    return rc == 1
+
+
+async def is_compat(cache=None, index=None, client=None, facts=None):
+    """
+    Async is_compat of kc-compat.py: check if running kernel is supported by KernelCare
+    :param client: AsyncProbeClient to ask patches server with, default one if None
+    :return: True if supported, False if kernel is unknown to patches server
+    :raises HTTPError, URLError: patches server didn't give an answer
+    """
+    kernel_hash = await asyncio.to_thread(KernelChecker.get_kernel_hash, facts)
+    if index is not None:
+        return kernel_hash in index
+    validators = None
+    if cache is not None:
+        result = cache.get(kernel_hash)
+        if result is not None:
+            return result
+        validators = cache.validators(kernel_hash)
+    client = client or AsyncProbeClient()
+    result = await client.check(kernel_hash, validators)
+    if cache is not None:
+        cache.put(kernel_hash, result, result and (client.answer_validators(kernel_hash) or validators) or None)
+        await asyncio.to_thread(cache.save)
+    return result
+
+
+async def _probe(name, coroutine, timeout, timings):
+    """
+    :return: result of coroutine, None if it failed or didn't finish in timeout seconds
+    """
+    started = time.time()
+    try:
+        result = await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError:
+        timings.timed_out(name)
+        return None
+    except Exception:
+        return None
+    # cpu time of a coroutine sharing the loop is unknown
+    timings.spans.append({'name': name, 'wall': round((time.time() - started) * 1000, 3), 'cpu': None,
+                          'exit_codes': []})
+    return result
+
+
+async def check(cache=None, timeouts=None, max_metadata_age=METADATA_MAX_AGE, index=None, client=None, root=None):
+    """
+    Async KernelChecker(): package queries, patches server request and kcarectl run concurrently.
+    Results of probes that failed or didn't finish in time are None
+    :param timeouts: dict of probe name -> seconds, see PROBE_TIMEOUTS
+    :param client: AsyncProbeClient to ask patches server with
+    :return: lazy KernelChecker with all results already computed, its todict() and get_data() don't block
+    """
+    checker = KernelChecker(cache, timeouts, max_metadata_age, index, None, root, lazy=True)
+    timeouts = timeouts or PROBE_TIMEOUTS
+    # reads /proc and /etc files, fails early if the kernel can't be found
+    handler = await asyncio.to_thread(lambda: (checker.current_version, checker.inside_container,
+                                               checker.kcare_installed, checker.handler)[-1])
+    probes = {
+        'installed': run_query(handler.query_installed),
+        'available': run_query(handler.query_available),
+        'supported': is_kernelcare_supported_kernel(cache, index, client, checker.facts),
+    }
+    if checker.kcare_installed and not root:
+        probes['kcarectl'] = is_kernelcare_up2date(timeouts.get('kcarectl', PROBE_TIMEOUTS['kcarectl']),
+                                                   checker.facts)
+    checker.timings = Timings()
+    names = list(probes)
+    results = await asyncio.gather(*[_probe(name, probes[name], timeouts.get(name, max(timeouts.values())),
+                                            checker.timings) for name in names])
+    for name, result in zip(names, results):
+        checker.results['probe:' + name] = result
+    # derived fields are cheap, computed here so the caller never blocks
+    checker.get_data()
+    return checker
+
+
+async def get_data(*args, **kwargs):
+    """
+    :param args: same as of check()
+    :return: KernelChecker.get_data() tuple
+    """
+    return (await check(*args, **kwargs)).get_data()
@@ -2,7 +2,7 @@ import pytest
 import sys
 import os
 import importlib.util
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, mock_open, MagicMock, ANY
 from urllib.error import HTTPError, URLError
 
 spec = importlib.util.spec_from_file_location("kc_compat", "kc-compat.py")
@@ -10,6 +10,12 @@ kc_compat = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(kc_compat)
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    with patch.object(kc_compat, 'default_cache_dir', return_value=str(tmp_path / 'cache')):
+        yield tmp_path / 'cache'
+
+
 class TestGetKernelHash:
     @patch('builtins.open', new_callable=mock_open, read_data=b'Linux version 5.4.0-test')
     def test_get_kernel_hash_success(self, mock_file):
@@ -58,6 +64,20 @@ class TestContainerDetection:
         assert kc_compat.inside_lxc_container() == False
 
 
+    def test_detect_container(self, tmp_path):
+        assert kc_compat.detect_container(kc_compat.HostFacts(str(tmp_path))) is None
+        (tmp_path / 'run').mkdir()
+        (tmp_path / 'run' / '.containerenv').write_text('')
+        assert kc_compat.detect_container(kc_compat.HostFacts(str(tmp_path))) == 'podman'
+
+    @patch('builtins.open', new_callable=mock_open, read_data=b'Linux version 5.4.0-test')
+    def test_facts_read_once(self, mock_file):
+        facts = kc_compat.HostFacts()
+        assert kc_compat.get_kernel_hash(facts) == kc_compat.get_kernel_hash(facts)
+        assert facts.kernel_release == '5.4.0-test'
+        mock_file.assert_called_once_with('/proc/version', 'rb')
+
+
 class TestGetDistroInfo:
     @patch('os.path.exists', return_value=True)
     @patch('builtins.open', new_callable=mock_open, read_data='ID=centos\nVERSION_ID="7"\n')
@@ -87,29 +107,27 @@ class TestIsDistroSupported:
 
 class TestIsCompat:
     @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
-    @patch.object(kc_compat, 'urlopen')
-    def test_is_compat_success(self, mock_urlopen, mock_hash):
-        mock_urlopen.return_value = MagicMock()
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(200, 'OK'))
+    def test_is_compat_success(self, mock_request, mock_hash):
         assert kc_compat.is_compat() == True
-        mock_urlopen.assert_called_once_with('http://patches.kernelcare.com/abcdef123456/version')
+        mock_request.assert_called_once_with('patches.kernelcare.com', '/abcdef123456/version', None)
 
     @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
-    @patch.object(kc_compat, 'urlopen')
-    def test_is_compat_404_error_returns_false(self, mock_urlopen, mock_hash):
-        mock_urlopen.side_effect = HTTPError(None, 404, 'Not Found', None, None)
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(404, 'Not Found'))
+    def test_is_compat_404_error_returns_false(self, mock_request, mock_hash):
         assert kc_compat.is_compat() == False
 
     @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
-    @patch.object(kc_compat, 'urlopen')
-    def test_is_compat_500_error_raises(self, mock_urlopen, mock_hash):
-        mock_urlopen.side_effect = HTTPError(None, 500, 'Server Error', None, None)
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(500, 'Server Error'))
+    @patch.object(kc_compat.time, 'sleep')
+    def test_is_compat_500_error_raises(self, mock_sleep, mock_request, mock_hash):
         with pytest.raises(HTTPError):
             kc_compat.is_compat()
 
     @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
-    @patch.object(kc_compat, 'urlopen')
-    def test_is_compat_url_error_raises(self, mock_urlopen, mock_hash):
-        mock_urlopen.side_effect = URLError('Connection refused')
+    @patch.object(kc_compat.ProbeClient, 'request', side_effect=OSError('Connection refused'))
+    @patch.object(kc_compat.time, 'sleep')
+    def test_is_compat_url_error_raises(self, mock_sleep, mock_request, mock_hash):
         with pytest.raises(URLError):
             kc_compat.is_compat()
 
@@ -128,41 +146,38 @@ class TestMyprint:
 
 class TestMain:
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=True)
+    @patch.object(kc_compat, 'detect_container', return_value='openvz')
     @patch('builtins.print')
-    def test_main_vz_container(self, mock_print, mock_vz):
+    def test_main_vz_container(self, mock_print, mock_container):
         result = kc_compat.main()
         assert result == 2
         mock_print.assert_called_once_with("UNSUPPORTED; INSIDE CONTAINER")
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=True)
+    @patch.object(kc_compat, 'detect_container', return_value='lxc')
     @patch('builtins.print')
-    def test_main_lxc_container(self, mock_print, mock_lxc, mock_vz):
+    def test_main_lxc_container(self, mock_print, mock_container):
         result = kc_compat.main()
         assert result == 2
         mock_print.assert_called_once_with("UNSUPPORTED; INSIDE CONTAINER")
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', return_value=True)
     @patch('builtins.print')
-    def test_main_compatible(self, mock_print, mock_compat, mock_lxc, mock_vz):
+    def test_main_compatible(self, mock_print, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 0
         mock_print.assert_called_once_with("COMPATIBLE")
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', return_value=False)
     @patch.object(kc_compat, 'get_distro_info', return_value='centos')
     @patch.object(kc_compat, 'is_distro_supported', return_value=True)
     @patch('builtins.print')
     def test_main_kernel_not_found_but_distro_supported(self, mock_print, mock_distro_supported, 
-                                                      mock_distro_info, mock_compat, mock_lxc, mock_vz):
+                                                      mock_distro_info, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 1
         # Expect two print calls: status + detailed message
@@ -173,14 +188,13 @@ class TestMain:
         mock_print.assert_has_calls(expected_calls)
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', return_value=False)
     @patch.object(kc_compat, 'get_distro_info', return_value='unknown')
     @patch.object(kc_compat, 'is_distro_supported', return_value=False)
     @patch('builtins.print')
     def test_main_kernel_not_found_distro_not_supported(self, mock_print, mock_distro_supported,
-                                                      mock_distro_info, mock_compat, mock_lxc, mock_vz):
+                                                      mock_distro_info, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 1
         # Expect two print calls: status + detailed message
@@ -191,51 +205,655 @@ class TestMain:
         mock_print.assert_has_calls(expected_calls)
 
     @patch('sys.argv', ['kc-compat.py', '--silent'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', return_value=True)
     @patch('builtins.print')
-    def test_main_silent_mode(self, mock_print, mock_compat, mock_lxc, mock_vz):
+    def test_main_silent_mode(self, mock_print, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 0
         mock_print.assert_not_called()
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', side_effect=HTTPError(None, 500, 'Server Error', None, None))
     @patch('builtins.print')
-    def test_main_http_error(self, mock_print, mock_compat, mock_lxc, mock_vz):
+    def test_main_http_error(self, mock_print, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 3
         mock_print.assert_called_once_with("CONNECTION ERROR; HTTP 500")
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', side_effect=URLError('Connection refused'))
     @patch('builtins.print')
-    def test_main_url_error(self, mock_print, mock_compat, mock_lxc, mock_vz):
+    def test_main_url_error(self, mock_print, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 3
         mock_print.assert_called_once_with("CONNECTION ERROR; Connection refused")
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', side_effect=IOError('Disk error'))
     @patch('builtins.print')
-    def test_main_system_error(self, mock_print, mock_compat, mock_lxc, mock_vz):
+    def test_main_system_error(self, mock_print, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 4
         mock_print.assert_called_once_with("SYSTEM ERROR; Disk error")
 
     @patch('sys.argv', ['kc-compat.py'])
-    @patch.object(kc_compat, 'inside_vz_container', return_value=False)
-    @patch.object(kc_compat, 'inside_lxc_container', return_value=False)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
     @patch.object(kc_compat, 'is_compat', side_effect=ValueError('Unexpected error'))
     @patch('builtins.print')
-    def test_main_unexpected_error(self, mock_print, mock_compat, mock_lxc, mock_vz):
+    def test_main_unexpected_error(self, mock_print, mock_compat, mock_container):
         result = kc_compat.main()
         assert result == 5
-        mock_print.assert_called_once_with("UNEXPECTED ERROR; Unexpected error") 
\ No newline at end of file
+        mock_print.assert_called_once_with("UNEXPECTED ERROR; Unexpected error") 
+
+class FakeResponse:
+    will_close = False
+
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.reason = 'Reason'
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self):
+        return b''
+
+
+class FakeConnection:
+    statuses = {}
+    requests = []
+    methods = []
+    instances = 0
+    allow_head = True
+    down = set()
+    etags = {}
+    headers = []
+
+    def __init__(self, host, timeout=None):
+        FakeConnection.instances += 1
+        self.host = host
+        self.path = None
+        self.method = None
+        self.sock = MagicMock()
+
+    def connect(self):
+        if self.host in FakeConnection.down:
+            raise OSError('Connection refused')
+
+    def request(self, method, path, headers=None):
+        self.connect()
+        FakeConnection.requests.append(path)
+        FakeConnection.methods.append(method)
+        FakeConnection.headers.append(headers)
+        self.if_none_match = (headers or {}).get('If-None-Match')
+        self.method = method
+        self.path = path
+
+    def getresponse(self):
+        if self.method == 'HEAD' and not FakeConnection.allow_head:
+            return FakeResponse(405)
+        etag = FakeConnection.etags.get(self.path.split('/')[1])
+        if etag and etag == self.if_none_match:
+            return FakeResponse(304)
+        return FakeResponse(FakeConnection.statuses.get(self.path.split('/')[1], 404), etag and {'ETag': etag})
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_connection():
+    FakeConnection.statuses = {}
+    FakeConnection.requests = []
+    FakeConnection.methods = []
+    FakeConnection.instances = 0
+    FakeConnection.allow_head = True
+    FakeConnection.down = set()
+    FakeConnection.etags = {}
+    FakeConnection.headers = []
+    with patch.object(kc_compat, 'http_connection', FakeConnection):
+        yield FakeConnection
+
+
+class TestProbeClient:
+    def test_server_url(self):
+        assert kc_compat.server_url('patches.kernelcare.com') == 'http://patches.kernelcare.com'
+        assert kc_compat.server_url('https://mirror.example.com/') == 'https://mirror.example.com'
+
+    def test_head_request(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        assert kc_compat.ProbeClient().check('a' * 40) == True
+        assert kc_compat.ProbeClient().check('b' * 40) == False
+        assert fake_connection.methods == ['HEAD', 'HEAD']
+
+    def test_get_fallback_when_head_not_allowed(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        fake_connection.allow_head = False
+        assert kc_compat.ProbeClient().check('a' * 40) == True
+        assert fake_connection.methods == ['HEAD', 'GET']
+
+    @patch.object(kc_compat.time, 'sleep')
+    @patch.object(kc_compat.ProbeClient, 'request', side_effect=[OSError('reset'), (503, 'Busy'), (200, 'OK')])
+    def test_retries_with_backoff(self, mock_request, mock_sleep):
+        assert kc_compat.ProbeClient(backoff=1).check('a' * 40) == True
+        (first,), (second,) = [call[0] for call in mock_sleep.call_args_list]
+        assert 0.5 <= first <= 1.5
+        assert 1 <= second <= 3
+
+    @patch.object(kc_compat.time, 'sleep')
+    @patch.object(kc_compat.ProbeClient, 'request', side_effect=OSError('Connection refused'))
+    def test_retries_exhausted(self, mock_request, mock_sleep):
+        with pytest.raises(URLError):
+            kc_compat.ProbeClient(retries=1).check('a' * 40)
+        assert mock_request.call_count == 2
+
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(403, 'Forbidden'))
+    def test_client_error_not_retried(self, mock_request):
+        with pytest.raises(HTTPError) as e:
+            kc_compat.ProbeClient().check('a' * 40)
+        assert e.value.code == 403
+        assert mock_request.call_count == 1
+
+    @patch.object(kc_compat.time, 'sleep')
+    def test_mirror_race(self, mock_sleep, fake_connection):
+        fake_connection.down = {'down.example.com'}
+        client = kc_compat.ProbeClient(['down.example.com', 'up.example.com'])
+        assert client.check('a' * 40) == False
+
+    def test_conditional_request(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        fake_connection.etags = {'a' * 40: '"v1"'}
+        client = kc_compat.ProbeClient()
+        assert client.check('a' * 40) == True
+        assert client.answer_validators('a' * 40) == {'etag': '"v1"'}
+        assert client.check('a' * 40, {'etag': '"v1"', 'last_modified': 'Mon, 05 Oct 2026 10:00:00 GMT'}) == True
+        assert fake_connection.headers == [{}, {'If-None-Match': '"v1"',
+                                                'If-Modified-Since': 'Mon, 05 Oct 2026 10:00:00 GMT'}]
+
+    def test_conditional_get_fallback(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        fake_connection.allow_head = False
+        assert kc_compat.ProbeClient().check('a' * 40, {'etag': '"v1"'}) == True
+        assert fake_connection.headers[-1] == {'If-None-Match': '"v1"', 'Range': 'bytes=0-0'}
+
+    @patch.object(kc_compat.time, 'sleep')
+    def test_splay_before_first_request(self, mock_sleep, fake_connection):
+        client = kc_compat.ProbeClient(splay=60)
+        with patch.object(kc_compat, 'splay_delay', return_value=12.5) as mock_delay:
+            client.check('a' * 40)
+            client.check('b' * 40)
+        mock_delay.assert_called_once_with(60)
+        mock_sleep.assert_called_once_with(12.5)
+
+    def test_splay_delay(self, tmp_path):
+        machine_id = tmp_path / 'machine-id'
+        machine_id.write_text('4f0b5e8a2c6d4e1f9a3b7c5d2e8f1a6b\n')
+        with patch.object(kc_compat, 'MACHINE_ID_FILES', (str(tmp_path / 'missing'), str(machine_id))):
+            delay = kc_compat.splay_delay(300)
+            assert 0 <= delay < 300
+            assert kc_compat.splay_delay(300) == delay
+            assert kc_compat.splay_delay(0) == 0
+            machine_id.write_text('0d5c2a7e9b1f4c3a8e6d2b5f7a9c1e3d\n')
+            assert kc_compat.splay_delay(300) != delay
+        with patch.object(kc_compat, 'MACHINE_ID_FILES', ()):
+            assert 0 <= kc_compat.splay_delay(300) < 300
+
+    def test_splay_spreads_hosts(self):
+        delays = []
+        for host in range(1000):
+            with patch.object(kc_compat, 'MACHINE_ID_FILES', ()), \
+                    patch('socket.gethostname', return_value='host%d' % host):
+                delays.append(kc_compat.splay_delay(60))
+        # every 10 seconds of the minute get about a sixth of the hosts
+        for start in range(0, 60, 10):
+            assert 120 < sum(start <= delay < start + 10 for delay in delays) < 220
+
+    @patch.object(kc_compat.time, 'sleep')
+    def test_mirror_race_all_down(self, mock_sleep, fake_connection):
+        fake_connection.down = {'down1.example.com', 'down2.example.com'}
+        client = kc_compat.ProbeClient(['down1.example.com', 'down2.example.com'], retries=0)
+        with pytest.raises(URLError):
+            client.check('a' * 40)
+
+    @patch('sys.argv', ['kc-compat.py', '--no-cache', '--server', 'a.example.com', '--server', 'b.example.com',
+                        '--timeout', '1', '--retries', '0'])
+    @patch.object(kc_compat, 'detect_container', return_value=None)
+    @patch.object(kc_compat, 'is_compat', return_value=True)
+    @patch('builtins.print')
+    def test_main_servers(self, mock_print, mock_compat, mock_container):
+        assert kc_compat.main() == 0
+        client = mock_compat.call_args[0][2]
+        assert client.servers == ['a.example.com', 'b.example.com']
+        assert client.timeout == 1
+        assert client.retries == 0
+
+
+class TestRoot:
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(404, 'Not Found'))
+    @patch('builtins.print')
+    def test_main_root(self, mock_print, mock_request, tmp_path):
+        (tmp_path / 'proc').mkdir()
+        (tmp_path / 'proc' / 'version').write_bytes(b'Linux version 5.4.0-test\n')
+        (tmp_path / 'etc').mkdir()
+        (tmp_path / 'etc' / 'os-release').write_text('ID=ubuntu\n')
+        with patch('sys.argv', ['kc-compat.py', '--no-cache', '--root', str(tmp_path)]):
+            assert kc_compat.main() == 1
+        kernel_hash = kc_compat.hash_kernel_version('Linux version 5.4.0-test')
+        mock_request.assert_called_once_with('patches.kernelcare.com', '/%s/version' % kernel_hash, None)
+        assert 'We support your distribution' in mock_print.call_args_list[1][0][0]
+
+    @patch('builtins.print')
+    def test_main_root_without_proc_version(self, mock_print, tmp_path):
+        with patch('sys.argv', ['kc-compat.py', '--no-cache', '--root', str(tmp_path)]):
+            assert kc_compat.main() == 4
+        assert mock_print.call_args[0][0].startswith('SYSTEM ERROR')
+
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(200, 'OK'))
+    @patch('builtins.print')
+    def test_main_root_kernel_image(self, mock_print, mock_request, tmp_path):
+        import gzip
+        # unpacked sysroot: kernel images, no proc/
+        (tmp_path / 'boot').mkdir()
+        for release in ('5.14.0-70.el9.x86_64', '5.14.0-162.el9.x86_64'):
+            banner = b'Linux version %s (mockbuild@example.com) #1 SMP\n' % release.encode()
+            (tmp_path / 'boot' / ('vmlinuz-' + release)).write_bytes(b'MZ' + b'\0' * 510 + gzip.compress(banner))
+        (tmp_path / 'boot' / 'vmlinuz-0-rescue-0123456789abcdef').write_bytes(b'')
+        with patch('sys.argv', ['kc-compat.py', '--no-cache', '--root', str(tmp_path)]):
+            assert kc_compat.main() == 0
+        kernel_hash = kc_compat.hash_kernel_version('Linux version 5.14.0-162.el9.x86_64 (mockbuild@example.com) #1 SMP')
+        mock_request.assert_called_once_with('patches.kernelcare.com', '/%s/version' % kernel_hash, None)
+        assert kc_compat.HostFacts(str(tmp_path)).kernel_release == '5.14.0-162.el9.x86_64'
+
+    def test_release_key(self):
+        releases = ['5.14.0-162.el9.x86_64', '0-rescue-0123456789abcdef', '5.14.0-70.el9.x86_64', '5.4.0-10']
+        assert sorted(releases, key=kc_compat.release_key) == [
+            '0-rescue-0123456789abcdef', '5.4.0-10', '5.14.0-70.el9.x86_64', '5.14.0-162.el9.x86_64']
+
+
+class TestBatch:
+    def test_hash_kernel_version_matches_proc_version(self):
+        data = b'Linux version 5.4.0-test\n'
+        with patch('builtins.open', mock_open(read_data=data)):
+            expected = kc_compat.get_kernel_hash()
+        assert kc_compat.hash_kernel_version('Linux version 5.4.0-test') == expected
+        assert kc_compat.hash_kernel_version('Linux version 5.4.0-test\n') == expected
+
+    def test_read_batch_hashes(self, capsys):
+        lines = ['A' * 40 + '\n', '\n', 'Linux version 5.4.0-test\n', 'garbage\n']
+        result = list(kc_compat.read_batch_hashes(lines))
+        assert result == ['a' * 40, kc_compat.hash_kernel_version('Linux version 5.4.0-test')]
+        assert 'garbage' in capsys.readouterr().err
+
+    def test_check_batch_deduplicates(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        results = dict(kc_compat.check_batch(['a' * 40, 'b' * 40, 'a' * 40], workers=4))
+        assert results == {'a' * 40: True, 'b' * 40: False}
+        assert sorted(fake_connection.requests) == ['/' + 'a' * 40 + '/version', '/' + 'b' * 40 + '/version']
+
+    def test_check_batch_reuses_connections(self, fake_connection):
+        hashes = ['%040x' % i for i in range(50)]
+        results = list(kc_compat.check_batch(hashes, workers=3))
+        assert len(results) == 50
+        assert 1 <= fake_connection.instances <= 3
+
+    def test_check_batch_server_error(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 500}
+        (kernel_hash, result), = kc_compat.check_batch(['a' * 40])
+        assert isinstance(result, HTTPError)
+        assert result.code == 500
+
+    @patch('time.sleep')
+    def test_check_batch_connection_error(self, mock_sleep):
+        conn = MagicMock()
+        conn.request.side_effect = OSError('Connection refused')
+        with patch.object(kc_compat, 'http_connection', return_value=conn):
+            (kernel_hash, result), = kc_compat.check_batch(['a' * 40])
+        assert isinstance(result, URLError)
+        assert conn.request.call_count == kc_compat.PROBE_RETRIES + 1
+        assert mock_sleep.call_count == kc_compat.PROBE_RETRIES
+
+    def test_check_batch_mirrors(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        fake_connection.down = {'down.example.com'}
+        client = kc_compat.ProbeClient(['down.example.com', 'up.example.com'], retries=0, keep_alive=True)
+        assert dict(kc_compat.check_batch(['a' * 40, 'b' * 40], client=client)) == {'a' * 40: True, 'b' * 40: False}
+
+    @patch('time.sleep')
+    def test_stale_keep_alive_connection_reopened(self, mock_sleep, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200}
+        client = kc_compat.ProbeClient(keep_alive=True)
+        assert client.check('a' * 40) is True
+        client.idle[kc_compat.PATCH_SERVER][0].request = MagicMock(side_effect=OSError('Connection reset'))
+        assert client.check('a' * 40) is True
+        assert fake_connection.instances == 2
+        mock_sleep.assert_not_called()
+
+    @patch.object(kc_compat, 'batch_main', return_value=0)
+    def test_main_batch_options(self, mock_batch, tmp_path):
+        argv = ['kc-compat.py', '--batch', '-', '--server', 'm1', '--server', 'm2', '--timeout', '7', '--retries', '4']
+        with patch('sys.argv', argv):
+            assert kc_compat.main() == 0
+        client = mock_batch.call_args[0][5]
+        assert (client.servers, client.timeout, client.retries, client.keep_alive) == (['m1', 'm2'], 7, 4, True)
+
+    @patch('builtins.print')
+    def test_main_batch(self, mock_print, fake_connection, tmp_path):
+        fake_connection.statuses = {'a' * 40: 200, 'c' * 40: 500}
+        source = tmp_path / 'hashes'
+        source.write_text('\n'.join(['a' * 40, 'b' * 40, 'c' * 40, 'a' * 40]) + '\n')
+        with patch('sys.argv', ['kc-compat.py', '--batch', str(source)]):
+            result = kc_compat.main()
+        assert result == 3
+        printed = sorted(call[0][0] for call in mock_print.call_args_list)
+        assert printed == ['a' * 40 + ' COMPATIBLE',
+                           'b' * 40 + ' NEEDS REVIEW',
+                           'c' * 40 + ' CONNECTION ERROR; HTTP 500']
+
+    def test_check_batch_conditional(self, fake_connection):
+        fake_connection.statuses = {'a' * 40: 200, 'b' * 40: 200}
+        fake_connection.etags = {'a' * 40: '"v1"', 'b' * 40: '"v2"'}
+        validators = {'a' * 40: {'etag': '"v1"'}}
+        results = dict(kc_compat.check_batch(['a' * 40, 'b' * 40], workers=1, validators=validators))
+        assert results == {'a' * 40: True, 'b' * 40: True}
+        assert fake_connection.headers == [{'If-None-Match': '"v1"'}, {}]
+        assert validators == {'a' * 40: {'etag': '"v1"'}, 'b' * 40: {'etag': '"v2"'}}
+
+    @patch('builtins.print')
+    def test_main_batch_missing_file(self, mock_print, tmp_path):
+        with patch('sys.argv', ['kc-compat.py', '--batch', str(tmp_path / 'missing')]):
+            assert kc_compat.main() == 4
+
+
+class TestCompatCache:
+    def test_roundtrip(self, cache_dir):
+        cache = kc_compat.CompatCache()
+        assert cache.get('a' * 40) is None
+        cache.put('a' * 40, True)
+        cache.put('b' * 40, False)
+        cache.save()
+        assert (cache_dir / 'compat.json').exists()
+        cache = kc_compat.CompatCache()
+        assert cache.get('a' * 40) is True
+        assert cache.get('b' * 40) is False
+
+    def test_separate_ttls(self, tmp_path):
+        path = str(tmp_path / 'cache.json')
+        cache = kc_compat.CompatCache(path, ttl=100, negative_ttl=10)
+        with patch.object(kc_compat.time, 'time', return_value=1000):
+            cache.put('a' * 40, True)
+            cache.put('b' * 40, False)
+            cache.save()
+        cache = kc_compat.CompatCache(path, ttl=100, negative_ttl=10)
+        with patch.object(kc_compat.time, 'time', return_value=1050):
+            assert cache.get('a' * 40) is True
+            assert cache.get('b' * 40) is None
+
+    def test_refresh_ignores_cached_answers(self, tmp_path):
+        path = str(tmp_path / 'cache.json')
+        cache = kc_compat.CompatCache(path)
+        cache.put('a' * 40, True)
+        cache.save()
+        cache = kc_compat.CompatCache(path, refresh=True)
+        assert cache.get('a' * 40) is None
+        cache.put('b' * 40, False)
+        cache.save()
+        cache = kc_compat.CompatCache(path)
+        assert cache.get('a' * 40) is True
+        assert cache.get('b' * 40) is False
+
+    def test_corrupted_file_ignored(self, tmp_path):
+        path = tmp_path / 'cache.json'
+        path.write_text('{not json')
+        cache = kc_compat.CompatCache(str(path))
+        assert cache.get('a' * 40) is None
+
+    def test_unwritable_location_ignored(self, tmp_path):
+        (tmp_path / 'file').write_text('')
+        cache = kc_compat.CompatCache(str(tmp_path / 'file' / 'cache.json'))
+        cache.put('a' * 40, True)
+        cache.save()
+
+    @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(404, 'Not Found'))
+    def test_is_compat_uses_cache(self, mock_request, mock_hash, tmp_path):
+        cache = kc_compat.CompatCache(str(tmp_path / 'cache.json'))
+        assert kc_compat.is_compat(cache) == False
+        assert kc_compat.is_compat(kc_compat.CompatCache(str(tmp_path / 'cache.json'))) == False
+        assert mock_request.call_count == 1
+
+    def test_expired_answers_kept_for_validators(self, tmp_path):
+        path = str(tmp_path / 'cache.json')
+        cache = kc_compat.CompatCache(path, ttl=100, validators_ttl=1000)
+        with patch.object(kc_compat.time, 'time', return_value=1000):
+            cache.put('a' * 40, True, {'etag': '"v1"'})
+            cache.put('b' * 40, True)
+            cache.save()
+        with patch.object(kc_compat.time, 'time', return_value=1500):
+            cache = kc_compat.CompatCache(path, ttl=100, validators_ttl=1000)
+            assert cache.get('a' * 40) is None
+            assert cache.validators('a' * 40) == {'etag': '"v1"'}
+            cache.put('c' * 40, False)
+            cache.save()
+        with patch.object(kc_compat.time, 'time', return_value=2500):
+            cache = kc_compat.CompatCache(path, ttl=100, validators_ttl=1000)
+            assert sorted(cache.entries) == ['a' * 40, 'c' * 40]
+            cache.put('c' * 40, False)
+            cache.save()
+        assert sorted(kc_compat.CompatCache(path).entries) == ['c' * 40]
+
+    @patch.object(kc_compat, 'get_kernel_hash', return_value='a' * 40)
+    def test_is_compat_revalidates(self, mock_hash, fake_connection, tmp_path):
+        fake_connection.statuses = {'a' * 40: 200}
+        fake_connection.etags = {'a' * 40: '"v1"'}
+        path = str(tmp_path / 'cache.json')
+        assert kc_compat.is_compat(kc_compat.CompatCache(path)) == True
+        cache = kc_compat.CompatCache(path, ttl=0)
+        assert kc_compat.is_compat(cache) == True
+        assert fake_connection.headers == [{}, {'If-None-Match': '"v1"'}]
+        # validators of the first answer are kept after a 304
+        assert kc_compat.CompatCache(path).validators('a' * 40) == {'etag': '"v1"'}
+
+    @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(500, 'Server Error'))
+    @patch.object(kc_compat.time, 'sleep')
+    def test_is_compat_does_not_cache_errors(self, mock_sleep, mock_request, mock_hash, tmp_path):
+        cache = kc_compat.CompatCache(str(tmp_path / 'cache.json'))
+        with pytest.raises(HTTPError):
+            kc_compat.is_compat(cache)
+        assert cache.get('abcdef123456') is None
+
+    @patch('sys.argv', ['kc-compat.py', '--no-cache'])
+    @patch.object(kc_compat, 'detect_container', return_value=None)
+    @patch.object(kc_compat, 'is_compat', return_value=True)
+    @patch('builtins.print')
+    def test_main_no_cache(self, mock_print, mock_compat, mock_container):
+        assert kc_compat.main() == 0
+        mock_compat.assert_called_once_with(None, None, ANY, ANY)
+
+    @patch('builtins.print')
+    def test_main_batch_uses_cache(self, mock_print, fake_connection, tmp_path):
+        fake_connection.statuses = {'a' * 40: 200}
+        source = tmp_path / 'hashes'
+        source.write_text('a' * 40 + '\n' + 'b' * 40 + '\n')
+        with patch('sys.argv', ['kc-compat.py', '--batch', str(source)]):
+            assert kc_compat.main() == 1
+            assert len(fake_connection.requests) == 2
+            assert kc_compat.main() == 1
+            assert len(fake_connection.requests) == 2
+
+
+class TestCompatIndex:
+    HASHES = ['%040x' % (i * 7919) for i in range(1000)]
+
+    def test_lookup(self, tmp_path):
+        path = str(tmp_path / 'index')
+        assert kc_compat.build_index(path, self.HASHES + self.HASHES[:10]) == 1000
+        index = kc_compat.CompatIndex(path)
+        assert len(index) == 1000
+        assert all(kernel_hash in index for kernel_hash in self.HASHES)
+        assert '%040x' % 1 not in index
+        assert 'f' * 40 not in index
+        assert '0' * 40 in index
+        assert 'not a hash' not in index
+        index.close()
+
+    def test_empty(self, tmp_path):
+        path = str(tmp_path / 'index')
+        kc_compat.build_index(path, [])
+        assert 'a' * 40 not in kc_compat.CompatIndex(path)
+
+    def test_update(self, tmp_path):
+        path = str(tmp_path / 'index')
+        kc_compat.build_index(path, self.HASHES[:500])
+        assert kc_compat.build_index(path, self.HASHES[400:], update=True) == 1000
+        index = kc_compat.CompatIndex(path)
+        assert all(kernel_hash in index for kernel_hash in self.HASHES)
+
+    def test_not_an_index(self, tmp_path):
+        path = tmp_path / 'index'
+        path.write_bytes(b'garbage' * 10)
+        with pytest.raises(ValueError):
+            kc_compat.CompatIndex(str(path))
+
+    def test_truncated(self, tmp_path):
+        path = tmp_path / 'index'
+        kc_compat.build_index(str(path), self.HASHES)
+        path.write_bytes(path.read_bytes()[:-1])
+        with pytest.raises(ValueError):
+            kc_compat.CompatIndex(str(path))
+
+    @patch.object(kc_compat.ProbeClient, 'request')
+    def test_is_compat_offline(self, mock_request, tmp_path):
+        path = str(tmp_path / 'index')
+        kc_compat.build_index(path, ['a' * 40])
+        index = kc_compat.CompatIndex(path)
+        with patch.object(kc_compat, 'get_kernel_hash', return_value='a' * 40):
+            assert kc_compat.is_compat(index=index) == True
+        with patch.object(kc_compat, 'get_kernel_hash', return_value='b' * 40):
+            assert kc_compat.is_compat(index=index) == False
+        mock_request.assert_not_called()
+
+    @patch('builtins.print')
+    def test_main_build_and_batch(self, mock_print, fake_connection, tmp_path):
+        path = str(tmp_path / 'index')
+        source = tmp_path / 'hashes'
+        source.write_text('a' * 40 + '\nLinux version 5.4.0-test\n')
+        with patch('sys.argv', ['kc-compat.py', '--build-index', path, str(source)]):
+            assert kc_compat.main() == 0
+        mock_print.assert_called_once_with('INDEX; 2 kernels')
+        mock_print.reset_mock()
+        source.write_text('a' * 40 + '\n' + 'b' * 40 + '\n')
+        with patch('sys.argv', ['kc-compat.py', '--batch', str(source), '--index', path]):
+            assert kc_compat.main() == 1
+        assert sorted(call[0][0] for call in mock_print.call_args_list) == \
+            ['a' * 40 + ' COMPATIBLE', 'b' * 40 + ' NEEDS REVIEW']
+        assert fake_connection.requests == []
+
+    @patch.object(kc_compat, 'detect_container', return_value=None)
+    @patch('builtins.print')
+    def test_main_bad_index(self, mock_print, mock_container, tmp_path):
+        with patch('sys.argv', ['kc-compat.py', '--index', str(tmp_path / 'missing')]):
+            assert kc_compat.main() == 4
+
+
+class TestTimings:
+    def test_span(self):
+        timings = kc_compat.Timings()
+        with timings.span('phase'):
+            pass
+        (name, wall, cpu), = timings.spans
+        assert name == 'phase'
+        assert wall >= 0 and cpu >= 0
+        assert timings.report().startswith('TIMINGS; phase ')
+
+    @patch('sys.argv', ['kc-compat.py', '--timings', '--no-cache'])
+    @patch.object(kc_compat, 'timings', new_callable=kc_compat.Timings)
+    @patch.object(kc_compat, 'detect_container', return_value=None)
+    @patch.object(kc_compat, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kc_compat.ProbeClient, 'request', return_value=(200, 'OK'))
+    @patch('builtins.print')
+    def test_main_timings(self, mock_print, mock_request, mock_hash, mock_container, mock_timings, capsys):
+        assert kc_compat.main() == 0
+        mock_print.assert_called_once_with("COMPATIBLE")
+        report = capsys.readouterr().err
+        for phase in ('container', 'hash', 'request', 'total'):
+            assert ' %s ' % phase in report
+
+    @patch.object(kc_compat, 'detect_container', return_value='openvz')
+    @patch('builtins.print')
+    def test_main_profile(self, mock_print, mock_container, tmp_path):
+        import pstats
+        path = str(tmp_path / 'profile')
+        with patch('sys.argv', ['kc-compat.py', '--profile', path]):
+            assert kc_compat.main() == 2
+        assert pstats.Stats(path).total_calls > 0
+
+
+LAZY_MODULES = {'argparse', 'http.client', 'json', 'queue', 'ssl', 'struct', 'threading', 'urllib.request', 'urllib.error'}
+
+
+def imported_modules(code):
+    """
+    Run kc-compat.py module code followed by code in a fresh interpreter
+    :return: names of modules imported by it
+    """
+    import subprocess
+    script = (
+        'import sys\n'
+        'before = set(sys.modules)\n'
+        'path = %r\n'
+        'module = type(sys)("kc_compat")\n'
+        'exec(compile(open(path).read(), path, "exec"), module.__dict__)\n'
+        '%s\n'
+        'print(" ".join(set(sys.modules) - before))\n'
+    ) % (kc_compat.__file__, code)
+    output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+    return set(output.split())
+
+
+class TestStartup:
+    def test_import_is_lazy(self):
+        assert not imported_modules('') & LAZY_MODULES
+
+    def test_container_exit_is_lazy(self):
+        modules = imported_modules('module.detect_container = lambda facts: "openvz"\n'
+                                   'sys.argv = ["kc-compat.py", "--silent"]\n'
+                                   'assert module.main() == 2')
+        assert not modules & LAZY_MODULES
+
+    def test_fast_args_match_argparse(self):
+        fast = kc_compat.parse_args(['-q', '--one-shot'])
+        assert isinstance(fast, kc_compat.Args)
+        full = kc_compat.parse_args(['-q', '--one-shot', '--workers', str(kc_compat.BATCH_WORKERS)])
+        assert vars(fast) == vars(full)
+        assert fast.silent and fast.one_shot
+
+    def test_unknown_args_ignored(self, capsys):
+        args = kc_compat.parse_args(['--bogus', '-j', '--one-shot'])
+        assert args.one_shot
+        assert 'ignoring unknown arguments: --bogus -j' in capsys.readouterr().err
+        kc_compat.parse_args(['-q', '--bogus'])
+        assert capsys.readouterr().err == ''
+
+    def test_usage_error_not_container_exit_code(self, capsys):
+        with pytest.raises(SystemExit) as e:
+            kc_compat.parse_args(['--timeout', 'soon'])
+        # 2 means UNSUPPORTED; INSIDE CONTAINER
+        assert e.value.code == 6
+        assert 'invalid float value' in capsys.readouterr().err
+
+    @patch('sys.argv', ['kc-compat.py', '--one-shot'])
+    @patch.object(kc_compat, 'detect_container', return_value=None)
+    @patch.object(kc_compat, 'is_compat', return_value=False)
+    @patch.object(kc_compat, 'get_distro_info')
+    @patch('builtins.print')
+    def test_main_one_shot(self, mock_print, mock_distro, mock_compat, mock_container):
+        assert kc_compat.main() == 1
+        mock_compat.assert_called_once_with(None, None, ANY, ANY)
+        mock_distro.assert_not_called()
+        assert mock_print.call_args_list[0] == (("NEEDS REVIEW",),)
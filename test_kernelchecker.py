@@ -0,0 +1,1808 @@
+import pytest
+import functools
+import os
+import random
+import re
+import sys
+import time
+import importlib.util
+from unittest.mock import patch, MagicMock
+
+import kernelchecker
+
+KernelChecker = kernelchecker.KernelChecker
+
+
+def process_gone(pid, wait=2):
+    deadline = time.time() + wait
+    while True:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.01)
+
+
+class TestCheckOutput:
+    def test_returns_text(self):
+        assert kernelchecker.check_output(['echo', 'kernel']) == 'kernel\n'
+        assert kernelchecker.check_output(['echo', 'kernel'], 5) == 'kernel\n'
+
+    def test_timeout_kills(self, tmp_path):
+        pid = tmp_path / 'pid'
+        started = time.time()
+        with pytest.raises(OSError):
+            kernelchecker.check_output(['sh', '-c', 'echo $$ > %s; exec sleep 30' % pid], 0.2)
+        assert time.time() - started < 5
+        assert process_gone(int(pid.read_text()), 0)
+
+
+RECORD = {'latest': '5.14.0: "new"', 'current': 'yes', 'distro': 'rpm', 'needs_update': True, 'version': '3.10',
+          'kernelcare': {'installed': False, 'supported': None}, 'timings': [{'name': 'total', 'wall': 1.5,
+                                                                             'exit_codes': [['rpm', 0]]}]}
+
+
+class TestOutput:
+    def test_json(self):
+        import json
+        assert json.loads(kernelchecker.format_record(RECORD, 'json')) == RECORD
+        line = kernelchecker.format_record(RECORD, 'jsonl')
+        assert '\n' not in line and ', "' not in line
+        assert json.loads(line) == RECORD
+
+    def test_yaml(self):
+        yaml = pytest.importorskip('yaml')
+        text = kernelchecker.format_record(RECORD, 'yaml')
+        assert 'distro : rpm\n' in text
+        assert yaml.safe_load(text) == RECORD
+
+    @pytest.mark.parametrize('value, expected', [
+        ('3.10.0-1160.el7.x86_64', '3.10.0-1160.el7.x86_64'),
+        ('3.10', '"3.10"'),
+        ('no', '"no"'),
+        ('', '""'),
+        ('a: b', '"a: b"'),
+        ('#1 SMP', '"#1 SMP"'),
+        (None, 'null'),
+        (False, 'False'),
+    ])
+    def test_yaml_scalar(self, value, expected):
+        assert kernelchecker.yaml_scalar(value) == expected
+
+    def test_msgpack(self):
+        assert kernelchecker.msgpack_dumps({'a': [1, -1, None, True]}) == b'\x81\xa1a\x94\x01\xff\xc0\xc3'
+        assert kernelchecker.msgpack_dumps(300) == b'\xce\x00\x00\x01\x2c'
+        assert kernelchecker.msgpack_dumps(1.5) == b'\xcb?\xf8\x00\x00\x00\x00\x00\x00'
+        assert kernelchecker.msgpack_dumps('x' * 40)[:5] == b'\xdb\x00\x00\x00\x28'
+
+    def test_msgpack_roundtrip(self):
+        msgpack = pytest.importorskip('msgpack')
+        assert msgpack.unpackb(kernelchecker.msgpack_dumps(RECORD)) == RECORD
+
+    def test_writer_streams(self):
+        import io
+        stream = io.StringIO()
+        writer = kernelchecker.RecordWriter('yaml', stream)
+        writer.write({'root': '/a'})
+        writer.write({'root': '/b'})
+        assert stream.getvalue() == 'root : /a\n---\nroot : /b\n'
+        stream = io.StringIO()
+        writer = kernelchecker.RecordWriter('jsonl', stream)
+        writer.write({'root': '/a'})
+        assert stream.getvalue() == '{"root":"/a"}\n'
+
+    def test_main_formats(self, rpm_host, capsys):
+        import json
+        with patch('sys.argv', ['kernelchecker.py', '--no-cache', '-j']):
+            assert kernelchecker.main() == 0
+        out = capsys.readouterr().out
+        assert json.loads(out)['kernelcare'] == {'installed': False, 'up2date': False, 'supported': True}
+        with patch('sys.argv', ['kernelchecker.py', '--no-cache']):
+            kernelchecker.main()
+        out = capsys.readouterr().out
+        assert out.startswith('latest : 3.10.0-1160.2\ncurrent : 3.10.0-1160\ndistro : rpm\n')
+        assert '    supported : True\n' in out
+
+
+class TestSupportedKernel:
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kernelchecker.ProbeClient, 'request', return_value=(200, 'OK'))
+    def test_supported(self, mock_request, mock_hash):
+        assert KernelChecker.is_kernelcare_supported_kernel() == True
+        mock_request.assert_called_once_with('patches.kernelcare.com', '/abcdef123456/version', None)
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kernelchecker.ProbeClient, 'request', return_value=(404, 'Not Found'))
+    def test_not_supported(self, mock_request, mock_hash):
+        assert KernelChecker.is_kernelcare_supported_kernel() == False
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kernelchecker.ProbeClient, 'request', return_value=(200, 'OK'))
+    def test_cached(self, mock_request, mock_hash):
+        cache = kernelchecker.CompatCache()
+        assert KernelChecker.is_kernelcare_supported_kernel(cache) == True
+        assert KernelChecker.is_kernelcare_supported_kernel(kernelchecker.CompatCache()) == True
+        assert mock_request.call_count == 1
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kernelchecker.ProbeClient, 'request', return_value=(404, 'Not Found'))
+    def test_negative_answer_cached(self, mock_request, mock_hash):
+        cache = kernelchecker.CompatCache(negative_ttl=10)
+        assert KernelChecker.is_kernelcare_supported_kernel(cache) == False
+        assert cache.get('abcdef123456') is False
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kernelchecker.ProbeClient, 'request', side_effect=OSError('Connection refused'))
+    @patch.object(kernelchecker.time, 'sleep')
+    def test_connection_error_not_cached(self, mock_sleep, mock_request, mock_hash):
+        cache = kernelchecker.CompatCache()
+        assert KernelChecker.is_kernelcare_supported_kernel(cache) is None
+        assert cache.get('abcdef123456') is None
+        assert mock_request.call_count == kernelchecker.PROBE_RETRIES + 1
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    @patch.object(kernelchecker.ProbeClient, 'request', side_effect=[OSError('Connection reset'), (200, 'OK')])
+    @patch.object(kernelchecker.time, 'sleep')
+    def test_transient_error_retried(self, mock_sleep, mock_request, mock_hash):
+        assert KernelChecker.is_kernelcare_supported_kernel() == True
+        assert mock_sleep.call_count == 1
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    def test_mirror_race(self, mock_hash):
+        def request(client, server, path, headers=None):
+            if server == 'down.example.com':
+                raise OSError('Connection refused')
+            return 200, 'OK'
+        client = kernelchecker.ProbeClient(['down.example.com', 'up.example.com'], retries=0)
+        with patch.object(kernelchecker.ProbeClient, 'request', request):
+            assert KernelChecker.is_kernelcare_supported_kernel(client=client) == True
+
+    @patch.object(KernelChecker, 'get_kernel_hash', return_value='abcdef123456')
+    def test_revalidated(self, mock_hash):
+        def request(client, server, path, headers=None):
+            requests.append(headers)
+            if headers:
+                return 304, 'Not Modified'
+            client.validators[path] = {'last_modified': 'Mon, 05 Oct 2026 10:00:00 GMT'}
+            return 200, 'OK'
+        requests = []
+        with patch.object(kernelchecker.ProbeClient, 'request', request):
+            assert KernelChecker.is_kernelcare_supported_kernel(kernelchecker.CompatCache()) == True
+            assert KernelChecker.is_kernelcare_supported_kernel(kernelchecker.CompatCache(ttl=0)) == True
+        assert requests == [None, {'If-Modified-Since': 'Mon, 05 Oct 2026 10:00:00 GMT'}]
+        assert kernelchecker.CompatCache().get('abcdef123456') is True
+
+    def test_splay(self, rpm_host, capsys):
+        with patch('sys.argv', ['kernelchecker.py', '--no-cache', '--index', '/nonexistent', '--splay', '60']), \
+                patch.object(kernelchecker, 'CompatIndex', return_value=set()), \
+                patch.object(kernelchecker, 'splay_delay', return_value=7.5) as mock_delay, \
+                patch.object(kernelchecker.time, 'sleep') as mock_sleep:
+            assert kernelchecker.main() == 0
+        mock_delay.assert_called_once_with(60)
+        mock_sleep.assert_called_once_with(7.5)
+
+    def test_cache_file_shared_with_kc_compat(self, cache_dir):
+        cache = kernelchecker.CompatCache()
+        cache.put('a' * 40, True)
+        cache.save()
+        assert (cache_dir / 'compat.json').exists()
+
+    def test_cache_shared_by_threads(self):
+        import threading
+        cache = kernelchecker.CompatCache()
+        write_atomic = kernelchecker.write_atomic
+        hashes = [str(i) * 40 for i in range(8)]
+
+        def put(kernel_hash):
+            cache.put(kernel_hash, True)
+            cache.save()
+
+        # other threads put their answers while one is saving
+        with patch.object(kernelchecker, 'write_atomic', lambda *args: time.sleep(0.05) or write_atomic(*args)):
+            threads = [threading.Thread(target=put, args=(h,)) for h in hashes]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        assert [kernelchecker.CompatCache().get(h) for h in hashes] == [True] * 8
+
+
+@pytest.fixture
+def rpm_host(rpm_host):
+    # no patches server to ask
+    with patch.object(KernelChecker, 'is_kernelcare_supported_kernel', return_value=True):
+        yield rpm_host
+
+
+class TestProbes:
+    def test_run_concurrently(self):
+        started = time.time()
+        results = kernelchecker.run_probes({
+            'a': lambda: time.sleep(0.2) or 'a',
+            'b': lambda: time.sleep(0.2) or 'b',
+        })
+        assert results == {'a': 'a', 'b': 'b'}
+        assert time.time() - started < 0.35
+
+    def test_timeout_reported_as_unknown(self):
+        started = time.time()
+        results = kernelchecker.run_probes({
+            'slow': lambda: time.sleep(2),
+            'fast': lambda: 'fast',
+        }, {'slow': 0.1, 'fast': 1})
+        assert results == {'slow': None, 'fast': 'fast'}
+        assert time.time() - started < 1
+
+    def test_failure_reported_as_unknown(self):
+        def fail():
+            raise OSError('No such file')
+        assert kernelchecker.run_probes({'fail': fail}) == {'fail': None}
+
+    def test_kernelchecker(self, rpm_host):
+        checker = KernelChecker()
+        assert checker.current_version == '3.10.0-1160'
+        assert checker.latest_version == '3.10.0-1160.2'
+        assert checker.needs_update == True
+        assert checker.latest_installed == False
+        assert checker.latest_available == True
+        assert checker.kernelcare == (False, False, True)
+
+    def test_kernelchecker_available_timeout(self, rpm_host):
+        with patch.object(kernelchecker.RpmHandler, 'get_available', side_effect=lambda *args: time.sleep(2)):
+            checker = KernelChecker(timeouts={'installed': 1, 'available': 0.1, 'supported': 1})
+        assert checker.available_versions is None
+        # a newer kernel might be available, so whether it is needed is unknown too
+        assert checker.latest_version is None
+        assert checker.needs_update is None
+        assert checker.latest_installed is None
+        assert checker.latest_available is None
+
+    def test_timeout_output(self, rpm_host):
+        with patch.object(kernelchecker.RpmHandler, 'get_installed', side_effect=lambda *args: time.sleep(2)):
+            checker = KernelChecker(timeouts={'installed': 0.1, 'available': 1, 'supported': 1})
+        result = checker.todict()
+        assert (result['latest'], result['needs_update'], result['latest_installed']) == (None, None, None)
+        text = kernelchecker.prometheus_metrics(checker, 0)
+        assert 'latest=""' in text
+        assert 'kernelchecker_needs_update' not in text
+
+    def test_timed_out_command_killed(self, rpm_host):
+        # e.g. yum waiting for the rpmdb lock, it must not keep holding it after the probe gave up
+        pid = rpm_host / 'pid'
+        query = kernelchecker.PackageQuery(['sh', '-c', 'echo $$ > %s; exec sleep 30' % pid], str.split)
+        with patch.object(kernelchecker.RpmHandler, 'query_available', return_value=query):
+            checker = KernelChecker(timeouts={'installed': 1, 'available': 0.3, 'supported': 1})
+        assert checker.available_versions is None
+        assert process_gone(int(pid.read_text()))
+
+    def test_kernelchecker_kcarectl(self, rpm_host):
+        (rpm_host / 'kcarectl').write_text('')
+        with patch.object(KernelChecker, 'is_kernelcare_up2date', return_value=True):
+            checker = KernelChecker()
+        assert checker.kernelcare == (True, True, True)
+
+
+class TestLazy:
+    def test_fields_run_only_their_probes(self, rpm_host):
+        with patch.object(KernelChecker, 'is_kernelcare_supported_kernel') as supported, \
+                patch.object(kernelchecker.RpmHandler, 'get_installed', return_value=['3.10.0-1160']) as installed:
+            checker = KernelChecker(lazy=True)
+            assert checker.inside_container is False
+            assert checker.current_version == '3.10.0-1160'
+            installed.assert_not_called()
+            assert checker.needs_update is True
+            assert checker.latest_version == '3.10.0-1160.2'
+            installed.assert_called_once()
+            supported.assert_not_called()
+            assert checker.kernelcare == (False, False, supported.return_value)
+            supported.assert_called_once()
+            assert [span['name'] for span in checker.timings.spans] == ['installed', 'available', 'supported']
+
+    def test_probes_of_a_field_run_concurrently(self, rpm_host):
+        slow = lambda *args: time.sleep(0.5)
+        with patch.object(kernelchecker.RpmHandler, 'get_installed', side_effect=slow), \
+                patch.object(kernelchecker.RpmHandler, 'get_available', side_effect=slow), \
+                patch.object(KernelChecker, 'is_kernelcare_supported_kernel', side_effect=slow), \
+                patch.object(KernelChecker, 'is_kernelcare_up2date', side_effect=slow):
+            write_script(rpm_host / 'kcarectl', 'exit 0')
+            for field in ('needs_update', 'latest_installed', 'latest_available', 'kernelcare'):
+                checker = KernelChecker(lazy=True)
+                started = time.time()
+                getattr(checker, field)
+                assert time.time() - started < 0.9, field
+
+    def test_refresh(self, rpm_host):
+        checker = KernelChecker(lazy=True)
+        assert checker.latest_installed is False
+        with patch.object(kernelchecker.RpmHandler, 'get_installed', return_value=['3.10.0-1160.2']):
+            assert checker.latest_installed is False
+            checker.refresh()
+            assert checker.latest_installed is True
+            assert checker.todict()['needs_update'] is True
+
+    def test_eager(self, rpm_host):
+        with patch.object(kernelchecker.RpmHandler, 'get_available') as available:
+            checker = KernelChecker()
+            available.assert_called_once()
+            checker.refresh()
+            assert available.call_count == 2
+        assert checker.results['probe:installed'] == ['3.10.0-1160']
+        assert 'total' in [span['name'] for span in checker.timings.spans]
+
+    def test_assigned_fields(self, rpm_host):
+        checker = KernelChecker(lazy=True)
+        checker.current_version = '3.10.0-1160.2'
+        assert checker.needs_update is False
+
+
+def write_script(path, body):
+    path.write_text('#!/bin/sh\n' + body)
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def kcare_state(tmp_path):
+    info = tmp_path / 'info'
+    patches = tmp_path / 'patches'
+    patches.mkdir()
+    with patch.object(kernelchecker, 'KCARE_INFO', str(info)), \
+            patch.object(kernelchecker, 'KCARE_PATCHES_DIR', str(patches)), \
+            patch.object(kernelchecker, 'KCARE_BIN', str(tmp_path / 'missing')), \
+            patch.object(kernelchecker.HostFacts, 'kernel_hash', 'abc'):
+        yield info, patches
+
+
+class TestKcarectl:
+    def test_run_command_drains_output(self, tmp_path):
+        script = write_script(tmp_path / 'noisy', 'head -c 1000000 /dev/zero; head -c 1000000 /dev/zero >&2; exit 1\n')
+        assert kernelchecker.run_command([script], 10) == 1
+
+    def test_run_command_timeout(self, tmp_path):
+        script = write_script(tmp_path / 'slow', 'exec sleep 10\n')
+        started = time.time()
+        timings = kernelchecker.Timings()
+        with timings.span('kcarectl'):
+            assert kernelchecker.run_command([script], 0.2) is None
+        assert time.time() - started < 5
+        assert timings.spans[0]['exit_codes'] == [[script, None]]
+
+    @pytest.mark.parametrize('levels, expected', [
+        (['abc-12', 'abc-11', 'def-20'], True),
+        (['abc-12', 'abc-13'], False),
+        (['def-20'], None),
+    ])
+    def test_state(self, kcare_state, levels, expected):
+        info, patches = kcare_state
+        info.write_text('kpatch-state: patch is applied\nkpatch-level: 12\n')
+        for level in levels:
+            (patches / level).mkdir()
+        assert KernelChecker.kernelcare_state(kernelchecker.HostFacts()) is expected
+        if expected is not None:
+            # kcarectl is missing, so it was not run
+            assert KernelChecker.is_kernelcare_up2date() is expected
+
+    def test_stale_state(self, kcare_state):
+        info, patches = kcare_state
+        info.write_text('kpatch-level: 12\n')
+        (patches / 'abc-12').mkdir()
+        os.utime(str(patches), (0, 0))
+        assert KernelChecker.kernelcare_state(kernelchecker.HostFacts()) is None
+        (patches / 'abc-13').mkdir()
+        os.utime(str(patches), (0, 0))
+        assert KernelChecker.kernelcare_state(kernelchecker.HostFacts()) is False
+
+    def test_fallback_to_kcarectl(self, kcare_state, tmp_path):
+        script = write_script(tmp_path / 'kcarectl', 'echo "No updates"; exit 1\n')
+        with patch.object(kernelchecker, 'KCARE_BIN', script):
+            assert KernelChecker.is_kernelcare_up2date() is True
+        with patch.object(kernelchecker, 'KCARE_BIN', write_script(tmp_path / 'slow', 'exec sleep 10\n')):
+            assert KernelChecker.is_kernelcare_up2date(0.1) is None
+
+
+PRIMARY_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="3">
+<package type="rpm"><name>kernel</name><arch>x86_64</arch><version epoch="0" ver="3.10.0" rel="1160.el7"/></package>
+<package type="rpm"><name>kernel</name><arch>x86_64</arch><version epoch="0" ver="3.10.0" rel="1160.2.1.el7"/></package>
+<package type="rpm"><name>kernel</name><arch>i686</arch><version epoch="0" ver="3.10.0" rel="1160.9.el7"/></package>
+<package type="rpm"><name>kernel-tools</name><arch>x86_64</arch><version epoch="0" ver="3.10.0" rel="1160.9.el7"/></package>
+</metadata>
+'''
+
+APT_PACKAGES = '''Package: linux-image-3.13.0-79-generic
+Version: 3.13.0-79.123
+
+Package: linux-image-3.13.0-85-generic
+Description: Package: linux-image-3.13.0-99-generic
+
+Package: linux-image-3.13.0-85-lowlatency
+
+Package: linux-headers-3.13.0-85-generic
+'''
+
+
+class TestRepoMetadata:
+    def write_primary(self, tmp_path):
+        import gzip
+        repodata = tmp_path / 'base' / 'repodata'
+        repodata.mkdir(parents=True)
+        with gzip.open(str(repodata / 'abc-primary.xml.gz'), 'wb') as f:
+            f.write(PRIMARY_XML.encode())
+        return str(tmp_path / '*/repodata/*primary.xml*')
+
+    def test_apt_lists(self, tmp_path):
+        (tmp_path / 'archive_dists_trusty_main_binary-amd64_Packages').write_text(APT_PACKAGES)
+        with patch.object(kernelchecker, 'APT_LISTS_DIR', str(tmp_path)), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            result = kernelchecker.DpkgHandler('3.13.0-79-generic').get_available()
+        assert result == ['3.13.0-79-generic', '3.13.0-85-generic']
+        mock_output.assert_not_called()
+
+    def test_compressed_apt_lists(self, tmp_path):
+        import gzip
+        with gzip.open(str(tmp_path / 'archive_Packages.gz'), 'wb') as f:
+            f.write(APT_PACKAGES.encode())
+        with patch.object(kernelchecker, 'APT_LISTS_DIR', str(tmp_path)):
+            result = kernelchecker.DpkgHandler('3.13.0-79-generic').get_available()
+        assert result == ['3.13.0-79-generic', '3.13.0-85-generic']
+
+    def test_stale_apt_lists_refreshed(self, tmp_path):
+        (tmp_path / 'archive_Packages').write_text(APT_PACKAGES)
+        with patch.object(kernelchecker, 'APT_LISTS_DIR', str(tmp_path)), \
+                patch.object(kernelchecker, 'check_output', return_value='') as mock_output:
+            kernelchecker.DpkgHandler('3.13.0-79-generic', max_metadata_age=0).get_available()
+        mock_output.assert_any_call(['apt-get', 'update'], None)
+
+    def test_primary_xml(self, tmp_path):
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [self.write_primary(tmp_path)]), \
+                patch.object(kernelchecker.platform, 'machine', return_value='x86_64'), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_available()
+        assert result == ['3.10.0-1160', '3.10.0-1160.2.1']
+        mock_output.assert_not_called()
+
+    def test_primary_sqlite(self, tmp_path):
+        import sqlite3
+        conn = sqlite3.connect(str(tmp_path / 'primary_db.sqlite'))
+        conn.execute('CREATE TABLE packages (name TEXT, arch TEXT, epoch TEXT, version TEXT, release TEXT)')
+        conn.execute("INSERT INTO packages VALUES ('kernel', 'x86_64', '0', '3.10.0', '1160.6.1.el7')")
+        conn.execute("INSERT INTO packages VALUES ('kernel-devel', 'x86_64', '0', '3.10.0', '1160.9.1.el7')")
+        conn.commit()
+        conn.close()
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [str(tmp_path / '*.sqlite')]), \
+                patch.object(kernelchecker.platform, 'machine', return_value='x86_64'):
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_available()
+        assert result == ['3.10.0-1160.6.1']
+
+    def test_missing_metadata_downloaded(self, tmp_path):
+        pattern = str(tmp_path / '*/repodata/*primary.xml*')
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [pattern]), \
+                patch.object(kernelchecker.platform, 'machine', return_value='x86_64'), \
+                patch.object(kernelchecker, 'check_output',
+                             side_effect=lambda args, timeout: self.write_primary(tmp_path) and '') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_available()
+        assert result == ['3.10.0-1160', '3.10.0-1160.2.1']
+        mock_output.assert_called_once_with(['yum', 'makecache'], None)
+
+    def test_no_metadata_falls_back_to_yum(self, tmp_path):
+        yum_output = ('Installed Packages\nkernel.x86_64    3.10.0-1160.el7    @anaconda\n'
+                      'Available Packages\nkernel.x86_64    3.10.0-1160.2.1.el7    updates\n')
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [str(tmp_path / '*.sqlite')]), \
+                patch.object(kernelchecker, 'check_output', return_value=yum_output) as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_available()
+        assert result == ['3.10.0-1160', '3.10.0-1160.2.1']
+        assert mock_output.call_args_list[0][0][0] == ['yum', 'makecache']
+        mock_output.assert_called_with(['yum', '--showduplicates', 'list', 'kernel'], None)
+
+    def write_zstd_primary(self, tmp_path):
+        # gzip data, read by a gzip decompressor standing in for zstd
+        import gzip
+        repodata = tmp_path / 'base' / 'repodata'
+        repodata.mkdir(parents=True)
+        with gzip.open(str(repodata / 'abc-primary.xml.zst'), 'wb') as f:
+            f.write(PRIMARY_XML.encode())
+        return str(tmp_path / '*/repodata/*primary.xml*')
+
+    def test_zstd_primary_xml(self, tmp_path):
+        import zlib
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [self.write_zstd_primary(tmp_path)]), \
+                patch.object(kernelchecker, '_zstd_decompressor',
+                             side_effect=lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)), \
+                patch.object(kernelchecker, 'METADATA_CHUNK', 16), \
+                patch.object(kernelchecker.platform, 'machine', return_value='x86_64'), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_available()
+        assert result == ['3.10.0-1160', '3.10.0-1160.2.1']
+        mock_output.assert_not_called()
+
+    def test_real_zstd_primary_xml(self, tmp_path):
+        zstandard = pytest.importorskip('zstandard')
+        repodata = tmp_path / 'base' / 'repodata'
+        repodata.mkdir(parents=True)
+        (repodata / 'abc-primary.xml.zst').write_bytes(zstandard.ZstdCompressor().compress(PRIMARY_XML.encode()))
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [str(tmp_path / '*/repodata/*primary.xml*')]), \
+                patch.object(kernelchecker.platform, 'machine', return_value='x86_64'):
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_available()
+        assert result == ['3.10.0-1160', '3.10.0-1160.2.1']
+
+    def test_unreadable_metadata_falls_back_to_yum(self, tmp_path):
+        # without a zstd module skipping the repository would miss its kernels
+        pattern = self.write_zstd_primary(tmp_path)
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [pattern]), \
+                patch.object(kernelchecker, '_zstd_decompressor', side_effect=ImportError):
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').query_available()
+            assert kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64', root=str(tmp_path)).query_available() is None
+        assert result.command == ['yum', '--showduplicates', 'list', 'kernel']
+
+    def test_unreadable_apt_lists_fall_back_to_apt(self, tmp_path):
+        (tmp_path / 'archive_Packages.lz4').write_bytes(b'\x04\x22\x4d\x18')
+        with patch.object(kernelchecker, 'APT_LISTS_DIR', str(tmp_path)), \
+                patch.dict(sys.modules, {'lz4': None, 'lz4.frame': None}), \
+                patch.object(kernelchecker, 'package_bindings', return_value=None):
+            result = kernelchecker.DpkgHandler('3.13.0-79-generic').query_available()
+        assert result.command[:3] == ['apt-cache', 'search', '--names-only']
+
+    def test_same_versions_with_and_without_metadata(self, tmp_path):
+        # kernel 3.10.0-1160 is installed, both kernels are in repositories
+        yum_output = ('Installed Packages\nkernel.x86_64    3.10.0-1160.el7    @base\n'
+                      'Available Packages\nkernel.x86_64    3.10.0-1160.2.1.el7    updates\n')
+        handler = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64')
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [self.write_primary(tmp_path)]), \
+                patch.object(kernelchecker.platform, 'machine', return_value='x86_64'), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            fresh = handler.get_available()
+            mock_output.assert_not_called()
+        with patch.object(kernelchecker, 'RPM_METADATA_GLOBS', [str(tmp_path / 'missing')]), \
+                patch.object(kernelchecker, 'check_output', return_value=yum_output):
+            assert handler.get_available() == fresh
+
+
+DPKG_STATUS = '''Package: linux-image-3.13.0-79-generic
+Status: install ok installed
+Version: 3.13.0-79.123
+
+Package: linux-image-3.13.0-77-generic
+Status: deinstall ok config-files
+Version: 3.13.0-77.121
+
+Package: linux-image-3.13.0-85-generic
+Status: install ok installed
+Description: kernel
+ Package: linux-image-3.13.0-99-generic
+
+Package: linux-image-3.13.0-85-lowlatency
+Status: install ok installed
+Package: bash
+Status: install ok installed'''
+
+
+def rpm_header(tags):
+    import struct
+    index, store = b'', b''
+    for tag, value in tags.items():
+        if isinstance(value, int):
+            store += b'\0' * (-len(store) % 4)
+            index += struct.pack('>iiii', tag, 4, len(store), 1)
+            store += struct.pack('>i', value)
+        else:
+            index += struct.pack('>iiii', tag, 6, len(store), 1)
+            store += value.encode() + b'\0'
+    return struct.pack('>ii', len(tags), len(store)) + index + store
+
+
+def make_rpmdb(path, packages):
+    import sqlite3
+    conn = sqlite3.connect(str(path))
+    conn.execute('CREATE TABLE Packages (hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB NOT NULL)')
+    conn.execute('CREATE TABLE Name (key TEXT NOT NULL, hnum INTEGER NOT NULL, idx INTEGER NOT NULL)')
+    for name, epoch, version, release in packages:
+        tags = {1000: name, 1001: version, 1002: release, 1022: 'x86_64'}
+        if epoch is not None:
+            tags[1003] = epoch
+        cursor = conn.execute('INSERT INTO Packages (blob) VALUES (?)', (rpm_header(tags),))
+        conn.execute('INSERT INTO Name VALUES (?, ?, 0)', (name, cursor.lastrowid))
+    conn.commit()
+    conn.close()
+
+
+class TestPackageRecords:
+    @pytest.mark.parametrize('name, expected', [
+        ('linux-image-5.15.0-91-generic', ('5.15.0', '91', 'generic')),
+        ('linux-image-6.1.0-13-rt-amd64', ('6.1.0', '13', 'rt-amd64')),
+        ('linux-image-6.1.0-13-cloud-amd64', ('6.1.0', '13', 'cloud-amd64')),
+        ('linux-image-6.1.0-13-amd64-unsigned', ('6.1.0', '13', 'amd64')),
+        ('linux-image-5.15.0-1034-azure-fde', ('5.15.0', '1034', 'azure-fde')),
+        ('pve-kernel-5.15.107-2-pve', ('5.15.107', '2', 'pve')),
+        ('proxmox-kernel-6.8.12-4-pve-signed', ('6.8.12', '4', 'pve')),
+        ('linux-image-generic', None),
+        ('linux-image-generic-hwe-22.04', None),
+        ('linux-headers-5.15.0-91-generic', None),
+    ])
+    def test_deb_names(self, name, expected):
+        record = kernelchecker.deb_package_record(name)
+        if expected is None:
+            assert record is None
+        else:
+            assert (record.version, record.release, record.flavor) == expected
+            assert record.name == name
+
+    @pytest.mark.parametrize('name, flavor', [
+        ('kernel', ''),
+        ('kernel-ml', 'ml'),
+        ('kernel-lt', 'lt'),
+        ('kernel-rt', 'rt'),
+        ('kernel-rt-debug', 'rt-debug'),
+        ('kernel-debug', 'debug'),
+        ('kernel-xen', ''),
+        ('vzkernel', ''),
+        ('kernel-devel', None),
+        ('kernel-rt-debug-devel', None),
+        ('kernel-modules-extra', None),
+        ('kernel-debuginfo-common-x86_64', None),
+        ('kernelshark', None),
+    ])
+    def test_rpm_names(self, name, flavor):
+        record = kernelchecker.rpm_package_record(name, None, '4.18.0', '372.el8', 'x86_64')
+        if flavor is None:
+            assert record is None
+        else:
+            assert record.flavor == flavor
+
+    def test_compact(self):
+        record = kernelchecker.PackageRecord('kernel', '1', '3.10.0', '1160.el7', '', 'x86_64')
+        assert not hasattr(record, '__dict__')
+        assert record == kernelchecker.PackageRecord('kernel', '1', '3.10.0', '1160.el7', '', 'x86_64')
+        assert record != kernelchecker.PackageRecord('kernel', '1', '3.10.0', '1160.el7', 'rt', 'x86_64')
+
+    def test_parse_yum(self):
+        output = ('Loaded plugins: fastestmirror\n'
+                  'Updated Packages\n'
+                  'kernel.x86_64                 3.10.0-1160.2.1.el7          updates\n'
+                  'kernel-devel.x86_64           3.10.0-1160.2.1.el7          updates\n'
+                  'kernel-rt-debug-modules-extra.x86_64\n'
+                  '                              4.18.0-372.rt7.el8           rt\n'
+                  'kernel-ml.x86_64\n'
+                  '                              1:6.5.7-1.el8.elrepo         elrepo-kernel\n')
+        assert list(kernelchecker.parse_packages(output.splitlines(), 'yum')) == [
+            kernelchecker.PackageRecord('kernel', None, '3.10.0', '1160.2.1.el7', '', 'x86_64'),
+            kernelchecker.PackageRecord('kernel-ml', '1', '6.5.7', '1.el8.elrepo', 'ml', 'x86_64'),
+        ]
+
+    def test_parse_rpm(self):
+        output = '3.10.0-1160.el7\npackage kernel-rt is not installed\n1:3.10.0-1160.2.1.el7\n'
+        assert [(r.epoch, r.version, r.release) for r in kernelchecker.parse_packages(output.splitlines(), 'rpm')] \
+            == [(None, '3.10.0', '1160.el7'), ('1', '3.10.0', '1160.2.1.el7')]
+
+    def test_parse_dpkg_query(self):
+        output = ('linux-image-3.13.0-79-generic\t3.13.0-79.123\n'
+                  'linux-image-3.13.0-77-generic\t\n'
+                  'linux-headers-3.13.0-79\t3.13.0-79.123\n')
+        assert [r.name for r in kernelchecker.parse_packages(output.splitlines(), 'deb')] == \
+            ['linux-image-3.13.0-79-generic']
+
+    @pytest.mark.parametrize('release, versions', [
+        ('6.1.0-13-amd64', ['6.1.0-13-amd64', '6.1.0-15-amd64']),
+        ('6.1.0-13-rt-amd64', ['6.1.0-13-rt-amd64']),
+        ('6.1.0-13-cloud-amd64', ['6.1.0-15-cloud-amd64']),
+    ])
+    def test_dpkg_flavors(self, release, versions):
+        names = ['linux-image-6.1.0-13-amd64', 'linux-image-6.1.0-13-rt-amd64', 'linux-image-6.1.0-15-cloud-amd64',
+                 'linux-image-6.1.0-15-amd64', 'linux-image-6.1.0-15-amd64-unsigned', 'linux-image-5.10.0-26-amd64']
+        assert kernelchecker.DpkgHandler(release).filter_versions(names) == versions
+
+    def test_dpkg_proxmox(self):
+        names = ['pve-kernel-5.15.107-2-pve', 'proxmox-kernel-5.15.108-1-pve-signed', 'linux-image-5.15.0-91-generic']
+        assert kernelchecker.DpkgHandler('5.15.107-2-pve').filter_versions(names) == \
+            ['5.15.107-2-pve', '5.15.108-1-pve']
+
+    @pytest.mark.parametrize('release, name', [
+        ('3.10.0-1160.el7.x86_64', 'kernel'),
+        ('2.6.32-042stab145.3', 'vzkernel'),
+        ('4.18.0-372.9.1.rt7.166.el8.x86_64', 'kernel-rt'),
+        ('5.4.17-2136.300.7.el8uek.x86_64', 'kernel-uek'),
+        ('5.14.0-362.8.1.el9_3.x86_64+debug', 'kernel-debug'),
+        ('3.10.0-1160.80.1.vz7.191.4', 'vzkernel'),
+        ('5.14.0-427.18.1.el9_4.aarch64+64k', 'kernel-64k'),
+    ])
+    def test_rpm_flavors(self, release, name):
+        assert kernelchecker.RpmHandler(release).kernel_name == name
+
+    def test_strip_version(self):
+        strip = kernelchecker.RpmHandler.strip_version
+        assert strip('3.10.0-1160.2.1.el7.x86_64') == '3.10.0-1160.2.1'
+        assert strip('1:3.10.0-1160.el7') == '3.10.0-1160'
+        assert strip('4.18.0-372.9.1.rt7.166.el8') == '4.18.0-372.9.1'
+
+    def test_get_version(self):
+        assert KernelChecker.get_version('kernel-ml-6.5.7-1.el8') == '6.5.7-1.el8'
+        assert KernelChecker.get_version('kernel-3.10.0-1160.el7') == '3.10.0-1160.el7'
+        assert KernelChecker.get_version('linux-image-5.15.0-91-generic') == '5.15.0-91-generic'
+        assert KernelChecker.get_version('kernel-devel-3.10.0-1160.el7') is None
+        assert KernelChecker.get_version('bash-5.1-2') is None
+
+
+class TestPackageDatabase:
+    def test_read_dpkg_status(self, tmp_path):
+        status = tmp_path / 'status'
+        status.write_text(DPKG_STATUS)
+        result = list(kernelchecker.read_dpkg_status(str(status), 'linux-image-3.13.0-*-generic'))
+        assert result == ['linux-image-3.13.0-79-generic', 'linux-image-3.13.0-85-generic']
+
+    def test_dpkg_installed(self, tmp_path):
+        status = tmp_path / 'status'
+        status.write_text(DPKG_STATUS)
+        with patch.object(kernelchecker, 'DPKG_STATUS', str(status)), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            result = kernelchecker.DpkgHandler('3.13.0-79-generic').get_installed()
+        assert result == ['3.13.0-79-generic', '3.13.0-85-generic']
+        mock_output.assert_not_called()
+
+    def test_parse_rpm_header(self):
+        header = rpm_header({1000: 'kernel', 1001: '3.10.0', 1003: 1})
+        assert kernelchecker.parse_rpm_header(header, (1001, 1003)) == {1001: '3.10.0', 1003: 1}
+
+    def test_rpm_installed(self, tmp_path):
+        rpmdb = tmp_path / 'rpmdb.sqlite'
+        make_rpmdb(rpmdb, [('kernel', None, '3.10.0', '1160.el7'),
+                           ('kernel', 1, '3.10.0', '1160.2.1.el7'),
+                           ('kernel-tools', None, '3.10.0', '1160.9.1.el7')])
+        with patch.object(kernelchecker, 'RPMDB_SQLITE', [str(rpmdb)]), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_installed()
+        assert sorted(result) == ['3.10.0-1160', '3.10.0-1160.2.1']
+        mock_output.assert_not_called()
+
+    def test_broken_rpmdb_falls_back_to_rpm(self, tmp_path):
+        rpmdb = tmp_path / 'rpmdb.sqlite'
+        rpmdb.write_text('not a database')
+        with patch.object(kernelchecker, 'RPMDB_SQLITE', [str(rpmdb)]), \
+                patch.object(kernelchecker, 'PACKAGE_BINDINGS', ()), \
+                patch.object(kernelchecker, 'check_output', return_value='3.10.0-1160.el7\n') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64').get_installed()
+        assert result == ['3.10.0-1160']
+        mock_output.assert_called_once()
+
+    def test_rpm_bindings(self, tmp_path):
+        rpm = MagicMock()
+        rpm.TransactionSet.return_value.dbMatch.return_value = [
+            {'epoch': None, 'version': b'3.10.0', 'release': b'1160.el7', 'arch': b'x86_64'},
+            {'epoch': 1, 'version': '3.10.0', 'release': '1160.2.1.el7', 'arch': 'x86_64'},
+        ]
+        with patch.object(kernelchecker, 'RPMDB_SQLITE', [str(tmp_path / 'missing')]), \
+                patch.object(kernelchecker, 'package_bindings', return_value=rpm), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64', root='/mnt/image').get_installed()
+        assert result == ['3.10.0-1160', '3.10.0-1160.2.1']
+        rpm.TransactionSet.assert_called_once_with('/mnt/image')
+        rpm.TransactionSet.return_value.dbMatch.assert_called_once_with('name', 'kernel')
+        mock_output.assert_not_called()
+
+    def test_apt_bindings(self, tmp_path):
+        from types import SimpleNamespace
+        apt_pkg = MagicMock()
+        apt_pkg.Cache.return_value.packages = [
+            SimpleNamespace(name='linux-image-3.13.0-85-generic', current_ver=None, has_versions=True),
+            SimpleNamespace(name='linux-image-3.13.0-79-generic', current_ver=object(), has_versions=True),
+            SimpleNamespace(name='linux-image-3.13.0-79-lowlatency', current_ver=object(), has_versions=True),
+            SimpleNamespace(name='linux-image-3.13.0-91-generic', current_ver=None, has_versions=False),
+        ]
+        with patch.object(kernelchecker, 'DPKG_STATUS', str(tmp_path / 'missing')), \
+                patch.object(kernelchecker, 'APT_LISTS_DIR', str(tmp_path)), \
+                patch.object(kernelchecker, 'package_bindings', return_value=apt_pkg), \
+                patch.object(kernelchecker, 'check_output') as mock_output:
+            handler = kernelchecker.DpkgHandler('3.13.0-79-generic')
+            assert handler.get_installed() == ['3.13.0-79-generic']
+            assert handler.get_available() == ['3.13.0-79-generic', '3.13.0-85-generic']
+        # only apt-get update is run
+        mock_output.assert_called_once_with(['apt-get', 'update'], None)
+
+    def test_broken_bindings_fall_back(self, tmp_path):
+        apt_pkg = MagicMock()
+        apt_pkg.init.side_effect = SystemError('E:Unable to lock directory /var/lib/dpkg/')
+        with patch.object(kernelchecker, 'DPKG_STATUS', str(tmp_path / 'missing')), \
+                patch.object(kernelchecker, 'package_bindings', return_value=apt_pkg), \
+                patch.object(kernelchecker, 'check_output', return_value='linux-image-3.13.0-79-generic\t3.13.0-79.123\n'):
+            assert kernelchecker.DpkgHandler('3.13.0-79-generic').get_installed() == ['3.13.0-79-generic']
+
+    def test_bindings_disabled(self):
+        with patch.object(kernelchecker, 'PACKAGE_BINDINGS', ()):
+            assert kernelchecker.package_bindings('rpm') is None
+        with patch.dict(sys.modules, {'apt_pkg': MagicMock(__name__='apt_pkg')}):
+            assert kernelchecker.package_bindings('apt_pkg') is sys.modules['apt_pkg']
+
+    def test_cached_while_database_unchanged(self, tmp_path, cache_dir):
+        status = tmp_path / 'status'
+        status.write_text(DPKG_STATUS)
+        compute = MagicMock(return_value=['3.13.0-79-generic'])
+        for _ in range(2):
+            result = kernelchecker.cached_by_signature([str(status)], 'key', compute, str(cache_dir))
+        assert result == ['3.13.0-79-generic']
+        assert compute.call_count == 1
+        status.write_text(DPKG_STATUS + '\n')
+        kernelchecker.cached_by_signature([str(status)], 'key', compute, str(cache_dir))
+        assert compute.call_count == 2
+
+    def test_not_cached_without_cache_dir(self, tmp_path):
+        compute = MagicMock(return_value=[])
+        kernelchecker.cached_by_signature([str(tmp_path)], 'key', compute)
+        kernelchecker.cached_by_signature([str(tmp_path)], 'key', compute)
+        assert compute.call_count == 2
+
+
+def make_tree(root, files):
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(data, bytes):
+            path.write_bytes(data)
+        else:
+            path.write_text(data)
+    return str(root)
+
+
+class TestHostFacts:
+    def test_kernel(self, tmp_path):
+        import hashlib
+        version = b'Linux version 5.14.0-70.el9.x86_64 (mockbuild@example.com) #1 SMP\n'
+        facts = kernelchecker.HostFacts(make_tree(tmp_path, {'proc/version': version}))
+        assert facts.kernel_release == '5.14.0-70.el9.x86_64'
+        assert facts.kernel_hash == hashlib.sha1(version).hexdigest()
+
+    def test_no_proc_version_in_image(self, tmp_path):
+        facts = kernelchecker.HostFacts(str(tmp_path))
+        assert facts.kernel_release is None
+        with pytest.raises(IOError):
+            facts.kernel_hash
+
+    @pytest.mark.parametrize('os_release, expected', [
+        ('ID="almalinux"\nID_LIKE="rhel centos fedora"\nVERSION_ID="9.1"\n', 'rpm'),
+        ('ID=linuxmint\nID_LIKE="ubuntu debian"\n', 'dpkg'),
+        ('ID=centos\n', 'rpm'),
+        ('# comment\nID=arch\n', 'unknown'),
+    ])
+    def test_distro_type(self, tmp_path, os_release, expected):
+        facts = kernelchecker.HostFacts(make_tree(tmp_path, {'etc/os-release': os_release}))
+        assert KernelChecker.get_distro_type(facts) == expected
+
+    def test_distro_type_by_package_manager(self, tmp_path):
+        facts = kernelchecker.HostFacts(make_tree(tmp_path, {'usr/bin/dpkg': ''}))
+        assert facts.distro_id is None
+        assert KernelChecker.get_distro_type(facts) == 'dpkg'
+
+    def test_os_release_fields(self, tmp_path):
+        facts = kernelchecker.HostFacts(make_tree(tmp_path, {
+            'usr/lib/os-release': 'ID=ubuntu\nVERSION_ID="22.04"\nID_LIKE=debian\n'}))
+        assert (facts.distro_id, facts.distro_version, facts.distro_like) == ('ubuntu', '22.04', ['debian'])
+
+    @pytest.mark.parametrize('files, expected', [
+        ({}, None),
+        ({'proc/1/cgroup': '0::/init.scope\n'}, None),
+        ({'proc/vz/veinfo': ''}, 'openvz'),
+        ({'proc/vz/veinfo': '', 'proc/vz/version': ''}, None),
+        ({'run/systemd/container': 'systemd-nspawn\n'}, 'systemd-nspawn'),
+        ({'proc/1/environ': b'PATH=/bin\0container=lxc\0', 'proc/1/cgroup': '0::/\n'}, 'lxc'),
+        ({'run/.containerenv': ''}, 'podman'),
+        ({'.dockerenv': ''}, 'docker'),
+        ({'proc/1/cgroup': '4:pids:/lxc/web\n'}, 'lxc'),
+        ({'proc/1/cgroup': '12:cpu:/docker/0123abcd\n'}, 'docker'),
+        ({'proc/1/cgroup': '0::/machine.slice/libpod-0123abcd.scope\n'}, 'podman'),
+    ])
+    def test_container(self, tmp_path, files, expected):
+        assert kernelchecker.HostFacts(make_tree(tmp_path, files)).container == expected
+
+    def test_cgroup_version(self, tmp_path):
+        assert kernelchecker.HostFacts(str(tmp_path)).cgroup_version == 1
+        root = make_tree(tmp_path, {'sys/fs/cgroup/cgroup.controllers': 'cpu memory\n'})
+        assert kernelchecker.HostFacts(root).cgroup_version == 2
+
+    def test_files_read_once(self, tmp_path):
+        import builtins
+        root = make_tree(tmp_path, {'proc/1/cgroup': '4:pids:/lxc/web\n',
+                                    'proc/version': b'Linux version 5.14.0 #1\n'})
+        facts = kernelchecker.HostFacts(root)
+        with patch('builtins.open', side_effect=builtins.open) as mock_file:
+            for _ in range(2):
+                facts.container, facts.init_cgroup, facts.kernel_release, facts.kernel_hash
+        opened = [call[0][0] for call in mock_file.call_args_list]
+        assert len(opened) == len(set(opened))
+
+
+def make_dpkg_root(root, modules=('3.13.0-79-generic', '3.13.0-85-generic')):
+    for directory in ('usr/bin', 'var/lib/dpkg', 'var/lib/apt/lists'):
+        (root / directory).mkdir(parents=True)
+    (root / 'usr/bin/dpkg').write_text('')
+    (root / 'var/lib/dpkg/status').write_text(DPKG_STATUS)
+    (root / 'var/lib/apt/lists/archive_Packages').write_text(APT_PACKAGES)
+    for release in modules:
+        (root / 'lib/modules' / release).mkdir(parents=True)
+    return root
+
+
+class TestRoot:
+    def test_dpkg_root(self, tmp_path):
+        root = make_dpkg_root(tmp_path / 'image')
+        with patch.object(kernelchecker, 'check_output') as mock_output:
+            checker = KernelChecker(root=str(root))
+        mock_output.assert_not_called()
+        assert checker.distro_type == 'dpkg'
+        assert checker.current_version == '3.13.0-85-generic'
+        assert checker.installed_versions == ['3.13.0-79-generic', '3.13.0-85-generic']
+        assert checker.available_versions == ['3.13.0-79-generic', '3.13.0-85-generic']
+        assert checker.needs_update == False
+        assert checker.inside_container == False
+        # no /proc/version in the image
+        assert checker.kernelcare == (False, False, None)
+
+    def test_kernel_image_banner(self, tmp_path):
+        import hashlib
+        root = make_dpkg_root(tmp_path / 'image')
+        banner = b'Linux version 3.13.0-85-generic (buildd@example.com) #129-Ubuntu SMP\n'
+        (root / 'lib/modules/3.13.0-85-generic/vmlinuz').write_bytes(b'MZ' + b'\0' * 100 + banner)
+        (root / 'boot').mkdir()
+        (root / 'boot/vmlinuz-3.13.0-79-generic').write_bytes(b'MZ' + banner.replace(b'-85-', b'-79-'))
+        requests = []
+
+        def request(client, server, path, headers=None):
+            requests.append(path)
+            return 200, 'OK'
+
+        with patch.object(kernelchecker.ProbeClient, 'request', request):
+            checker = KernelChecker(root=str(root))
+        # no /proc/version in the image, the newest kernel image tells the kernel it boots
+        assert checker.kernelcare == (False, False, True)
+        assert requests == ['/%s/version' % hashlib.sha1(banner).hexdigest()]
+        assert checker.current_version == '3.13.0-85-generic'
+
+    def test_stale_lists_not_refreshed(self, tmp_path):
+        root = make_dpkg_root(tmp_path / 'image', ['3.13.0-79-generic'])
+        lists = root / 'var/lib/apt/lists'
+        os.utime(str(lists / 'archive_Packages'), (0, 0))
+        os.utime(str(lists), (0, 0))
+        with patch.object(kernelchecker, 'check_output') as mock_output:
+            checker = KernelChecker(root=str(root))
+        mock_output.assert_not_called()
+        assert checker.latest_version == '3.13.0-85-generic'
+        assert checker.latest_installed == True
+
+    def test_no_metadata(self, tmp_path):
+        root = make_dpkg_root(tmp_path / 'image')
+        (root / 'var/lib/apt/lists/archive_Packages').unlink()
+        checker = KernelChecker(root=str(root))
+        assert checker.available_versions is None
+        assert checker.latest_available is None
+
+    def test_rpm_fallback_uses_root(self, tmp_path):
+        with patch.object(kernelchecker, 'RPMDB_SQLITE', ['/missing/rpmdb.sqlite']), \
+                patch.object(kernelchecker, 'check_output', return_value='3.10.0-1160.el7\n') as mock_output:
+            result = kernelchecker.RpmHandler('3.10.0-1160.el7.x86_64', root=str(tmp_path)).get_installed()
+        assert result == ['3.10.0-1160']
+        assert mock_output.call_args[0][0][1:3] == ['--root', str(tmp_path)]
+
+    def test_check_roots(self, tmp_path):
+        roots = [str(make_dpkg_root(tmp_path / name)) for name in ('a', 'b')] + [str(tmp_path / 'missing')]
+        options = vars(kernelchecker.parse_args(['--no-cache']))
+        results = dict((root, (result, error)) for root, result, error in
+                       kernelchecker.check_roots(roots, options, workers=2))
+        assert sorted(results) == sorted(roots)
+        for root in roots[:2]:
+            result, error = results[root]
+            assert error is None
+            assert result['current'] == '3.13.0-85-generic'
+        result, error = results[roots[2]]
+        assert result is None and 'no kernels found' in error
+
+    def test_roots_main(self, tmp_path, capsys):
+        import json
+        roots = [str(make_dpkg_root(tmp_path / name)) for name in ('a', 'b')]
+        with patch('sys.argv', ['kernelchecker.py', '--no-cache', '--root'] + roots):
+            assert kernelchecker.main() == 0
+        records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert sorted(record['root'] for record in records) == roots
+        assert all(record['needs_update'] is False for record in records)
+
+    def test_roots_main_msgpack(self, tmp_path, capfdbinary):
+        roots = [str(make_dpkg_root(tmp_path / name)) for name in ('a', 'b')]
+        assert kernelchecker.roots_main(roots, vars(kernelchecker.parse_args(['--no-cache'])), 1, 'msgpack') == 0
+        out = capfdbinary.readouterr().out
+        assert out.count(b'\xa4root') == 2 and out.startswith(b'\x89')
+
+
+def compare(key, a, b):
+    return (key(a) > key(b)) - (key(a) < key(b))
+
+
+class TestVersionKeys:
+    # (a, b, expected result of comparing a to b), mostly from rpm and dpkg test suites
+    RPM_CASES = [
+        ('1.0', '1.0', 0), ('1.0', '2.0', -1), ('2.0.1', '2.0', 1), ('2.0.1a', '2.0.1', 1),
+        ('5.5p1', '5.5p2', -1), ('5.5p10', '5.5p1', 1), ('10xyz', '10.1xyz', -1), ('xyz10', 'xyz10.1', -1),
+        ('10.0001', '10.1', 0), ('6.0.rc1', '6.0', 1), ('10b2', '10a1', 1), ('1.0a', '1.0.1', -1),
+        ('1.0~rc1', '1.0', -1), ('1.0~rc1', '1.0~rc2', -1), ('1.0~rc1~git123', '1.0~rc1', -1),
+        ('1.0^', '1.0', 1), ('1.0^git1', '1.01', -1), ('1.0^20160101', '1.0.1', -1), ('1.0^git1', '1.0~rc1', 1),
+        ('1.0_1', '1.0.1', 0), ('a', '1', -1),
+    ]
+
+    DPKG_CASES = [
+        ('1.0', '1.0', 0), ('1.0', '1.0-1', -1), ('1.0-0', '1.0', 0), ('1.0~rc1', '1.0', -1),
+        ('1:0.9', '2.0', 1), ('1.0+dfsg', '1.0', 1), ('1.0a', '1.0+', -1), ('1.0', '1.0a', -1),
+        ('1.0~~', '1.0~', -1), ('1.0~', '1.0', -1), ('2.6.32-5', '2.6.32-10', -1),
+        ('3.13.0-85-generic', '3.13.0-79-generic', 1), ('4.15.0-1009-aws', '4.15.0-101-aws', 1),
+        ('0~rc1', '0', -1), ('1.0-0~rc1', '1.0-0', -1), ('0', '', 0),
+    ]
+
+    @pytest.mark.parametrize('a, b, expected', RPM_CASES)
+    def test_rpm_version(self, a, b, expected):
+        assert compare(kernelchecker.rpm_version_key, a, b) == expected
+        assert compare(kernelchecker.rpm_version_key, b, a) == -expected
+
+    @pytest.mark.parametrize('a, b, expected', DPKG_CASES)
+    def test_dpkg_version(self, a, b, expected):
+        assert compare(kernelchecker.dpkg_version_key, a, b) == expected
+        assert compare(kernelchecker.dpkg_version_key, b, a) == -expected
+
+    def test_rpm_evr(self):
+        key = kernelchecker.rpm_evr_key
+        assert compare(key, '1:3.10.0-1160', '4.18.0-1') == 1
+        assert compare(key, '3.10.0-1160.2', '3.10.0-1160.11') == -1
+        assert compare(key, '3.10.0-1160', '3.10.0-1160') == 0
+
+    def test_latest(self, rpm_host):
+        with patch.object(kernelchecker.RpmHandler, 'get_installed', return_value=['3.10.0-1160.11', '3.10.0-1160']), \
+                patch.object(kernelchecker.RpmHandler, 'get_available', return_value=['3.10.0-1160.2.1']):
+            checker = KernelChecker()
+        assert checker.latest_version == '3.10.0-1160.11'
+        assert checker.installed_versions == ['3.10.0-1160', '3.10.0-1160.11']
+        assert checker.latest_installed == True
+        assert checker.latest_available == False
+
+    def test_key_memoized(self):
+        key = MagicMock(side_effect=lambda version: version)
+        memoized = kernelchecker.memoize_key(key)
+        sorted(['b', 'a', 'b', 'a'], key=memoized)
+        max(['a', 'b'], key=memoized)
+        assert key.call_count == 2
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kernel_corpus.tsv')
+
+
+def load_corpus():
+    """
+    :return: (distro, format, package, version, flavor) rows of kernel_corpus.tsv
+    """
+    with open(CORPUS) as f:
+        return [tuple((line.rstrip('\n').split('\t') + [''])[:5]) for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+def split_nevra(nevra):
+    rest, arch = nevra.rsplit('.', 1)
+    name, version, release = rest.rsplit('-', 2)
+    return name, version, release, arch
+
+
+def corpus_groups(rows):
+    """
+    :return: dict of (distro, flavor, arch) -> kernel packages of rows from oldest to newest
+    """
+    groups = {}
+    for distro, fmt, package, version, flavor in rows:
+        if version != '-':
+            arch = split_nevra(package)[3] if fmt == 'rpm' else None
+            groups.setdefault((distro, flavor, arch), []).append((package, version))
+    return groups
+
+
+def unique(values):
+    result = []
+    for value in values:
+        if value not in result:
+            result.append(value)
+    return result
+
+
+class TestCorpus:
+    ROWS = load_corpus()
+    RPM = [row for row in ROWS if row[1] == 'rpm']
+    DEB = [row for row in ROWS if row[1] == 'deb']
+    GROUPS = sorted(corpus_groups(ROWS).items())
+
+    def test_coverage(self):
+        assert len(self.ROWS) >= 500
+        assert set(row[1] for row in self.ROWS) == {'rpm', 'deb'}
+        assert all(len(row) == 5 and row[0] and row[2] for row in self.ROWS)
+
+    @pytest.mark.parametrize('wrapped', [False, True])
+    def test_yum_records(self, wrapped):
+        lines = ['Available Packages']
+        for _, _, package, _, _ in self.RPM:
+            name, version, release, arch = split_nevra(package)
+            if wrapped:
+                lines += ['%s.%s' % (name, arch), '        %s-%s    baseos' % (version, release)]
+            else:
+                lines.append('%s.%s    %s-%s    baseos' % (name, arch, version, release))
+        records = list(kernelchecker.parse_packages(lines, 'yum'))
+        kernels = [row for row in self.RPM if row[3] != '-']
+        expected = []
+        for _, _, package, _, flavor in kernels:
+            name, version, release, arch = split_nevra(package)
+            expected.append(kernelchecker.PackageRecord(name, None, version, release, flavor, arch))
+        assert records == expected
+        assert kernelchecker.RpmHandler.versions(records) == [version for _, _, _, version, _ in kernels]
+
+    def test_rpm_output(self):
+        kernels = [row for row in self.RPM if row[3] != '-']
+        output = ''.join('%s-%s\n' % split_nevra(package)[1:3] for _, _, package, _, _ in kernels)
+        assert kernelchecker.RpmHandler.parse_rpm_output(output) == [version for _, _, _, version, _ in kernels]
+
+    def test_rpm_running_kernel(self):
+        for _, _, package, version, flavor in self.RPM:
+            if version == '-':
+                continue
+            name, ver, release, arch = split_nevra(package)
+            uname = '%s-%s.%s' % (ver, release, arch)
+            # variants built from the same sources show in uname -r only as a suffix
+            if flavor in ('debug', '64k'):
+                uname += '+' + flavor
+            assert kernelchecker.RpmHandler.strip_version(uname) == version
+            # kernel-ml and kernel-lt releases are not told apart from those of kernel
+            if flavor not in ('ml', 'lt'):
+                assert kernelchecker.RpmHandler(uname).kernel_name == name, uname
+
+    def test_deb_records(self):
+        records = list(kernelchecker.parse_packages([row[2] for row in self.DEB], 'deb'))
+        kernels = [row for row in self.DEB if row[3] != '-']
+        assert [record.name for record in records] == [package for _, _, package, _, _ in kernels]
+        assert [('%s-%s-%s' % (record.version, record.release, record.flavor), record.flavor) for record in records] \
+            == [(version, flavor) for _, _, _, version, flavor in kernels]
+
+    def test_deb_filter(self):
+        names = [row[2] for row in self.DEB]
+        for (_, flavor, _), kernels in self.GROUPS:
+            if kernels[0][0] not in names:
+                continue
+            handler = kernelchecker.DpkgHandler(kernels[0][1])
+            assert handler.filter_versions(names) == unique(
+                version for _, _, _, version, other in self.DEB
+                if other == flavor and version.split('.')[:2] == handler.series.split('.'))
+
+    def test_order(self):
+        for group, kernels in self.GROUPS:
+            if group[2] is None:
+                versions = unique(version for _, version in kernels)
+                key = kernelchecker.dpkg_version_key
+            else:
+                versions = unique('%s-%s' % split_nevra(package)[1:3] for package, _ in kernels)
+                key = kernelchecker.rpm_evr_key
+                # short versions order the same way
+                assert sorted(reversed(unique(version for _, version in kernels)), key=key) == \
+                    unique(version for _, version in kernels), group
+            assert sorted(reversed(versions), key=key) == versions, group
+            assert all(key(a) < key(b) for a, b in zip(versions, versions[1:])), group
+
+    @pytest.mark.parametrize('seed', range(5))
+    def test_latest(self, seed):
+        rng = random.Random(seed)
+        for group, kernels in self.GROUPS:
+            versions = unique(version for _, version in kernels)
+            shuffled = rng.sample(versions, len(versions))
+            checker = KernelChecker(lazy=True)
+            checker.distro_type = 'rpm' if group[2] else 'dpkg'
+            split = rng.randint(1, len(shuffled))
+            checker.current_version = shuffled[0]
+            checker.installed_versions = checker.sort_versions(shuffled[:split])
+            checker.available_versions = checker.sort_versions(shuffled[split:])
+            assert checker.get_latest() == versions[-1], group
+            assert checker.sort_versions(shuffled) == versions, group
+
+
+def rpmvercmp(a, b):
+    """
+    Reference comparison of rpm versions, python port of rpmvercmp of rpm 4.16
+    """
+    if a == b:
+        return 0
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while i < len(a) and not a[i].isalnum() and a[i] not in '~^':
+            i += 1
+        while j < len(b) and not b[j].isalnum() and b[j] not in '~^':
+            j += 1
+        if a[i:i + 1] == '~' or b[j:j + 1] == '~':
+            if a[i:i + 1] != '~':
+                return 1
+            if b[j:j + 1] != '~':
+                return -1
+            i, j = i + 1, j + 1
+            continue
+        if a[i:i + 1] == '^' or b[j:j + 1] == '^':
+            if i == len(a):
+                return -1
+            if j == len(b):
+                return 1
+            if a[i] != '^':
+                return 1
+            if b[j] != '^':
+                return -1
+            i, j = i + 1, j + 1
+            continue
+        if i == len(a) or j == len(b):
+            break
+        start_a, start_b = i, j
+        isnum = a[i].isdigit()
+        same_kind = str.isdigit if isnum else str.isalpha
+        while i < len(a) and same_kind(a[i]):
+            i += 1
+        while j < len(b) and same_kind(b[j]):
+            j += 1
+        one, two = a[start_a:i], b[start_b:j]
+        if not two:
+            return 1 if isnum else -1
+        if isnum:
+            one, two = one.lstrip('0'), two.lstrip('0')
+            if len(one) != len(two):
+                return 1 if len(one) > len(two) else -1
+        if one != two:
+            return 1 if one > two else -1
+    if i == len(a) and j == len(b):
+        return 0
+    return -1 if i == len(a) else 1
+
+
+def verrevcmp(a, b):
+    """
+    Reference comparison of debian upstream versions or revisions, python port of verrevcmp of dpkg
+    """
+    def order(c):
+        if not c or c.isdigit():
+            return 0
+        if c.isalpha():
+            return ord(c)
+        if c == '~':
+            return -1
+        return ord(c) + 256
+
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac, bc = order(a[i:i + 1]), order(b[j:j + 1])
+            if ac != bc:
+                return ac - bc
+            i, j = i + 1, j + 1
+        while a[i:i + 1] == '0':
+            i += 1
+        while b[j:j + 1] == '0':
+            j += 1
+        first_diff = 0
+        while a[i:i + 1].isdigit() and b[j:j + 1].isdigit():
+            first_diff = first_diff or ord(a[i]) - ord(b[j])
+            i, j = i + 1, j + 1
+        if a[i:i + 1].isdigit():
+            return 1
+        if b[j:j + 1].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+def evr_cmp(a, b, compare, split):
+    """
+    Reference comparison of [epoch:]version-release strings: epochs as numbers, then the rest with compare
+    """
+    a, b = split(a), split(b)
+    if a[0] != b[0]:
+        return sign(a[0] - b[0])
+    return sign(compare(a[1], b[1])) or sign(compare(a[2], b[2]))
+
+
+def rpm_split(evr):
+    epoch, _, vr = evr.rpartition(':')
+    version, _, release = vr.partition('-')
+    return int(epoch or 0), version, release
+
+
+def dpkg_split(version):
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    return int(epoch), upstream, revision
+
+
+RPM_TOKENS = ['0', '1', '2', '9', '10', '007', '1160', 'a', 'b', 'rc', 'el', 'Z', '.', '.', '_', '+', '~', '^']
+DPKG_TOKENS = ['0', '1', '2', '9', '10', '007', '1160', 'a', 'b', 'rc', 'Z', '.', '.', '+', '~']
+
+
+def random_part(rng, tokens, size=8):
+    return ''.join(rng.choice(tokens) for _ in range(rng.randint(0, size)))
+
+
+def random_evr(rng, tokens, epoch_sep=':'):
+    """
+    Random [epoch:]version[-release], often sharing the start with previous ones, so that they compare
+    equal up to the last segments
+    """
+    version = rng.choice(['', '1.0', '3.10.0', '5.15.0']) + random_part(rng, tokens)
+    if rng.random() < 0.2:
+        version = '%d%s%s' % (rng.randint(0, 2), epoch_sep, version)
+    if rng.random() < 0.7:
+        version += '-' + random_part(rng, tokens, 4)
+    return version
+
+
+class TestVersionProperties:
+    # sort keys must agree with the comparisons of rpm and dpkg on any versions, not just the ones seen so far
+    SEEDS = range(20)
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_rpm_matches_rpmvercmp(self, seed):
+        rng = random.Random(seed)
+        for _ in range(300):
+            prefix = random_part(rng, RPM_TOKENS, 4)
+            a, b = prefix + random_part(rng, RPM_TOKENS), prefix + random_part(rng, RPM_TOKENS)
+            assert compare(kernelchecker.rpm_version_key, a, b) == rpmvercmp(a, b), (a, b)
+            a, b = random_evr(rng, RPM_TOKENS), random_evr(rng, RPM_TOKENS)
+            assert compare(kernelchecker.rpm_evr_key, a, b) == evr_cmp(a, b, rpmvercmp, rpm_split), (a, b)
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_dpkg_matches_verrevcmp(self, seed):
+        rng = random.Random(seed)
+        for _ in range(300):
+            prefix = random_part(rng, DPKG_TOKENS, 4)
+            a, b = prefix + random_part(rng, DPKG_TOKENS), prefix + random_part(rng, DPKG_TOKENS)
+            assert compare(kernelchecker.dpkg_version_key, a, b) == sign(verrevcmp(a, b)), (a, b)
+            a, b = random_evr(rng, DPKG_TOKENS), random_evr(rng, DPKG_TOKENS)
+            assert compare(kernelchecker.dpkg_version_key, a, b) == evr_cmp(a, b, verrevcmp, dpkg_split), (a, b)
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_sorted_and_latest(self, seed):
+        rng = random.Random(seed)
+        for distro_type, tokens, reference in (('rpm', RPM_TOKENS, lambda a, b: evr_cmp(a, b, rpmvercmp, rpm_split)),
+                                               ('dpkg', DPKG_TOKENS,
+                                                lambda a, b: evr_cmp(a, b, verrevcmp, dpkg_split))):
+            versions = [random_evr(rng, tokens) for _ in range(rng.randint(1, 30))]
+            checker = KernelChecker(lazy=True)
+            checker.distro_type = distro_type
+            ordered = checker.sort_versions(versions)
+            assert all(reference(a, b) <= 0 for a, b in zip(ordered, ordered[1:])), ordered
+            # versions comparing equal, e.g. 1.0 and 1_0, keep their order
+            assert list(map(checker.version_key, ordered)) == \
+                list(map(checker.version_key, checker.sort_versions(rng.sample(versions, len(versions)))))
+            checker.current_version, checker.installed_versions = versions[0], versions[1:]
+            checker.available_versions = []
+            latest = checker.get_latest()
+            assert latest in versions
+            assert reference(latest, max(versions, key=functools.cmp_to_key(reference))) == 0
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_bumped_versions_are_newer(self, seed):
+        rng = random.Random(seed)
+        for _, fmt, _, version, _ in rng.sample(TestCorpus.ROWS, 50):
+            if version == '-':
+                continue
+            parts = re.split(r'(\d+)', version)
+            i = rng.choice([i for i, part in enumerate(parts) if part.isdigit()])
+            parts[i] = str(int(parts[i]) + rng.randint(1, 1000))
+            bumped = ''.join(parts)
+            key = kernelchecker.rpm_evr_key if fmt == 'rpm' else kernelchecker.dpkg_version_key
+            assert key(bumped) > key(version), (version, bumped)
+            assert key('1:' + version) > key(bumped)
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_suffixes(self, seed):
+        rng = random.Random(seed)
+        for _ in range(50):
+            version = random_part(rng, RPM_TOKENS) + rng.choice(['0', '1', 'a'])
+            suffix = random_part(rng, ['1', 'rc', 'git', '.', '~'], 3)
+            key = kernelchecker.rpm_version_key
+            assert key(version + '~' + suffix) < key(version) < key(version + '^' + suffix) < key(version + '.0')
+            assert key(version + '^' + suffix) < key(version + 'a')
+            key = kernelchecker.dpkg_version_key
+            version = version.replace('^', '').replace('_', '')
+            assert key(version + '~' + suffix) < key(version) < key(version + '+' + suffix)
+            assert key(version) < key(version + '.0')
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_strip_version(self, seed):
+        rng = random.Random(seed)
+        strip = kernelchecker.RpmHandler.strip_version
+        for _, _, package, version, _ in TestCorpus.RPM:
+            if version == '-':
+                continue
+            _, ver, release, arch = split_nevra(package)
+            full = '%s%s-%s%s' % (rng.choice(['', '0:', '1:']), ver, release, rng.choice(['', '.' + arch]))
+            assert strip(full) == version
+            assert strip(version) == version
+
+    @pytest.mark.parametrize('seed', SEEDS)
+    def test_deb_names(self, seed):
+        rng = random.Random(seed)
+        for _ in range(100):
+            prefix = rng.choice(kernelchecker.DEB_KERNEL_PREFIXES)
+            version = '.'.join(str(rng.randint(0, 200)) for _ in range(rng.randint(2, 3)))
+            release = '.'.join(str(rng.randint(0, 2000)) for _ in range(rng.randint(1, 2)))
+            flavor = rng.choice(['generic', 'aws', 'azure-fde', 'lowlatency-64k', 'cloud-amd64', 'rt-amd64', 'pve',
+                                 'arm64', 'generic-lpae', '', ''])
+            name = '-'.join(part for part in (prefix, version, release, flavor) if part)
+            if flavor:
+                name += rng.choice(['', '-signed', '-unsigned'])
+            record = kernelchecker.deb_package_record(name)
+            assert record == kernelchecker.PackageRecord(name, None, version, release, flavor), name
+            assert kernelchecker.deb_package_record(name.replace(prefix, prefix + '-headers', 1)) is None
+
+
+def http_get(socket_path, path='/'):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    sock.sendall(('GET %s HTTP/1.0\r\n\r\n' % path).encode())
+    response = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        response += chunk
+    sock.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), body
+
+
+class TestService:
+    @pytest.mark.parametrize('use_inotify', [False, True])
+    def test_watcher_detects_changes(self, tmp_path, use_inotify):
+        import threading
+        status = tmp_path / 'status'
+        status.write_text('a')
+        with patch.object(kernelchecker, 'SERVE_SETTLE_TIME', 0):
+            watcher = kernelchecker.StateWatcher([str(status), str(tmp_path / 'missing')], 0.05, use_inotify)
+            timer = threading.Timer(0.1, lambda: status.write_text('changed'))
+            timer.start()
+            started = time.time()
+            watcher.wait()
+        assert time.time() - started < 2
+
+    def test_watcher_detects_refreshed_dnf_metadata(self, tmp_path):
+        repodata = tmp_path / 'var/cache/dnf/baseos-0123456789abcdef/repodata'
+        repodata.mkdir(parents=True)
+        (repodata / 'aaaa-primary.xml.gz').write_bytes(b'old')
+        paths = kernelchecker.watched_paths(str(tmp_path))
+        assert str(repodata / 'aaaa-primary.xml.gz') in paths and str(tmp_path / 'var/cache/dnf') in paths
+        watcher = kernelchecker.StateWatcher(paths, 0.05, use_inotify=False)
+        # dnf makecache replaces metadata with files named by their checksums
+        (repodata / 'bbbb-primary.xml.gz').write_bytes(b'new')
+        (repodata / 'aaaa-primary.xml.gz').unlink()
+        assert watcher.wait(2) is True
+
+    def test_watcher_timeout(self, tmp_path):
+        watcher = kernelchecker.StateWatcher([str(tmp_path)], 0.05, use_inotify=False)
+        started = time.time()
+        assert watcher.wait(0.2) is False
+        assert time.time() - started < 1
+
+    def test_old_results_rechecked(self, rpm_host):
+        with patch.object(KernelChecker, 'is_kernelcare_supported_kernel', return_value=None):
+            unknown = KernelChecker()
+        factory = MagicMock(side_effect=[unknown, KernelChecker(), KernelChecker()])
+        watcher = MagicMock()
+        watcher.wait.side_effect = [False, False, KeyboardInterrupt]
+        service = kernelchecker.KernelCheckerService(factory, watcher, max_age=3600, retry=60)
+        with pytest.raises(KeyboardInterrupt):
+            service.watch()
+        # patches server didn't answer: retried soon, then complete results are kept for max_age
+        assert [call[0][0] for call in watcher.wait.call_args_list] == [60, 3600, 3600]
+        assert factory.call_count == 3
+        assert b'"supported": true' in service.response
+
+    def test_serves_cached_results(self, tmp_path, rpm_host):
+        import json
+        import threading
+        factory = MagicMock(side_effect=KernelChecker)
+        watcher = MagicMock()
+        service = kernelchecker.KernelCheckerService(factory, watcher)
+        socket_path = str(tmp_path / 'kernelchecker.sock')
+        server = kernelchecker.make_server(service, socket_path)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            for _ in range(3):
+                code, body = http_get(socket_path)
+                assert code == 200
+                data = json.loads(body)
+                assert data['latest'] == '3.10.0-1160.2'
+                assert data['kernelcare'] == {'installed': False, 'up2date': False, 'supported': True}
+            assert factory.call_count == 1
+            assert http_get(socket_path, '/other')[0] == 404
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_refresh_failure_keeps_results(self, rpm_host):
+        factory = MagicMock(side_effect=[KernelChecker(), OSError('rpmdb locked')])
+        watcher = MagicMock()
+        watcher.wait.side_effect = [None, KeyboardInterrupt]
+        service = kernelchecker.KernelCheckerService(factory, watcher)
+        response = service.response
+        with pytest.raises(KeyboardInterrupt):
+            service.watch()
+        assert service.response == response
+        # failed check is retried sooner than complete results get old
+        assert watcher.wait.call_args_list[1][0][0] == kernelchecker.RESULT_TTL
+
+
+class TestTextfile:
+    def test_metrics(self, rpm_host):
+        checker = KernelChecker()
+        checker.current_version = 'a"b\\'
+        checker.kernelcare = (False, None, True)
+        text = kernelchecker.prometheus_metrics(checker, 1700000000.5)
+        lines = text.splitlines()
+        assert 'kernelchecker_info{current="a\\"b\\\\",latest="3.10.0-1160.2",distro="rpm"} 1' in lines
+        assert 'kernelchecker_needs_update 1' in lines
+        assert 'kernelchecker_kernelcare_supported 1' in lines
+        assert 'kernelchecker_kernelcare_up2date' not in text
+        assert '# TYPE kernelchecker_inside_container gauge' in lines
+        assert 'kernelchecker_probe_timed_out{probe="installed"} 0' in lines
+        assert any(line.startswith('kernelchecker_probe_duration_seconds{probe="available"} ') for line in lines)
+        assert 'kernelchecker_last_check_success 1' in lines
+        assert lines[-1] == 'kernelchecker_last_success_timestamp_seconds 1700000000.500'
+
+    def test_write_once(self, rpm_host):
+        path = str(rpm_host / 'textfile' / 'kernelchecker.prom')
+        assert kernelchecker.textfile_main(KernelChecker, path) == 0
+        assert os.stat(path).st_mode & 0o777 == 0o644
+        assert 'kernelchecker_latest_installed 0\n' in open(path).read()
+        assert not [name for name in os.listdir(os.path.dirname(path)) if name != 'kernelchecker.prom']
+
+    def test_relative_path(self, rpm_host, monkeypatch):
+        monkeypatch.chdir(rpm_host)
+        assert kernelchecker.textfile_main(KernelChecker, 'kernelchecker.prom') == 0
+        assert 'kernelchecker_latest_installed 0\n' in (rpm_host / 'kernelchecker.prom').read_text()
+        cache = kernelchecker.CompatCache('compat.json')
+        cache.put('a' * 40, True)
+        cache.save()
+        assert kernelchecker.CompatCache('compat.json').get('a' * 40) is True
+
+    def test_interval(self, rpm_host):
+        path = str(rpm_host / 'kernelchecker.prom')
+        checker = KernelChecker()
+        factory = MagicMock(side_effect=[checker, checker, OSError('rpmdb locked')])
+        signatures = iter([1, 1, 2, 3])
+        sleeps = MagicMock(side_effect=[None, None, None, KeyboardInterrupt])
+        with patch.object(kernelchecker, 'file_signature', side_effect=lambda paths: next(signatures)), \
+                patch.object(kernelchecker.time, 'sleep', sleeps):
+            with pytest.raises(KeyboardInterrupt):
+                kernelchecker.textfile_main(factory, path, interval=60)
+        # unchanged files reuse results, changed ones are rechecked, a failed check keeps previous results
+        assert factory.call_count == 3
+        text = open(path).read()
+        assert 'kernelchecker_last_check_success 0\n' in text
+        assert 'kernelchecker_needs_update 1\n' in text
+
+
+@pytest.fixture
+def watched(tmp_path):
+    path = tmp_path / 'status'
+    path.write_text('')
+    with patch.object(kernelchecker, 'watched_paths', return_value=[str(path)]):
+        yield path
+
+
+class TestSingleFlight:
+    def test_reused_while_fresh(self, cache_dir, watched):
+        path = str(cache_dir / 'results.json')
+        compute = MagicMock(side_effect=lambda: {'latest': str(compute.call_count)})
+        assert kernelchecker.single_flight(path, '/', compute) == {'latest': '1'}
+        assert kernelchecker.single_flight(path, '/', compute) == {'latest': '1'}
+        assert kernelchecker.single_flight(path, '/mnt', compute) == {'latest': '2'}
+        assert kernelchecker.single_flight(path, '/', compute, refresh=True) == {'latest': '3'}
+        assert kernelchecker.single_flight(path, '/', compute, ttl=0) == {'latest': '4'}
+        watched.write_text('changed')
+        assert kernelchecker.single_flight(path, '/', compute) == {'latest': '5'}
+
+    def test_files_changed_by_compute(self, cache_dir, watched):
+        path = str(cache_dir / 'results.json')
+        # e.g. repository metadata refreshed by the check itself
+        compute = MagicMock(side_effect=lambda: watched.write_text(str(compute.call_count)) or {})
+        kernelchecker.single_flight(path, '/', compute)
+        kernelchecker.single_flight(path, '/', compute)
+        assert compute.call_count == 1
+
+    def test_watched_paths_in_root(self, tmp_path):
+        paths = kernelchecker.watched_paths(str(tmp_path))
+        assert str(tmp_path / 'var/lib/dpkg/status') in paths
+        assert all(path.startswith(str(tmp_path) + '/') for path in paths)
+        assert kernelchecker.watched_paths()[0] == kernelchecker.DPKG_STATUS
+
+    def test_concurrent_runs_compute_once(self, cache_dir, watched):
+        import threading
+        path = str(cache_dir / 'results.json')
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return {'latest': '3.10.0-1160'}
+
+        threads = [threading.Thread(target=lambda: results.append(kernelchecker.single_flight(path, '/', compute)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(calls) == 1
+        assert results == [{'latest': '3.10.0-1160'}] * 5
+
+    def test_unusable_cache_dir(self, tmp_path, watched):
+        (tmp_path / 'file').write_text('')
+        compute = MagicMock(return_value={})
+        kernelchecker.single_flight(str(tmp_path / 'file' / 'results.json'), '/', compute)
+        kernelchecker.single_flight(str(tmp_path / 'file' / 'results.json'), '/', compute)
+        assert compute.call_count == 2
+
+    def test_main(self, rpm_host, cache_dir, capsys):
+        with patch('sys.argv', ['kernelchecker.py']):
+            kernelchecker.main()
+            first = capsys.readouterr().out
+            with patch.object(kernelchecker.RpmHandler, 'get_available', return_value=['3.10.0-1160.9']):
+                kernelchecker.main()
+                assert capsys.readouterr().out == first
+                with patch('sys.argv', ['kernelchecker.py', '--result-ttl', '0']):
+                    kernelchecker.main()
+                assert 'latest : 3.10.0-1160.9\n' in capsys.readouterr().out
+        assert (cache_dir / 'results.json').exists()
+
+    @pytest.mark.parametrize('options', [['--server', 'mirror.example.com'], ['--retries', '0'],
+                                         ['--timeout', '5'], ['--root', '/mnt']])
+    def test_main_options_in_key(self, cache_dir, options):
+        import json
+        with patch.object(kernelchecker, 'checker_factory') as factory:
+            factory.return_value.return_value.todict.return_value = {}
+            with patch('sys.argv', ['kernelchecker.py']):
+                kernelchecker.main()
+            with patch('sys.argv', ['kernelchecker.py'] + options):
+                kernelchecker.main()
+        assert len(json.load(open(str(cache_dir / 'results.json')))) == 2
+
+
+BANNER = b'Linux version 5.14.0-70.el9.x86_64 (mockbuild@example.com) (gcc 11.2.1) #1 SMP PREEMPT Mon Jan 1\n'
+
+
+def make_vmlinuz(path, compress, banner=BANNER):
+    import random
+    rng = random.Random(0)
+    kernel = bytes(rng.getrandbits(8) for _ in range(300000)) + b'%s version %s\0' + banner + b'\0' * 1000
+    # setup code with a stray gzip magic, then compressed kernel
+    path.write_bytes(b'MZ' + b'\0' * 510 + b'\x1f\x8b\x08junk' + b'\0' * 100 + compress(kernel) + b'\0' * 64)
+    return str(path)
+
+
+class TestBootKernels:
+    @pytest.mark.parametrize('compression', ['gzip', 'lzma', 'bz2', 'none'])
+    def test_read_banner(self, tmp_path, compression):
+        import gzip, lzma, bz2
+        compress = {'gzip': gzip.compress, 'lzma': lzma.compress, 'bz2': bz2.compress, 'none': lambda data: data}
+        path = make_vmlinuz(tmp_path / 'vmlinuz', compress[compression])
+        assert kernelchecker.read_kernel_banner(path) == BANNER
+
+    def test_read_zstd_banner(self, tmp_path):
+        zstandard = pytest.importorskip('zstandard')
+        path = make_vmlinuz(tmp_path / 'vmlinuz', zstandard.ZstdCompressor().compress)
+        assert kernelchecker.read_kernel_banner(path) == BANNER
+
+    def test_no_banner(self, tmp_path):
+        import gzip
+        path = tmp_path / 'vmlinuz'
+        path.write_bytes(b'MZ' + gzip.compress(b'\0' * 1000))
+        with pytest.raises(IOError):
+            kernelchecker.read_kernel_banner(str(path))
+
+    def test_boot_main(self, tmp_path, capsys):
+        import gzip, hashlib, json
+        boot = tmp_path / 'boot'
+        boot.mkdir()
+        other = BANNER.replace(b'5.14.0-70', b'5.14.0-162')
+        make_vmlinuz(boot / 'vmlinuz-5.14.0-70.el9.x86_64', gzip.compress)
+        make_vmlinuz(boot / 'vmlinuz-5.14.0-162.el9.x86_64', gzip.compress, other)
+        (boot / 'vmlinuz-0-rescue').write_bytes(b'')
+        supported = {hashlib.sha1(BANNER).hexdigest(): 200, hashlib.sha1(other).hexdigest(): 404}
+        requests = []
+
+        def request(client, server, path, headers=None):
+            requests.append(path)
+            return supported[path.split('/')[-2]], 'OK'
+
+        with patch.object(kernelchecker.ProbeClient, 'request', request):
+            rc = kernelchecker.boot_main(vars(kernelchecker.parse_args([])), str(tmp_path))
+        assert rc == 1
+        records = dict((os.path.basename(record['image']), record)
+                       for record in map(json.loads, capsys.readouterr().out.splitlines()))
+        assert records['vmlinuz-5.14.0-70.el9.x86_64']['supported'] is True
+        assert records['vmlinuz-5.14.0-162.el9.x86_64']['release'] == '5.14.0-162.el9.x86_64'
+        assert records['vmlinuz-5.14.0-162.el9.x86_64']['supported'] is False
+        assert records['vmlinuz-5.14.0-162.el9.x86_64']['running'] is False
+        assert 'error' in records['vmlinuz-0-rescue']
+        assert len(requests) == 2
+        # answers are cached
+        with patch.object(kernelchecker.ProbeClient, 'request', request):
+            kernelchecker.boot_main(vars(kernelchecker.parse_args([])), str(tmp_path))
+        assert len(requests) == 2
+
+
+class TestCompatIndex:
+    def test_supported_kernel_offline(self, tmp_path):
+        import struct
+        digests = sorted(bytes.fromhex(h) for h in ['a' * 40, 'c' * 40])
+        path = tmp_path / 'index'
+        path.write_bytes(kernelchecker.INDEX_MAGIC + struct.pack('>Q', len(digests)) + b''.join(digests))
+        index = kernelchecker.CompatIndex(str(path))
+        with patch.object(kernelchecker.ProbeClient, 'request') as mock_request:
+            with patch.object(KernelChecker, 'get_kernel_hash', return_value='c' * 40):
+                assert KernelChecker.is_kernelcare_supported_kernel(index=index) == True
+            with patch.object(KernelChecker, 'get_kernel_hash', return_value='b' * 40):
+                assert KernelChecker.is_kernelcare_supported_kernel(index=index) == False
+        mock_request.assert_not_called()
+
+
+class TestTimings:
+    def test_span_hook_and_exit_codes(self):
+        spans = []
+        kernelchecker.add_span_hook(spans.append)
+        try:
+            timings = kernelchecker.Timings()
+            with timings.span('phase'):
+                kernelchecker.check_output(['false'])
+        finally:
+            kernelchecker.remove_span_hook(spans.append)
+        assert spans == timings.spans
+        assert spans[0]['name'] == 'phase'
+        assert spans[0]['exit_codes'] == [['false', 1]]
+        assert spans[0]['wall'] >= 0
+
+    def test_exit_codes_outside_span_ignored(self):
+        kernelchecker.check_output(['true'])
+
+    def test_timed_out_probe(self):
+        timings = kernelchecker.Timings()
+        kernelchecker.run_probes({'slow': lambda: time.sleep(1), 'fast': lambda: 1}, {'slow': 0.05, 'fast': 1}, timings)
+        assert [span['name'] for span in timings.spans if span.get('timed_out')] == ['slow']
+        assert 'fast' in [span['name'] for span in timings.spans]
+
+    def test_output(self, rpm_host):
+        checker = KernelChecker()
+        names = [span['name'] for span in checker.timings.spans]
+        assert sorted(names) == ['available', 'installed', 'supported', 'total']
+        assert '"timings"' in checker.tojson(timings=True)
+        assert '"timings"' not in checker.tojson()
+        assert '    - name : total\n' in checker.toyaml(timings=True)
+        assert 'timings' not in checker.toyaml()
+
+
+class TestSharedWithKcCompat:
+    # kc-compat.py is run on its own through curl | python, so these are copies rather than imports
+    SHARED = ['write_atomic', 'server_url', 'in_root', 'conditional_headers',
+              'response_validators', 'splay_delay', 'CACHE_TTL', 'CACHE_NEGATIVE_TTL', 'CACHE_VALIDATORS_TTL',
+              'VALIDATOR_HEADERS', 'MACHINE_ID_FILES', 'INDEX_MAGIC', 'PATCH_SERVER', 'PROBE_TIMEOUT',
+              'PROBE_CONNECT_TIMEOUT', 'PROBE_RETRIES', 'PROBE_BACKOFF', 'release_key', 'read_kernel_banner',
+              '_scan_payload', '_payload_decompressors', '_zstd_decompressor', 'BOOT_IMAGES', 'BANNER_PATTERN',
+              'BANNER_MAX', 'BANNER_CHUNK', 'BANNER_CANDIDATES', 'url_errors', 'HostFacts', 'CompatCache',
+              'CompatIndex', 'ProbeClient']
+
+    @pytest.mark.parametrize('name', SHARED)
+    def test_same(self, name):
+        import inspect
+        spec = importlib.util.spec_from_file_location('kc_compat', 'kc-compat.py')
+        kc_compat = importlib.util.module_from_spec(spec)
+        # classes are found in their module's source by inspect
+        with patch.dict(sys.modules, {'kc_compat': kc_compat}):
+            spec.loader.exec_module(kc_compat)
+            ours, theirs = getattr(kernelchecker, name), getattr(kc_compat, name)
+            if inspect.isfunction(ours) or inspect.isclass(ours):
+                ours, theirs = inspect.getsource(ours), inspect.getsource(theirs)
+        assert ours == theirs
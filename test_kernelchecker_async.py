@@ -0,0 +1,170 @@
+import pytest
+import asyncio
+import time
+from unittest.mock import patch
+from urllib.error import HTTPError, URLError
+
+import kernelchecker_async
+
+kernelchecker = kernelchecker_async.kernelchecker
+KernelChecker = kernelchecker.KernelChecker
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def serve(statuses):
+    """
+    :param statuses: dict of request method -> response status line, optionally followed by header lines;
+        methods of requests are recorded in its 'requests', and requests themselves in 'raw'
+    """
+    requests = statuses.setdefault('requests', [])
+    raw = statuses.setdefault('raw', [])
+
+    async def handle(reader, writer):
+        request = (await reader.readuntil(b'\r\n\r\n')).decode()
+        method = request.split()[0]
+        requests.append(method)
+        raw.append(request)
+        writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\n\r\n' % statuses[method]).encode())
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, '127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+
+
+class TestRunCommand:
+    def test_output(self):
+        assert run(kernelchecker_async.run_command(['sh', '-c', 'echo kernel; exit 3'])) == ('kernel\n', 3)
+
+    def test_timeout_kills(self):
+        started = time.time()
+        with pytest.raises(asyncio.TimeoutError):
+            run(kernelchecker_async.run_command(['sleep', '10'], 0.1))
+        assert time.time() - started < 5
+
+    def test_query_commands(self):
+        query = kernelchecker.PackageQuery(['echo', 'first'], lambda output: kernelchecker.PackageQuery(
+            ['echo', output.strip() + ' second'], lambda output: output.split()))
+        assert run(kernelchecker_async.run_query(lambda: query)) == ['first', 'second']
+
+
+class TestProbeClient:
+    def check(self, statuses, servers=None, **kwargs):
+        async def main():
+            server, address = await serve(statuses)
+            async with server:
+                client = kernelchecker_async.AsyncProbeClient(servers or [address], backoff=0.01, **kwargs)
+                return await client.check('a' * 40)
+        return run(main())
+
+    def test_found(self):
+        statuses = {'HEAD': '200 OK'}
+        assert self.check(statuses) is True
+        assert statuses['requests'] == ['HEAD']
+
+    def test_not_found(self):
+        assert self.check({'HEAD': '404 Not Found'}) is False
+
+    def test_head_not_allowed(self):
+        statuses = {'HEAD': '405 Method Not Allowed', 'GET': '206 Partial Content'}
+        assert self.check(statuses) is True
+        assert statuses['requests'] == ['HEAD', 'GET']
+
+    def test_retries(self):
+        statuses = {'HEAD': '503 Service Unavailable'}
+        with pytest.raises(HTTPError):
+            self.check(statuses, retries=2)
+        assert statuses['requests'] == ['HEAD'] * 3
+
+    def test_conditional_request(self):
+        async def main():
+            server, address = await serve(statuses)
+            async with server:
+                client = kernelchecker_async.AsyncProbeClient([address])
+                found = await client.check('a' * 40)
+                validators = client.answer_validators('a' * 40)
+                statuses['HEAD'] = '304 Not Modified'
+                return found, validators, await client.check('a' * 40, validators)
+
+        statuses = {'HEAD': '200 OK\r\nETag: "v1"\r\nLast-Modified: Mon, 05 Oct 2026 10:00:00 GMT'}
+        assert run(main()) == (True, {'etag': '"v1"', 'last_modified': 'Mon, 05 Oct 2026 10:00:00 GMT'}, True)
+        assert 'If-None-Match' not in statuses['raw'][0]
+        assert 'If-None-Match: "v1"\r\n' in statuses['raw'][1]
+        assert 'If-Modified-Since: Mon, 05 Oct 2026 10:00:00 GMT\r\n' in statuses['raw'][1]
+
+    def test_splay(self):
+        with patch.object(kernelchecker_async, 'splay_delay', return_value=0.2) as mock_delay:
+            started = time.time()
+            assert self.check({'HEAD': '200 OK'}, splay=30) is True
+        mock_delay.assert_called_once_with(30)
+        assert time.time() - started >= 0.2
+
+    def test_connection_error(self):
+        with pytest.raises(URLError):
+            self.check({}, servers=['127.0.0.1:1'], retries=0)
+
+    def test_mirrors(self):
+        async def main():
+            server, address = await serve({'HEAD': '200 OK'})
+            async with server:
+                client = kernelchecker_async.AsyncProbeClient(['127.0.0.1:1', address], retries=0)
+                return await client.check('a' * 40)
+        assert run(main()) is True
+
+
+class TestCheck:
+    def test_get_data(self, rpm_host):
+        async def main():
+            server, address = await serve({'HEAD': '200 OK'})
+            async with server:
+                client = kernelchecker_async.AsyncProbeClient([address])
+                return await kernelchecker_async.get_data(client=client)
+        assert run(main()) == ('3.10.0-1160.2', '3.10.0-1160', 'rpm', True, False, True, False, False, False, True)
+
+    def test_same_as_sync(self, rpm_host):
+        async def main():
+            server, address = await serve({'HEAD': '404 Not Found'})
+            async with server:
+                return await kernelchecker_async.check(client=kernelchecker_async.AsyncProbeClient([address]))
+        checker = run(main())
+        with patch.object(KernelChecker, 'is_kernelcare_supported_kernel', return_value=False):
+            assert checker.todict() == KernelChecker().todict()
+        assert sorted(span['name'] for span in checker.timings.spans) == ['available', 'installed', 'supported']
+
+    def test_probe_timeout(self, rpm_host):
+        slow = kernelchecker.PackageQuery(['sleep', '10'], str)
+        with patch.object(kernelchecker.RpmHandler, 'query_installed', return_value=slow):
+            started = time.time()
+            checker = run(kernelchecker_async.check(timeouts={'installed': 0.2, 'available': 1, 'supported': 1},
+                                                    index=set()))
+        assert time.time() - started < 5
+        assert checker.installed_versions is None
+        assert checker.kernelcare == (False, False, False)
+        assert [span['name'] for span in checker.timings.spans if span.get('timed_out')] == ['installed']
+
+    def test_cancel(self, rpm_host):
+        slow = kernelchecker.PackageQuery(['sleep', '10'], str)
+
+        async def main():
+            task = asyncio.ensure_future(kernelchecker_async.check(index=set()))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        with patch.object(kernelchecker.RpmHandler, 'query_installed', return_value=slow):
+            started = time.time()
+            run(main())
+        assert time.time() - started < 5
+
+    def test_is_compat(self, rpm_host):
+        assert run(kernelchecker_async.is_compat(index={'a' * 40})) is True
+        cache = kernelchecker.CompatCache(str(rpm_host / 'compat.json'))
+        cache.put('a' * 40, False)
+        assert run(kernelchecker_async.is_compat(cache)) is False
+        with pytest.raises(URLError):
+            run(kernelchecker_async.is_compat(client=kernelchecker_async.AsyncProbeClient(['127.0.0.1:1'],
+                                                                                         retries=0)))